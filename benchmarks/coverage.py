@@ -0,0 +1,176 @@
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import click
+import numpy as np
+
+from benchmarks.high_density import make_sprites
+from countpillar.composition import create_pill_comp
+from countpillar.random_utils import get_sample_rng
+from countpillar.scheduler import CoverageScheduler
+
+
+def images_to_cover(
+    compose: Callable[[int], Tuple[int, int]],
+    scheduler: CoverageScheduler,
+    min_per_cell: int,
+    max_images: int,
+) -> Optional[int]:
+    """Count the images composed until every cell of the scheduler holds at least
+    `min_per_cell` images.
+
+    Args:
+        compose: The function composing an image from its index, and returning the
+            number of pills and of pill types actually placed in it.
+        scheduler: The scheduler whose cells are covered.
+        min_per_cell: The number of images each cell should hold.
+        max_images: The number of images after which to give up.
+
+    Returns:
+        The number of images, or None if the cells are not covered after `max_images`.
+    """
+    counts = np.zeros(len(scheduler.cells), dtype=int)
+    n_uncovered = len(scheduler.cells)
+    for idx in range(max_images):
+        cell = scheduler.find_cell(*compose(idx))
+        if cell is None:
+            continue
+        counts[cell] += 1
+        if counts[cell] == min_per_cell:
+            n_uncovered -= 1
+            if n_uncovered == 0:
+                return idx + 1
+
+    return None
+
+
+def compose_cell(
+    bg_img: np.ndarray,
+    sprites: Sequence[Tuple[np.ndarray, np.ndarray]],
+    pills_per_type: Optional[List[int]],
+    rng: np.random.Generator,
+    **kwargs,
+) -> Tuple[int, int]:
+    """Compose an image and get the number of pills and of pill types placed in it.
+
+    Args:
+        bg_img: The background image.
+        sprites: The pill sprites, each of its own pill type.
+        pills_per_type: The planned number of pills of each pill type, or None to draw
+            them with create_pill_comp.
+        rng: The random generator of the image.
+        **kwargs: Keyword arguments for create_pill_comp.
+
+    Returns:
+        The number of pills and the number of pill types of the composition.
+    """
+    _, _, labels, _ = create_pill_comp(
+        bg_img,
+        [],
+        sprite_cache=sprites,
+        sprite_labels=list(range(len(sprites))),
+        pills_per_type=pills_per_type,
+        rng=rng,
+        **kwargs,
+    )
+    return len(labels), len(set(labels))
+
+
+@click.command()
+@click.option(
+    "-mp", "--min-pills", default=5, show_default=True, help="Minimum pills per image"
+)
+@click.option(
+    "-MP", "--max-pills", default=50, show_default=True, help="Maximum pills per image"
+)
+@click.option(
+    "-np",
+    "--n-pill-types",
+    default=[1, 2, 3],
+    multiple=True,
+    show_default=True,
+    help="Number of different types of pills",
+)
+@click.option(
+    "-nb",
+    "--n-count-bins",
+    default=10,
+    show_default=True,
+    help="Number of pill count bins",
+)
+@click.option(
+    "-k",
+    "--min-per-cell",
+    default=5,
+    show_default=True,
+    help="Number of images each cell should hold",
+)
+@click.option(
+    "-M",
+    "--max-images",
+    default=20_000,
+    show_default=True,
+    help="Number of images after which to give up on a schedule",
+)
+@click.option(
+    "-bs", "--bg-size", default=384, show_default=True, help="Side of the background"
+)
+@click.option(
+    "-p", "--pill-size", default=32, show_default=True, help="Long side of the pills"
+)
+@click.option("-s", "--seed", default=0, show_default=True, help="Seed of the images")
+def main(
+    min_pills: int,
+    max_pills: int,
+    n_pill_types: List[int],
+    n_count_bins: int,
+    min_per_cell: int,
+    max_images: int,
+    bg_size: int,
+    pill_size: int,
+    seed: int,
+) -> None:
+    """Count the images needed to cover every pill count bin x number of pill types
+    with the random and the stratified schedules. The images are composed, and
+    counted in the cell of the pills actually placed in them."""
+    sprites = make_sprites(16)
+    bg_img = np.zeros((bg_size, bg_size, 3), dtype=np.uint8)
+
+    print(f"{'types':>5} {'cells':>6} {'random':>10} {'stratified':>10} {'ratio':>7}")
+    for n_types in n_pill_types:
+        scheduler = CoverageScheduler(seed, min_pills, max_pills, n_types, n_count_bins)
+        comp_kwargs = dict(
+            n_pill_types=n_types,
+            min_pills=min_pills,
+            max_pills=max_pills,
+            longest_min=pill_size,
+            longest_max=pill_size,
+        )
+
+        def compose_random(idx: int) -> Tuple[int, int]:
+            rng = get_sample_rng(seed, idx)
+            return compose_cell(bg_img, sprites, None, rng, **comp_kwargs)
+
+        def compose_stratified(idx: int) -> Tuple[int, int]:
+            rng = get_sample_rng(seed, idx)
+            pills_per_type = scheduler.plan_sample(idx, rng)
+            return compose_cell(bg_img, sprites, pills_per_type, rng, **comp_kwargs)
+
+        n_random = images_to_cover(compose_random, scheduler, min_per_cell, max_images)
+        n_stratified = images_to_cover(
+            compose_stratified, scheduler, min_per_cell, max_images
+        )
+        ratio = (
+            f"{n_random / n_stratified:6.1f}x"
+            if n_random is not None and n_stratified is not None
+            else "-"
+        )
+        print(
+            f"{n_types:>5} {len(scheduler.cells):>6} "
+            f"{n_random if n_random is not None else f'>{max_images}':>10} "
+            f"{n_stratified if n_stratified is not None else f'>{max_images}':>10} "
+            f"{ratio:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
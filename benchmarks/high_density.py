@@ -0,0 +1,140 @@
+import time
+from typing import Dict, List, Tuple
+
+import click
+import cv2
+import numpy as np
+
+from countpillar.composition import create_pill_comp
+from countpillar.object_overlay import generate_random_bg
+
+
+def make_sprites(
+    n_sprites: int, size: int = 256, seed: int = 0
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Draw random elliptical pills in memory, so that no data directory is needed."""
+    rng = np.random.default_rng(seed)
+    sprites: List[Tuple[np.ndarray, np.ndarray]] = []
+    for _ in range(n_sprites):
+        mask = np.zeros((size, size), dtype=np.uint8)
+        axes = (
+            int(rng.integers(size // 4, size // 2)),
+            int(rng.integers(size // 6, size // 3)),
+        )
+        cv2.ellipse(
+            mask,
+            (size // 2, size // 2),
+            axes,
+            float(rng.uniform(0, 180)),
+            0,
+            360,
+            1,
+            -1,
+        )
+        img = np.zeros((size, size, 3), dtype=np.uint8)
+        img[mask == 1] = rng.integers(0, 256, size=3)
+        sprites.append((img, mask))
+
+    return sprites
+
+
+@click.command()
+@click.option(
+    "-n",
+    "--n-pills",
+    default=[100, 250, 500, 1000, 2000, 5000],
+    multiple=True,
+    show_default=True,
+    help="Number of pills per image",
+)
+@click.option(
+    "-s",
+    "--bg-size",
+    default=4096,
+    show_default=True,
+    help="Side of the square background",
+)
+@click.option(
+    "-p", "--pill-size", default=40, show_default=True, help="Long side of the pills"
+)
+@click.option(
+    "-mo",
+    "--max-overlap",
+    default=0.5,
+    show_default=True,
+    help="Maximum overlap between pills",
+)
+@click.option(
+    "-pl",
+    "--placement",
+    default="gaussian",
+    type=click.Choice(["gaussian", "free"]),
+    show_default=True,
+    help="How the candidate pill positions are drawn",
+)
+@click.option(
+    "-tc/-no-tc",
+    "--target-count/--no-target-count",
+    default=False,
+    show_default=True,
+    help="Share the placement attempts between all the pills of an image",
+)
+@click.option(
+    "-r",
+    "--repeats",
+    default=3,
+    show_default=True,
+    help="Number of images per pill count",
+)
+def main(
+    n_pills: List[int],
+    bg_size: int,
+    pill_size: int,
+    max_overlap: float,
+    placement: str,
+    target_count: bool,
+    repeats: int,
+) -> None:
+    """Time create_pill_comp on scenes of increasing density. The cost per attempt and
+    per placed pill should stay flat as the number of pills grows, and the number of
+    placed pills should get close to the requested one."""
+    sprites = make_sprites(16)
+    bg_img = generate_random_bg(bg_size, bg_size)
+
+    print(
+        f"{'pills':>8} {'placed':>8} {'attempts':>9} {'s/image':>9} {'us/attempt':>11} {'us/pill':>9} {'pills/s':>9}"
+    )
+    for n in n_pills:
+        np.random.seed(n)
+        elapsed, placed, attempts = 0.0, 0, 0
+        for _ in range(repeats):
+            stats: Dict[str, int] = {}
+            start = time.perf_counter()
+            _, mask_comp, labels, _ = create_pill_comp(
+                bg_img,
+                [],
+                n_pill_types=1,
+                min_pills=n,
+                max_pills=n,
+                max_overlap=max_overlap,
+                placement=placement,
+                target_count=target_count,
+                sprite_cache=sprites,
+                stats=stats,
+                longest_min=pill_size,
+                longest_max=pill_size,
+            )
+            elapsed += time.perf_counter() - start
+            placed += len(labels)
+            attempts += stats["attempts"]
+            assert mask_comp.max() == len(labels)
+
+        print(
+            f"{n:>8} {placed / repeats:>8.0f} {attempts / repeats:>9.0f} {elapsed / repeats:>9.2f}"
+            f" {1e6 * elapsed / attempts:>11.0f} {1e6 * elapsed / max(placed, 1):>9.0f}"
+            f" {placed / elapsed:>9.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
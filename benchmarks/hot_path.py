@@ -0,0 +1,395 @@
+import json
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import click
+import cv2
+import numpy as np
+
+from benchmarks.high_density import make_sprites
+from countpillar.composition import create_pill_comp
+from countpillar.io_utils import create_yolo_annotations
+from countpillar.object_overlay import (
+    add_pill_on_bg,
+    generate_random_bg,
+    get_mask_dtype,
+    verify_overlap,
+)
+from countpillar.transform import resize_and_transform_pill
+
+# Height and width of the backgrounds, from VGA to 4K UHD
+BG_SHAPES = {640: (480, 640), 1920: (1080, 1920), 3840: (2160, 3840)}
+
+# Largest boolean mask stack `verify_overlap` is timed on, in bytes
+MAX_VERIFY_BYTES = 2**30
+
+
+def time_call(
+    func: Callable[[], Any], repeats: int, min_time: float = 0.05
+) -> Dict[str, float]:
+    """Time a function, calling it in batches of at least `min_time` seconds.
+
+    Args:
+        func: The function to time.
+        repeats: The number of batches.
+        min_time: The minimum duration of a batch, in seconds.
+
+    Returns:
+        The median and minimum time per call over the batches, in seconds, and the
+        number of calls per batch.
+    """
+    n_calls = 1
+    start = time.perf_counter()
+    func()
+    first = time.perf_counter() - start
+    if first < min_time:
+        n_calls = int(min_time / max(first, 1e-7)) + 1
+
+    timings: List[float] = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            func()
+        timings.append((time.perf_counter() - start) / n_calls)
+
+    return {
+        "median": statistics.median(timings),
+        "min": min(timings),
+        "calls": n_calls,
+    }
+
+
+def get_pill_size(bg_shape: Tuple[int, int], n_pills: int) -> int:
+    """Get a long side of the pills at which `n_pills` pills roughly fill a background,
+    so that every pill count can be composed on every background size."""
+    size = int(0.8 * np.sqrt(bg_shape[0] * bg_shape[1] / n_pills))
+    return int(np.clip(size, 16, 224))
+
+
+def compose(
+    bg_img: np.ndarray,
+    sprites: List[Tuple[np.ndarray, np.ndarray]],
+    n_pills: int,
+    max_overlap: float,
+    seed: int = 0,
+    stats: Optional[Dict[str, int]] = None,
+) -> Tuple[np.ndarray, np.ndarray, List[int], List[int]]:
+    """Compose `n_pills` pills scaled to the background with create_pill_comp."""
+    pill_size = get_pill_size(bg_img.shape[:2], n_pills)
+    return create_pill_comp(
+        bg_img,
+        [],
+        n_pill_types=1,
+        min_pills=n_pills,
+        max_pills=n_pills,
+        max_overlap=max_overlap,
+        sprite_cache=sprites,
+        stats=stats,
+        rng=np.random.default_rng(seed),
+        longest_min=pill_size,
+        longest_max=pill_size,
+    )
+
+
+def bench_add_pill_on_bg(
+    sprites: List[Tuple[np.ndarray, np.ndarray]],
+    bg_size: int,
+    n_pills: int,
+    repeats: int,
+) -> Dict[str, float]:
+    """Time adding one more pill to a composition of `n_pills` pills."""
+    bg_img, mask_comp, labels, _ = compose(
+        generate_random_bg(*BG_SHAPES[bg_size]), sprites, n_pills, 0.5
+    )
+    idx = len(labels) + 1
+    mask_comp = mask_comp.astype(get_mask_dtype(idx))
+    pill_size = get_pill_size(bg_img.shape[:2], n_pills)
+    pill_img = cv2.resize(sprites[0][0], (pill_size, pill_size))
+    pill_mask = cv2.resize(sprites[0][1], (pill_size, pill_size))
+    x, y = bg_img.shape[1] // 2, bg_img.shape[0] // 2
+
+    return time_call(
+        lambda: add_pill_on_bg(bg_img, mask_comp, pill_img, pill_mask, x, y, idx),
+        repeats,
+    )
+
+
+def bench_verify_overlap(
+    sprites: List[Tuple[np.ndarray, np.ndarray]],
+    bg_size: int,
+    n_pills: int,
+    repeats: int,
+) -> Optional[Dict[str, float]]:
+    """Time checking the overlap of the last pill of a composition of `n_pills` pills,
+    unless the mask stack it allocates would be too large."""
+    h, w = BG_SHAPES[bg_size]
+    if n_pills * h * w > MAX_VERIFY_BYTES:
+        return None
+
+    _, mask_comp, _, pill_areas = compose(
+        generate_random_bg(h, w), sprites, n_pills, 0.5
+    )
+    return time_call(lambda: verify_overlap(mask_comp, pill_areas, 0.5), repeats)
+
+
+def bench_create_yolo_annotations(
+    sprites: List[Tuple[np.ndarray, np.ndarray]],
+    bg_size: int,
+    n_pills: int,
+    repeats: int,
+) -> Dict[str, float]:
+    """Time annotating a composition of `n_pills` pills."""
+    _, mask_comp, labels, _ = compose(
+        generate_random_bg(*BG_SHAPES[bg_size]), sprites, n_pills, 0.5
+    )
+    return time_call(lambda: create_yolo_annotations(mask_comp, labels), repeats)
+
+
+def bench_resize_and_transform_pill(
+    sprites: List[Tuple[np.ndarray, np.ndarray]], pill_size: int, repeats: int
+) -> Dict[str, float]:
+    """Time resizing and augmenting a pill to a long side of `pill_size` pixels."""
+    img, mask = sprites[0]
+    rng = np.random.default_rng(0)
+    return time_call(
+        lambda: resize_and_transform_pill(img, mask, pill_size, pill_size, rng=rng),
+        repeats,
+    )
+
+
+def bench_create_pill_comp(
+    sprites: List[Tuple[np.ndarray, np.ndarray]],
+    bg_size: int,
+    n_pills: int,
+    max_overlap: float,
+    repeats: int,
+) -> Dict[str, float]:
+    """Time composing a whole image of `n_pills` pills, each repeat with a new seed."""
+    bg_img = generate_random_bg(*BG_SHAPES[bg_size])
+    timings: List[float] = []
+    placed, attempts = 0, 0
+    for seed in range(repeats):
+        stats: Dict[str, int] = {}
+        start = time.perf_counter()
+        _, _, labels, _ = compose(bg_img, sprites, n_pills, max_overlap, seed, stats)
+        timings.append(time.perf_counter() - start)
+        placed += len(labels)
+        attempts += stats["attempts"]
+
+    return {
+        "median": statistics.median(timings),
+        "min": min(timings),
+        "calls": 1,
+        "placed": placed / repeats,
+        "attempts": attempts / repeats,
+    }
+
+
+def run_benchmarks(
+    n_pills: List[int],
+    bg_sizes: List[int],
+    max_overlaps: List[float],
+    pill_sizes: List[int],
+    repeats: int,
+) -> Dict[str, Dict[str, Any]]:
+    """Run every benchmark over its sweep of parameters.
+
+    Returns:
+        The timings of each benchmark case, along with its parameters, keyed by the
+        name of the case.
+    """
+    sprites = make_sprites(16)
+    results: Dict[str, Dict[str, Any]] = {}
+
+    def record(name: str, params: Dict[str, Any], timing: Optional[Dict]) -> None:
+        if timing is None:
+            return
+        key = f"{name}[{','.join(f'{k}={v}' for k, v in params.items())}]"
+        results[key] = {"benchmark": name, "params": params, **timing}
+        print(f"{key:<70} {1e3 * timing['median']:>10.3f} ms")
+
+    for pill_size in pill_sizes:
+        record(
+            "resize_and_transform_pill",
+            {"pill_size": pill_size},
+            bench_resize_and_transform_pill(sprites, pill_size, repeats),
+        )
+    for bg_size in bg_sizes:
+        for n in n_pills:
+            params = {"bg_size": bg_size, "n_pills": n}
+            record(
+                "add_pill_on_bg",
+                params,
+                bench_add_pill_on_bg(sprites, bg_size, n, repeats),
+            )
+            record(
+                "verify_overlap",
+                params,
+                bench_verify_overlap(sprites, bg_size, n, repeats),
+            )
+            record(
+                "create_yolo_annotations",
+                params,
+                bench_create_yolo_annotations(sprites, bg_size, n, repeats),
+            )
+            for max_overlap in max_overlaps:
+                record(
+                    "create_pill_comp",
+                    {**params, "max_overlap": max_overlap},
+                    bench_create_pill_comp(sprites, bg_size, n, max_overlap, repeats),
+                )
+
+    return results
+
+
+def compare_results(
+    results: Dict[str, Dict[str, Any]],
+    baseline: Dict[str, Dict[str, Any]],
+    tolerance: float,
+) -> List[str]:
+    """Print the speedup of every case over the baseline.
+
+    Args:
+        results: The new results.
+        baseline: The results of the baseline.
+        tolerance: The relative slowdown of the median time above which a case is
+            reported as a regression.
+
+    Returns:
+        The names of the regressed cases.
+    """
+    regressions: List[str] = []
+    print(f"\n{'case':<70} {'baseline':>10} {'new':>10} {'speedup':>8}")
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base, new = baseline[key]["median"], result["median"]
+        flag = ""
+        if new > base * (1 + tolerance):
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(
+            f"{key:<70} {1e3 * base:>8.3f}ms {1e3 * new:>8.3f}ms"
+            f" {base / new:>7.2f}x{flag}"
+        )
+
+    return regressions
+
+
+@click.command()
+@click.option(
+    "-n",
+    "--n-pills",
+    default=[5, 50, 500],
+    multiple=True,
+    show_default=True,
+    help="Number of pills per image",
+)
+@click.option(
+    "-s",
+    "--bg-size",
+    default=list(BG_SHAPES),
+    multiple=True,
+    type=click.Choice([str(s) for s in BG_SHAPES]),
+    show_default=True,
+    help="Width of the backgrounds: 640x480, 1920x1080 or 3840x2160",
+)
+@click.option(
+    "-mo",
+    "--max-overlap",
+    default=[0.1, 0.3, 0.5],
+    multiple=True,
+    show_default=True,
+    help="Maximum overlap between pills",
+)
+@click.option(
+    "-p",
+    "--pill-size",
+    default=[64, 224],
+    multiple=True,
+    show_default=True,
+    help="Long side of the pills resized by resize_and_transform_pill",
+)
+@click.option(
+    "-r",
+    "--repeats",
+    default=5,
+    show_default=True,
+    help="Number of timings of each case",
+)
+@click.option(
+    "-o",
+    "--output",
+    default=Path("benchmark_results.json"),
+    type=click.Path(path_type=Path),
+    show_default=True,
+    help="Path to the JSON file to save the results to",
+)
+@click.option(
+    "-b",
+    "--baseline",
+    default=None,
+    type=click.Path(exists=True, path_type=Path),
+    help="Path to the JSON results of a baseline run to compare against",
+)
+@click.option(
+    "-t",
+    "--tolerance",
+    default=0.2,
+    show_default=True,
+    help="Relative slowdown over the baseline reported as a regression",
+)
+def main(
+    n_pills: List[int],
+    bg_size: List[str],
+    max_overlap: List[float],
+    pill_size: List[int],
+    repeats: int,
+    output: Path,
+    baseline: Optional[Path],
+    tolerance: float,
+) -> None:
+    """Time the functions on the composition hot path, with synthetic in-memory sprites
+    and backgrounds, and compare the timings to those of a baseline run. Exits with
+    status 1 if any case regressed."""
+    results = run_benchmarks(
+        list(n_pills),
+        [int(s) for s in bg_size],
+        list(max_overlap),
+        list(pill_size),
+        repeats,
+    )
+
+    with output.open("w") as f:
+        json.dump(
+            {
+                "meta": {
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "opencv": cv2.__version__,
+                    "machine": platform.machine(),
+                    "processor": platform.processor(),
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"\nResults are saved to {output}")
+
+    if baseline is not None:
+        with baseline.open() as f:
+            baseline_results = json.load(f)["results"]
+        regressions = compare_results(results, baseline_results, tolerance)
+        if regressions:
+            print(f"{len(regressions)} cases regressed by more than {tolerance:.0%}.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import numpy as np
+
+
+def get_nbytes(value: Any) -> int:
+    """Get the memory size of a numpy array, or of a tuple or list of numpy arrays."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(v) for v in value)
+
+    return 0
+
+
+class LRUCache:
+    """Least-recently-used cache of numpy arrays, bounded by their total memory size.
+
+    Once the arrays held by the cache exceed `max_bytes`, the least recently used
+    entries are evicted until the cache fits in its budget again. An entry larger than
+    the whole budget is not cached at all.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes: "OrderedDict[Hashable, int]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        """Get an entry and mark it as the most recently used one."""
+        if key not in self._entries:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Add an entry, evicting the least recently used entries if needed."""
+        nbytes = get_nbytes(value)
+        if key in self._entries:
+            self.nbytes -= self._sizes.pop(key)
+            del self._entries[key]
+        if nbytes > self.max_bytes:
+            return
+
+        while self._entries and self.nbytes + nbytes > self.max_bytes:
+            evicted, _ = self._entries.popitem(last=False)
+            self.nbytes -= self._sizes.pop(evicted)
+            self.evictions += 1
+
+        self._entries[key] = value
+        self._sizes[key] = nbytes
+        self.nbytes += nbytes
@@ -1,16 +1,30 @@
-import random
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
 
 import numpy as np
 
-from countpillar.io_utils import get_img_and_mask
-from countpillar.object_overlay import add_pill_on_bg, verify_overlap
-from countpillar.transform import resize_and_transform_pill
+from countpillar.io_utils import get_img_and_mask, mask_bbox
+from countpillar.object_overlay import (
+    OccupancyGrid,
+    OverlapTracker,
+    add_pill_on_bg,
+    get_mask_dtype,
+    get_pill_roi,
+)
+from countpillar.random_utils import get_rng
+from countpillar.telemetry import add_counts, time_stage
+from countpillar.transform import (
+    PILL_LONGEST_MAX,
+    PILL_LONGEST_MIN,
+    resize_and_transform_pill,
+)
+from countpillar.variant_bank import VariantBank
 
 
 def is_object_mask_within_image(
-    image: np.ndarray, mask: np.ndarray, position: Tuple[int, int]
+    image: np.ndarray,
+    mask: np.ndarray,
+    position: Tuple[int, int],
 ) -> bool:
     """
     Verifies whether an object along with its mask can fit inside a rectangular image.
@@ -24,8 +38,7 @@ def is_object_mask_within_image(
         bool: True if the object along with its mask can fit inside the image, False otherwise.
     """
     # Get the minimum and maximum x and y coordinates of the mask
-    y_min, y_max = np.min(np.where(mask > 0)[0]), np.max(np.where(mask > 0)[0])
-    x_min, x_max = np.min(np.where(mask > 0)[1]), np.max(np.where(mask > 0)[1])
+    x_min, y_min, x_max, y_max = mask_bbox(mask)
     obj_width, obj_height = x_max - x_min, y_max - y_min
 
     # Determine the dimensions of the mask and the rectangular image
@@ -43,26 +56,307 @@ def is_object_mask_within_image(
         return False
 
 
-def random_partition(number: int, num_parts: int) -> List[int]:
+def random_partition(
+    number: int, num_parts: int, rng: Optional[np.random.Generator] = None
+) -> List[int]:
     """Generates a list of random integers that add up to a specified number.
 
     Args:
         number (int): The number to be divided into multiple parts.
         num_parts (int): The number of parts to divide the number into.
+        rng (np.random.Generator, optional): The random generator to draw from.
 
     Returns:
         A list of num_parts random integers that add up to number.
     """
 
+    rng = get_rng(rng)
     parts: List[int] = [0] * num_parts
     for i in range(num_parts - 1):
-        parts[i] = random.randint(0, number)
+        parts[i] = int(rng.integers(0, number + 1))
         number -= parts[i]
     parts[num_parts - 1] = number
 
     return parts
 
 
+def load_pill(
+    pill_mask_paths: List[Tuple[Path, Path]],
+    idx: int,
+    sprite_cache: Optional[Sequence[Tuple[np.ndarray, np.ndarray]]] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Load a pill image and mask, from the sprite cache if one is provided.
+
+    Args:
+        pill_mask_paths: List of tuples of pill image and mask paths.
+        idx: The index of the pill in `pill_mask_paths`.
+        sprite_cache: Pre-decoded sprites in the same order as `pill_mask_paths`, e.g.
+            a SpriteCache.
+
+    Returns:
+        The pill image and mask.
+    """
+    if sprite_cache is not None:
+        return sprite_cache[idx]
+
+    return get_img_and_mask(pill_mask_paths[idx])
+
+
+def get_pill_footprint(pill_img: np.ndarray, **kwargs) -> Tuple[int, int]:
+    """Get the expected size of a pill once resized by resize_and_transform_pill.
+
+    Args:
+        pill_img: The pill image.
+        **kwargs: Keyword arguments for resize_and_transform_pill.
+
+    Returns:
+        The expected height and width of the resized pill.
+    """
+    long_side = (
+        kwargs.get("longest_min", PILL_LONGEST_MIN)
+        + kwargs.get("longest_max", PILL_LONGEST_MAX)
+    ) // 2
+    scale = long_side / max(pill_img.shape[:2])
+
+    return int(pill_img.shape[0] * scale), int(pill_img.shape[1] * scale)
+
+
+def transform_pill(
+    pill_img: np.ndarray,
+    mask: np.ndarray,
+    sprite_key: Hashable,
+    variant_bank: Optional[VariantBank] = None,
+    rng: Optional[np.random.Generator] = None,
+    **kwargs,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Resize and transform a pill, or draw a pre-transformed variant of it.
+
+    Args:
+        pill_img: The pill image.
+        mask: The pill mask.
+        sprite_key: The key identifying the pill sprite in the variant bank.
+        variant_bank: The bank of pre-transformed variants, if any.
+        rng: The random generator to draw from.
+        **kwargs: Keyword arguments for resize_and_transform_pill.
+
+    Returns:
+        The transformed pill image and mask.
+    """
+    if variant_bank is not None:
+        return variant_bank.get(sprite_key, pill_img, mask, rng=rng, **kwargs)
+
+    return resize_and_transform_pill(pill_img, mask, rng=rng, **kwargs)
+
+
+def get_centered_position(
+    center: Tuple[int, int],
+    pill_shape: Tuple[int, ...],
+    bg_shape: Tuple[int, ...],
+    allow_pill_on_border: bool = True,
+) -> Tuple[int, int]:
+    """Get the position of the top left corner of a pill centered on a point.
+
+    Args:
+        center: The (x, y) coordinates of the center of the pill.
+        pill_shape: The shape of the pill image.
+        bg_shape: The shape of the background image.
+        allow_pill_on_border: If False, the pill is shifted inside the background
+            image, off its edges, if it fits.
+
+    Returns:
+        The (x, y) position of the top left corner of the pill.
+    """
+    h_pill, w_pill = pill_shape[:2]
+    x, y = center[0] - w_pill // 2, center[1] - h_pill // 2
+    if not allow_pill_on_border:
+        # Keep a pixel of margin on every side, as `is_object_mask_within_image`
+        # rejects a pill touching the edges of the background image
+        x = min(max(x, 1), max(bg_shape[1] - w_pill - 1, 1))
+        y = min(max(y, 1), max(bg_shape[0] - h_pill - 1, 1))
+
+    return x, y
+
+
+def place_pill(
+    bg_img: np.ndarray,
+    comp_mask: np.ndarray,
+    pill_img_t: np.ndarray,
+    mask_t: np.ndarray,
+    position: Tuple[int, int],
+    idx: int,
+    overlap_tracker: OverlapTracker,
+    allow_pill_on_border: bool = True,
+    counters: Optional[Dict[str, int]] = None,
+    timings: Optional[Dict[str, float]] = None,
+) -> Optional[Tuple[slice, slice]]:
+    """Make one attempt at placing a transformed pill on the composition, in place.
+
+    The pill is composed at the given position and kept only if it does not overlap
+    with the other pills too much. Otherwise, the region of the composition covered by
+    the pill is restored.
+
+    Args:
+        bg_img: The background image with the pills placed so far.
+        comp_mask: The mask of the composition.
+        pill_img_t: The resized and transformed pill image.
+        mask_t: The resized and transformed pill mask.
+        position: The (x, y) position of the top left corner of the pill.
+        idx: The index of the pill in the composition mask.
+        overlap_tracker: The visible areas of the pills placed so far.
+        allow_pill_on_border: whether to allow the pill object to be on the border of
+            the background image.
+        counters: If provided, the rejection counters are incremented in place.
+        timings: If provided, the time spent composing the pill and checking its
+            overlap is added to the `composite` and `overlap_check` stages.
+
+    Returns:
+        The region of the composition covered by the pill if it was placed, else None.
+    """
+    counters = counters if counters is not None else {}
+    x, y = position
+
+    # Check if the pill can fit inside the background image.
+    if not allow_pill_on_border and not is_object_mask_within_image(
+        bg_img, mask_t, (x, y)
+    ):
+        counters["border_rejected"] = counters.get("border_rejected", 0) + 1
+        return None
+
+    # Reject the pill if it lies entirely outside of the background image, e.g. when
+    # its position was clipped to the right or bottom edge.
+    roi = get_pill_roi(bg_img.shape, mask_t.shape, x, y)
+    if roi is None:
+        counters["border_rejected"] = counters.get("border_rejected", 0) + 1
+        return None
+
+    with time_stage(timings, "composite"):
+        # Save the region of the composition covered by the pill, so that a rejected
+        # placement can be rolled back without copying the full frame.
+        bg_roi = roi[0]
+        bg_img_prev = bg_img[bg_roi].copy()
+        comp_mask_prev = comp_mask[bg_roi].copy()
+
+        # Add the pill to the background image.
+        _, _, added_mask, pill_added = add_pill_on_bg(
+            bg_img, comp_mask, pill_img_t, mask_t, x, y, idx
+        )
+
+    # Verify that the pill does not overlap with other pills too much.
+    with time_stage(timings, "overlap_check"):
+        accepted = pill_added and overlap_tracker.add(comp_mask_prev, added_mask)
+    if accepted:
+        return bg_roi
+
+    with time_stage(timings, "composite"):
+        bg_img[bg_roi], comp_mask[bg_roi] = bg_img_prev, comp_mask_prev
+
+    # A pill none of whose pixels is within the frame is out of frame as well
+    rejection = "overlap_rejected" if pill_added else "border_rejected"
+    counters[rejection] = counters.get(rejection, 0) + 1
+
+    return None
+
+
+def attempt_pill(
+    bg_img: np.ndarray,
+    comp_mask: np.ndarray,
+    pill_img: np.ndarray,
+    mask: np.ndarray,
+    sprite_key: Hashable,
+    idx: int,
+    overlap_tracker: OverlapTracker,
+    occupancy_grid: Optional[OccupancyGrid] = None,
+    placement: str = "gaussian",
+    max_occupancy: Optional[float] = None,
+    allow_pill_on_border: bool = True,
+    variant_bank: Optional[VariantBank] = None,
+    counters: Optional[Dict[str, int]] = None,
+    timings: Optional[Dict[str, float]] = None,
+    rng: Optional[np.random.Generator] = None,
+    **kwargs,
+) -> Optional[Tuple[slice, slice]]:
+    """Make one attempt at placing a pill on the composition, in place: draw a position,
+    pre-screen it, transform the pill and place it.
+
+    Args:
+        bg_img: The background image with the pills placed so far.
+        comp_mask: The mask of the composition.
+        pill_img: The pill image, before resizing and transformation.
+        mask: The pill mask, before resizing and transformation.
+        sprite_key: The key of the pill in the variant bank.
+        idx: The index of the pill in the composition mask.
+        overlap_tracker: The visible areas of the pills placed so far.
+        occupancy_grid: The occupancy grid of the composition, required by the
+            pre-screen and by the `free` placement.
+        placement: How the position is drawn, `gaussian` or `free`.
+        max_occupancy: The occupancy above which positions are pre-screened, which
+            may reject positions the overlap check would accept.
+        allow_pill_on_border: whether to allow the pill object to be on the border of
+            the background image.
+        variant_bank: If provided, the bank of pre-transformed variants of the pills.
+        counters: If provided, the placement counters are incremented in place.
+        timings: If provided, the time spent in each stage is added to it.
+        rng: The random generator to draw from.
+        **kwargs: Keyword arguments for resize_and_transform_pill.
+
+    Returns:
+        The region of the composition covered by the pill if it was placed, else None.
+    """
+    counters = counters if counters is not None else {}
+    counters["attempts"] = counters.get("attempts", 0) + 1
+    rng = get_rng(rng)
+    h_bg, w_bg = bg_img.shape[:2]
+
+    # Expected footprint of the pill, used by the occupancy pre-screen
+    h_pill, w_pill = get_pill_footprint(pill_img, **kwargs)
+
+    # Randomly sample a position for the pill.
+    if placement == "free" and occupancy_grid is not None:
+        center = occupancy_grid.sample_free(rng)
+        x, y = center[0] - w_pill // 2, center[1] - h_pill // 2
+    else:
+        # The position is sampled from a normal distribution with mean at the center of the background image
+        # and standard deviation of a quarter of the background image's width and height.
+        x, y = rng.normal(
+            loc=(w_bg / 2, h_bg / 2), scale=(w_bg / 4, h_bg / 4), size=(2,)
+        )
+        x, y = np.clip(x, 0, w_bg), np.clip(y, 0, h_bg)
+
+    # Reject the position early if its surroundings are already crowded.
+    if (
+        max_occupancy is not None
+        and occupancy_grid is not None
+        and occupancy_grid.occupancy(int(x), int(y), h_pill, w_pill) > max_occupancy
+    ):
+        counters["prescreen_rejected"] = counters.get("prescreen_rejected", 0) + 1
+        return None
+
+    # Resize and transform the pill image and mask.
+    with time_stage(timings, "transform"):
+        pill_img_t, mask_t = transform_pill(
+            pill_img, mask, sprite_key, variant_bank, rng, **kwargs
+        )
+
+    # Center the transformed pill on the position drawn from the free space
+    if placement == "free" and occupancy_grid is not None:
+        x, y = get_centered_position(
+            center, mask_t.shape, (h_bg, w_bg), allow_pill_on_border
+        )
+
+    return place_pill(
+        bg_img,
+        comp_mask,
+        pill_img_t,
+        mask_t,
+        (int(x), int(y)),
+        idx,
+        overlap_tracker,
+        allow_pill_on_border,
+        counters,
+        timings,
+    )
+
+
 def create_pill_comp(
     bg_img: np.ndarray,
     pill_mask_paths: List[Tuple[Path, Path]],
@@ -72,6 +366,16 @@ def create_pill_comp(
     max_overlap: float = 0.2,
     max_attempts: int = 10,
     allow_pill_on_border: bool = True,
+    sprite_cache: Optional[Sequence[Tuple[np.ndarray, np.ndarray]]] = None,
+    sprite_labels: Optional[Sequence[int]] = None,
+    variant_bank: Optional[VariantBank] = None,
+    max_occupancy: Optional[float] = None,
+    placement: str = "gaussian",
+    target_count: bool = False,
+    pills_per_type: Optional[Sequence[int]] = None,
+    stats: Optional[Dict[str, int]] = None,
+    timings: Optional[Dict[str, float]] = None,
+    rng: Optional[np.random.Generator] = None,
     **kwargs,
 ) -> Tuple[np.ndarray, np.ndarray, List[int], List[int]]:
     """Create a composition of pills on a background image.
@@ -86,72 +390,166 @@ def create_pill_comp(
         max_attempts: The maximum number of attempts to compose a pill.
         allow_pill_on_border: whether to allow the pill object to be on the border of
             the background image.
+        sprite_cache: Pre-decoded (image, mask) sprites in the same order as
+            `pill_mask_paths`, e.g. a SpriteCache. If provided, the pills are read from
+            the cache instead of being decoded from `pill_mask_paths`, which may then
+            be empty.
+        sprite_labels: The class id of each pill, in the order of `pill_mask_paths`,
+            e.g. as returned by `get_sprite_labels`. If not provided, every pill is of
+            class 0.
+        variant_bank: If provided, the pills are drawn from pre-transformed variants
+            kept in this bank instead of being transformed on every attempt.
+        max_occupancy: If provided, a coarse occupancy grid of the composition is
+            maintained, and candidate positions whose expected footprint is already
+            covered by other pills by more than this fraction are rejected before the
+            pill is transformed and composed. The pre-screen is a lossy filter, not a
+            conservative bound derived from `max_overlap`: the occupancy of the cells
+            around a footprint is not the overlap of the pill, so it also rejects
+            positions the overlap check would accept, which changes the compositions
+            and may cut them short. Off by default.
+        placement: How the candidate positions of the pills are drawn. With
+            `gaussian`, the top left corner of a pill is drawn from a normal
+            distribution centered on the background image. With `free`, the center of
+            a pill is drawn from the space not yet covered by other pills, which a
+            coarse occupancy grid of the composition keeps track of.
+        target_count: If False, the composition of a type of pill stops as soon as a
+            pill could not be placed in `max_attempts` attempts. If True, the pills
+            share a budget of `max_attempts` attempts per requested pill instead, so
+            that a pill which is hard to place does not cut the composition short.
+        pills_per_type: The number of pills of each pill type to compose, e.g. as
+            planned by a `CoverageScheduler`. The planned types are distinct pills, as
+            long as there are enough of them, and share a budget of attempts as in
+            the `target_count` mode, so that the composition reaches its plan whenever
+            the pills fit. If not provided, the number of pills is drawn uniformly
+            between `min_pills` and `max_pills` and randomly split between
+            `n_pill_types` pill types.
+        stats: If provided, the placement counters `requested`, `attempts`,
+            `accepted`, `prescreen_rejected`, `border_rejected`, `overlap_rejected` and
+            `early_terminated` are added to this dictionary. `early_terminated` is 1
+            if fewer pills than requested were placed, i.e. a pill could not be
+            placed in its attempts, however many pill types were cut short, so that
+            it adds up to a number of images.
+        timings: If provided, the wall time spent loading, transforming, composing
+            and checking the overlap of the pills is added to the `sprite_load`,
+            `transform`, `composite` and `overlap_check` stages of this dictionary.
+        rng: The random generator to draw every random choice of the composition
+            from. Passing a generator seeded per sample makes the sample reproducible.
         **kwargs: Keyword arguments for resize_and_transform_pill.
 
     Returns:
         bg_img: The background image with pills.
         composition_mask: The mask of the composition.
         pill_areas: List of areas of the pills.
-        pill_labels: List of labels of the pills.
+        pill_labels: List of labels of the pills, i.e. their class ids plus one.
     """
 
+    rng = get_rng(rng)
+    planned = pills_per_type is not None
+
+    # Randomly sample the number of pills to compose and the number of pills per type,
+    # unless they are planned by the caller.
+    if pills_per_type is None:
+        num_pills = int(rng.integers(min_pills, max_pills + 1))
+        pills_per_type = random_partition(num_pills, n_pill_types, rng)
+    else:
+        num_pills = int(sum(pills_per_type))
+
     bg_img = bg_img.copy()
     h_bg, w_bg = bg_img.shape[0], bg_img.shape[1]
-    comp_mask = np.zeros((h_bg, w_bg), dtype=np.uint8)
+    comp_mask = np.zeros((h_bg, w_bg), dtype=get_mask_dtype(max(max_pills, num_pills)))
 
-    pill_areas: List[int] = []
+    overlap_tracker = OverlapTracker(max_overlap)
+    occupancy_grid = (
+        OccupancyGrid(comp_mask.shape)
+        if max_occupancy is not None or placement == "free"
+        else None
+    )
     pill_labels: List[int] = []
 
-    # Randomly sample the number of pills to compose.
-    num_pills = np.random.randint(min_pills, max_pills + 1)
+    counters: Dict[str, int] = dict.fromkeys(
+        (
+            "requested",
+            "attempts",
+            "accepted",
+            "prescreen_rejected",
+            "border_rejected",
+            "overlap_rejected",
+            "early_terminated",
+        ),
+        0,
+    )
 
-    # Randomly sample the number of pills per type.
-    pills_per_type = random_partition(num_pills, n_pill_types)
+    counters["requested"] = num_pills
 
-    count: int = 1
-    pill_added: bool = False
-    for n_pills in pills_per_type:
-        # Randomly sample a pill image and mask.
-        idx = np.random.randint(len(pill_mask_paths))
-        pill_img, mask = get_img_and_mask(pill_mask_paths[idx])
+    # Attempts left to place all the pills in the target-count mode
+    budget: Optional[int] = (
+        max_attempts * num_pills if target_count or planned else None
+    )
 
-        for _ in range(1, n_pills + 1):
-            success: bool = False
-            for _ in range(max_attempts):
-                # Randomly sample a position for the pill.
-                # The position is sampled from a normal distribution with mean at the center of the background image
-                # and standard deviation of a quarter of the background image's width and height.
-                x, y = np.random.normal(
-                    loc=(w_bg / 2, h_bg / 2), scale=(w_bg / 4, h_bg / 4), size=(2,)
-                )
-                x, y = np.clip(x, 0, w_bg), np.clip(y, 0, h_bg)
+    # Draw distinct pills for the planned pill types
+    n_sprites = len(sprite_cache) if sprite_cache is not None else len(pill_mask_paths)
+    planned_idxs = (
+        rng.choice(
+            n_sprites, len(pills_per_type), replace=len(pills_per_type) > n_sprites
+        )
+        if planned
+        else None
+    )
 
-                # Resize and transform the pill image and mask.
-                pill_img_t, mask_t = resize_and_transform_pill(pill_img, mask, **kwargs)
+    count: int = 1
+    for type_idx, n_pills in enumerate(pills_per_type):
+        if budget is not None and budget <= 0:
+            break
 
-                # Check if the pill can fit inside the background image.
-                if not allow_pill_on_border and not is_object_mask_within_image(
-                    bg_img, mask_t, (x, y)
-                ):
-                    continue
+        # Randomly sample a pill image and mask.
+        idx = (
+            int(planned_idxs[type_idx])
+            if planned_idxs is not None
+            else int(rng.integers(n_sprites))
+        )
+        with time_stage(timings, "sprite_load"):
+            pill_img, mask = load_pill(pill_mask_paths, idx, sprite_cache)
 
-                # Add the pill to the background image.
-                bg_img_prev, comp_mask_prev = bg_img.copy(), comp_mask.copy()
-                bg_img, comp_mask, added_mask, pill_added = add_pill_on_bg(
-                    bg_img, comp_mask, pill_img_t, mask_t, int(x), int(y), count
+        for _ in range(1, n_pills + 1):
+            bg_roi: Optional[Tuple[slice, slice]] = None
+            for _ in range(max_attempts if budget is None else budget):
+                if budget is not None:
+                    budget -= 1
+                bg_roi = attempt_pill(
+                    bg_img,
+                    comp_mask,
+                    pill_img,
+                    mask,
+                    idx,
+                    count,
+                    overlap_tracker,
+                    occupancy_grid,
+                    placement,
+                    max_occupancy,
+                    allow_pill_on_border,
+                    variant_bank,
+                    counters,
+                    timings,
+                    rng,
+                    **kwargs,
                 )
-
-                # Verify that the pill does not overlap with other pills too much.
-                if pill_added and verify_overlap(comp_mask, pill_areas, max_overlap):
-                    pill_areas.append(np.count_nonzero(added_mask))
-                    pill_labels.append(1)
-                    success = True
-                    count += 1
+                if bg_roi is not None:
                     break
-                else:
-                    bg_img, comp_mask = bg_img_prev.copy(), comp_mask_prev.copy()
 
-            if not success:
+            if bg_roi is None:
                 break
 
-    return bg_img, comp_mask, pill_labels, pill_areas
+            pill_labels.append(
+                1 if sprite_labels is None else int(sprite_labels[idx]) + 1
+            )
+            if occupancy_grid is not None:
+                occupancy_grid.update(comp_mask, bg_roi)
+            counters["accepted"] += 1
+            count += 1
+
+    # A pill type cut short, or a budget spent before its first attempt, leaves
+    # pills unplaced in either mode
+    counters["early_terminated"] = int(counters["accepted"] < num_pills)
+    add_counts(stats, counters)
+
+    return bg_img, comp_mask, pill_labels, overlap_tracker.pill_areas
@@ -0,0 +1,123 @@
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+EMBEDDING_SUFFIX = ".npy"
+
+
+def get_embedding_key(image: np.ndarray, checkpoint: str) -> str:
+    """Get the key of the SAM embedding of an image: a hash of its pixels and shape,
+    and of the SAM checkpoint which computes the embedding.
+
+    Args:
+        image: The image.
+        checkpoint: The size of the SAM model, one of `SAM_CHECKPOINTS`.
+
+    Returns:
+        The hexadecimal key.
+    """
+    image = np.ascontiguousarray(image)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{checkpoint}:{image.shape}:{image.dtype}:".encode())
+    digest.update(image.data)
+
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """On-disk cache of SAM image embeddings, bounded by their total file size.
+
+    Every embedding is saved as a `.npy` file named after its key, as returned by
+    `get_embedding_key`, and is loaded memory-mapped. Since the key only depends on
+    the image and the SAM checkpoint, a rerun over the same images with other
+    prompts, GrabCut or post-processing parameters only runs the mask decoder.
+
+    The modification time of a file records when its embedding was last used. Once
+    the files exceed `max_bytes`, the least recently used embeddings are evicted until
+    the cache fits in its budget again. An embedding larger than the whole budget is
+    not cached at all.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 4 * 2**30) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+        # Sizes of the cached files, from the least to the most recently used
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        stats = [
+            (p.stem, p.stat()) for p in self.cache_dir.glob(f"*{EMBEDDING_SUFFIX}")
+        ]
+        for key, stat in sorted(stats, key=lambda item: item[1].st_mtime):
+            self._sizes[key] = stat.st_size
+        self.nbytes: int = sum(self._sizes.values())
+        self._evict()
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._sizes
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}{EMBEDDING_SUFFIX}"
+
+    def _forget(self, key: str) -> None:
+        self.nbytes -= self._sizes.pop(key, 0)
+
+    def _evict(self) -> None:
+        while self._sizes and self.nbytes > self.max_bytes:
+            key = next(iter(self._sizes))
+            self._forget(key)
+            self._path(key).unlink(missing_ok=True)
+            self.evictions += 1
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Get an embedding as a read-only memory-mapped array, and mark it as the most
+        recently used one. Return None if it is not cached."""
+        if key not in self._sizes:
+            self.misses += 1
+            return None
+
+        path = self._path(key)
+        try:
+            embedding = np.load(path, mmap_mode="r")
+            os.utime(path)
+        except (OSError, ValueError):
+            # The file was removed or cut short by another process
+            self._forget(key)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._sizes.move_to_end(key)
+        return embedding
+
+    def put(self, key: str, embedding: np.ndarray) -> None:
+        """Save an embedding, evicting the least recently used embeddings if needed."""
+        self._forget(key)
+        if embedding.nbytes > self.max_bytes:
+            return
+
+        # Write the embedding under a temporary name first, so that a crash never
+        # leaves a partially written embedding under its key
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.ascontiguousarray(embedding))
+            os.replace(tmp_path, self._path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self._sizes[key] = self._path(key).stat().st_size
+        self.nbytes += self._sizes[key]
+        self._evict()
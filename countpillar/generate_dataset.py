@@ -1,51 +1,522 @@
+import hashlib
+import math
 import os
-import random
+import time
+import uuid
+from collections import OrderedDict
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, Union
 
 import click
-import cv2
 import numpy as np
-from joblib import Parallel, delayed
-from tqdm import trange
+from joblib import Parallel, delayed, effective_n_jobs
+from tqdm import tqdm
 
 from countpillar.composition import create_pill_comp
 from countpillar.io_utils import (
+    ATLAS_DIR,
+    BackgroundCache,
     create_yolo_annotations,
     load_bg_image,
     load_pill_mask_paths,
 )
+from countpillar.label_index import (
+    LABEL_ATTRIBUTES,
+    METADATA_FILE,
+    get_sprite_labels,
+    load_label_index,
+)
+from countpillar.manifest import (
+    compact_completed,
+    diff_params,
+    load_completed,
+    load_manifest,
+    parse_indices,
+    record_completed,
+    write_manifest,
+)
 from countpillar.object_overlay import generate_random_bg
+from countpillar.output_writers import (
+    SHARDS_DIR,
+    AsyncWriter,
+    FileWriter,
+    TarShardWriter,
+    remove_partial_outputs,
+)
+from countpillar.random_utils import get_sample_rng
+from countpillar.scheduler import SCHEDULES, CoverageScheduler
+from countpillar.sprite_cache import SpriteCache, load_sprite_cache, open_sprite_cache
+from countpillar.telemetry import (
+    STAGES,
+    TELEMETRY_JSON,
+    sum_counts,
+    time_stage,
+    write_telemetry,
+)
+from countpillar.transform import PILL_LONGEST_MAX, PILL_LONGEST_MIN
+from countpillar.variant_bank import VariantBank
 
+CLASSES_FILE = "classes.txt"
 
-def generate_samples(
-    bg_img: Optional[np.ndarray],
-    bg_img_path: Optional[Path],
-    bg_img_paths: List[Path],
-    output_folder: Path,
-    min_bg_dim: int,
-    max_bg_dim: int,
-    idx,
-    **kwargs,
+
+def plan_chunks(
+    sample_indices: List[int],
+    output_format: str,
+    shard_size: int,
+    chunk_size: Optional[int],
+    num_cpu: int,
+) -> List[Tuple[List[int], Optional[int]]]:
+    """Split the indices of the samples to generate into the tasks of the workers.
+
+    Args:
+        sample_indices: The sorted indices of the samples to generate.
+        output_format: The output format, `files` or `tar`.
+        shard_size: The number of samples per tar shard.
+        chunk_size: The number of samples per task, chosen automatically if None.
+        num_cpu: The number of workers.
+
+    Returns:
+        The indices of each task along with the number of the tar shard it writes,
+        or None if the output format is `files`.
+    """
+    # Every shard is written by a single worker, in one task
+    if output_format == "tar":
+        shards: Dict[int, List[int]] = {}
+        for idx in sample_indices:
+            shards.setdefault(idx // shard_size, []).append(idx)
+        return [(shard, shard_id) for shard_id, shard in sorted(shards.items())]
+
+    n_samples = len(sample_indices)
+    chunk_size = chunk_size or max(1, min(256, math.ceil(n_samples / (4 * num_cpu))))
+    return [
+        (sample_indices[start : start + chunk_size], None)
+        for start in range(0, n_samples, chunk_size)
+    ]
+
+
+def make_job_config(
+    pill_mask_paths: List[Tuple[Path, Path]],
+    seed: int,
+    bg_img_path: Optional[Path] = None,
+    min_bg_dim: int = 1080,
+    max_bg_dim: int = 1920,
+    bg_cache_memory: int = 256,
+    preload_bg: bool = False,
+    n_variants: int = 0,
+    variant_memory: int = 512,
+    schedule: str = "random",
+    n_count_bins: int = 10,
+    **comp_kwargs,
+) -> Dict[str, Any]:
+    """Build the configuration of a generation job, which is sent to every worker.
+
+    Args:
+        pill_mask_paths: The paths to the pill images and masks.
+        seed: The seed of the dataset.
+        bg_img_path: The background image or directory of backgrounds, or None for
+            random color backgrounds.
+        min_bg_dim: The minimum dimension of the backgrounds.
+        max_bg_dim: The maximum dimension of the backgrounds.
+        bg_cache_memory: The memory budget of the background cache of each worker, in
+            MB.
+        preload_bg: Whether to load the whole background directory upfront.
+        n_variants: The number of pre-transformed variants per pill, 0 to disable.
+        variant_memory: The memory budget of the variant bank, in MB.
+        schedule: How the number of pills and the pill types of the samples are
+            chosen, one of `SCHEDULES`. With `random`, they are drawn by
+            `create_pill_comp`. With `stratified`, they are planned by a
+            `CoverageScheduler` to cover every pill count bin and number of pill types
+            evenly.
+        n_count_bins: The number of pill count bins of the `stratified` schedule.
+        comp_kwargs: The other keyword arguments of `create_pill_comp`.
+
+    Returns:
+        The job configuration.
+    """
+    return {
+        "job_id": uuid.uuid4().hex,
+        "seed": seed,
+        "bg_img_path": Path(bg_img_path) if bg_img_path is not None else None,
+        "min_bg_dim": min_bg_dim,
+        "max_bg_dim": max_bg_dim,
+        "bg_cache_memory": bg_cache_memory,
+        "preload_bg": preload_bg,
+        "n_variants": n_variants,
+        "variant_memory": variant_memory,
+        "schedule": schedule,
+        "n_count_bins": n_count_bins,
+        "comp_kwargs": {"pill_mask_paths": pill_mask_paths, **comp_kwargs},
+    }
+
+
+def get_job_params(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Get the parameters of a generation job which determine its samples and how they
+    are saved, to be recorded in its manifest.
+
+    Args:
+        config: The job configuration, as built by `main` from `make_job_config`.
+
+    Returns:
+        The JSON-serializable parameters of the job.
+    """
+    comp_kwargs = dict(config["comp_kwargs"])
+    pill_names = [img_path.name for img_path, _ in comp_kwargs.pop("pill_mask_paths")]
+    sprite_cache: Optional[SpriteCache] = comp_kwargs.pop("sprite_cache", None)
+    comp_kwargs.pop("sprite_labels", None)
+    bg_img_path: Optional[Path] = config["bg_img_path"]
+
+    return {
+        "seed": config["seed"],
+        "pills": hashlib.sha1("\n".join(pill_names).encode()).hexdigest(),
+        "cropped_pills": sprite_cache is not None and sprite_cache.cropped,
+        "bg_img_path": str(bg_img_path) if bg_img_path is not None else None,
+        "min_bg_dim": config["min_bg_dim"],
+        "max_bg_dim": config["max_bg_dim"],
+        "n_variants": config["n_variants"],
+        "schedule": config["schedule"],
+        "n_count_bins": config["n_count_bins"],
+        "label_attribute": config["label_attribute"],
+        "output_format": config["output_format"],
+        "shard_size": config["shard_size"],
+        "image_format": config["image_format"],
+        "quality": config["quality"],
+        **comp_kwargs,
+    }
+
+
+def prepare_output(output_path: Path, params: Dict[str, Any], resume: bool) -> Set[int]:
+    """Prepare the output folder of a generation job.
+
+    A new job records its parameters in a manifest. A resumed job checks that its
+    parameters match the manifest of the interrupted job, and removes whatever the
+    interrupted job left of the samples it did not complete.
+
+    Args:
+        output_path: The output folder of the job.
+        params: The parameters of the job, as returned by `get_job_params`.
+        resume: Whether to resume the job recorded in the output folder, if any.
+
+    Returns:
+        The indices of the samples which are already completed.
+    """
+    output_path.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(output_path) if resume else None
+    if manifest is None:
+        write_manifest(output_path, params)
+        return set()
+
+    mismatched = diff_params(params, manifest)
+    if mismatched:
+        raise click.UsageError(
+            f"Cannot resume the job in {output_path}, as its parameters differ: "
+            + ", ".join(mismatched)
+        )
+
+    completed = load_completed(output_path)
+    compact_completed(output_path, completed)
+    n_removed = remove_partial_outputs(output_path, completed)
+    print(
+        f"Resuming the job in {output_path}: {len(completed)} images are completed, "
+        f"{n_removed} partial files were removed."
+    )
+    return completed
+
+
+def get_missing_indices(
+    sample_indices: List[int], completed: Set[int], shard_size: Optional[int] = None
+) -> List[int]:
+    """Get the indices of the samples to generate which are not completed yet.
+
+    Args:
+        sample_indices: The sorted indices of the samples of the job.
+        completed: The indices of the completed samples.
+        shard_size: The number of samples per tar shard, if the output format is `tar`.
+            Tar shards are written as a whole, so all the samples of a shard are
+            generated again if any of them is missing.
+
+    Returns:
+        The sorted indices of the samples to generate.
+    """
+    if shard_size is None:
+        return [i for i in sample_indices if i not in completed]
+
+    missing_shards = {i // shard_size for i in sample_indices if i not in completed}
+    return [i for i in sample_indices if i // shard_size in missing_shards]
+
+
+class ProgressParallel(Parallel):
+    """joblib Parallel which advances a progress bar as the tasks complete, showing
+    the throughput of the job in its postfix."""
+
+    def __init__(self, pbar: tqdm, n_images: int, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.pbar = pbar
+        self.n_images = n_images
+        self.start_time = time.perf_counter()
+
+    def print_progress(self) -> None:
+        n_completed = self.n_completed_tasks
+        if self.pbar.total:
+            # The chunks all have the same size but the last one
+            n_done = min(n_completed * self.n_images / self.pbar.total, self.n_images)
+            elapsed = max(time.perf_counter() - self.start_time, 1e-9)
+            self.pbar.set_postfix(images_per_s=f"{n_done / elapsed:.1f}", refresh=False)
+        self.pbar.update(n_completed - self.pbar.n)
+
+
+def report_job(
+    chunk_reports: List[Dict[str, Any]],
+    elapsed: float,
+    telemetry_folder: Optional[Path] = None,
 ) -> None:
-    """Generate and save a single sample along with its annotation."""
+    """Print the throughput and placement counters of a generation job, along with
+    the time spent in each stage if the job is profiled.
+
+    Args:
+        chunk_reports: The reports of the chunks, as returned by `generate_chunk`.
+        elapsed: The wall time of the whole job, in seconds.
+        telemetry_folder: If provided, the folder to write the telemetry of the
+            profiled job to.
+    """
+    # Report the throughput of each worker and of the whole job
+    n_samples = sum(report["n_images"] for report in chunk_reports)
+    workers: Dict[int, List[float]] = {}
+    for report in chunk_reports:
+        worker = workers.setdefault(report["pid"], [0, 0.0])
+        worker[0] += report["n_images"]
+        worker[1] += report["elapsed"]
+    for pid, (n_worker_images, worker_elapsed) in sorted(workers.items()):
+        print(
+            f"Worker {pid}: {n_worker_images:.0f} images in {worker_elapsed:.1f}s "
+            f"({n_worker_images / max(worker_elapsed, 1e-9):.2f} images/s)"
+        )
+    print(
+        f"Generated {n_samples} images in {elapsed:.1f}s "
+        f"({n_samples / max(elapsed, 1e-9):.2f} images/s) with {len(workers)} workers."
+    )
+
+    # Report how much placement work was done and saved
+    total_stats = sum_counts(report["stats"] for report in chunk_reports)
+    print(
+        f"Placed {total_stats.get('accepted', 0)} of "
+        f"{total_stats.get('requested', 0)} requested pills in "
+        f"{total_stats.get('attempts', 0)} attempts "
+        f"({total_stats.get('prescreen_rejected', 0)} pre-screened, "
+        f"{total_stats.get('border_rejected', 0)} on the border or out of frame, "
+        f"{total_stats.get('overlap_rejected', 0)} overlapping), "
+        f"{total_stats.get('early_terminated', 0)} images were terminated early."
+    )
+
+    # Report where the time of the workers went
+    if telemetry_folder is not None:
+        summary = write_telemetry(telemetry_folder, chunk_reports, elapsed)
+        worker_time = max(summary["worker_time"], 1e-9)
+        for stage in STAGES:
+            stage_time = summary["timings"][stage]
+            print(
+                f"{stage:>14}: {stage_time:9.2f}s {100 * stage_time / worker_time:5.1f}%"
+                f" {summary['ms_per_image'][stage]:9.2f} ms/image"
+            )
+        print("Telemetry is saved to: ", telemetry_folder / TELEMETRY_JSON)
+
+
+# Assets of the most recent generation jobs, loaded once per worker process and
+# keyed by job id, so that several jobs, e.g. a training and a validation stream, can
+# run interleaved in a single process
+_WORKER_STATES: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+MAX_WORKER_STATES = 2
+
+
+def init_worker(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Load the assets of a generation job in the current worker process, unless they
+    were already loaded for an earlier chunk of the same job. The states of the
+    least recently used jobs are dropped beyond `MAX_WORKER_STATES`, but stay valid
+    for the callers holding them.
+
+    Args:
+        config: The job configuration, as built by `make_job_config`.
+
+    Returns:
+        The worker state: the background image or background paths, the background
+        cache, the coverage scheduler if any, and the keyword arguments for
+        create_pill_comp.
+    """
+    if config["job_id"] in _WORKER_STATES:
+        _WORKER_STATES.move_to_end(config["job_id"])
+        return _WORKER_STATES[config["job_id"]]
+
+    state: Dict[str, Any] = {
+        "job_id": config["job_id"],
+        "bg_img": None,
+        "bg_img_paths": [],
+        "bg_cache": None,
+        "scheduler": None,
+        "kwargs": dict(config["comp_kwargs"]),
+    }
+
+    # Load and resize the background image, or list the background directory
+    bg_img_path: Optional[Path] = config["bg_img_path"]
+    min_bg_dim, max_bg_dim = config["min_bg_dim"], config["max_bg_dim"]
+    if bg_img_path is not None and bg_img_path.is_file():
+        state["bg_img"] = load_bg_image(bg_img_path, min_bg_dim, max_bg_dim)
+    elif bg_img_path is not None:
+        state["bg_img_paths"] = sorted(bg_img_path.glob("*.jpg"))
+        if config["bg_cache_memory"] > 0:
+            state["bg_cache"] = BackgroundCache(config["bg_cache_memory"] * 2**20)
+            if config["preload_bg"]:
+                state["bg_cache"].preload(state["bg_img_paths"], min_bg_dim, max_bg_dim)
+
+    # Draw the pills from a bank of pre-transformed variants if enabled
+    if config["n_variants"] > 0:
+        state["kwargs"]["variant_bank"] = VariantBank(
+            config["n_variants"], config["variant_memory"] * 2**20, config["seed"]
+        )
+
+    # Plan the pill counts and types of the samples to cover them evenly if enabled
+    if config["schedule"] == "stratified":
+        comp_kwargs = config["comp_kwargs"]
+        state["scheduler"] = CoverageScheduler(
+            config["seed"],
+            comp_kwargs.get("min_pills", 5),
+            comp_kwargs.get("max_pills", 15),
+            comp_kwargs["n_pill_types"],
+            config["n_count_bins"],
+        )
+
+    _WORKER_STATES[config["job_id"]] = state
+    while len(_WORKER_STATES) > MAX_WORKER_STATES:
+        _WORKER_STATES.popitem(last=False)
+    return state
+
+
+def compose_sample(
+    idx: int,
+    config: Dict[str, Any],
+    state: Dict[str, Any],
+    timings: Optional[Dict[str, float]] = None,
+) -> Tuple[np.ndarray, List[List[float]], Dict[str, int]]:
+    """Compose a single sample.
+
+    Args:
+        idx: The index of the sample.
+        config: The job configuration, as built by `make_job_config`.
+        state: The worker state, as returned by `init_worker`.
+        timings: If provided, the wall time spent in each stage of the composition is
+            added to this dictionary.
+
+    Returns:
+        The RGB image of the sample, its YOLO annotations, and the placement counters
+        of the composition.
+    """
+    min_bg_dim, max_bg_dim = config["min_bg_dim"], config["max_bg_dim"]
+
+    # Draw every random choice of the sample from its own stream, so that the sample
+    # only depends on the seed and its index
+    rng = get_sample_rng(config["seed"], idx)
+
     # Generate random color background if no background image is provided
     # or if a directory of background images is provided, choose a random image
-    if bg_img_path is None:
-        bg_img = generate_random_bg(min_bg_dim, max_bg_dim)
-    elif bg_img_path.is_dir():
-        bg_img = load_bg_image(random.choice(bg_img_paths), min_bg_dim, max_bg_dim)
+    bg_img = state["bg_img"]
+    with time_stage(timings, "bg_load"):
+        if config["bg_img_path"] is None:
+            bg_img = generate_random_bg(min_bg_dim, max_bg_dim, rng)
+        elif state["bg_img_paths"]:
+            bg_path = state["bg_img_paths"][rng.integers(len(state["bg_img_paths"]))]
+            if state["bg_cache"] is not None:
+                bg_img = state["bg_cache"].load(bg_path, min_bg_dim, max_bg_dim)
+            else:
+                bg_img = load_bg_image(bg_path, min_bg_dim, max_bg_dim)
+
+    variant_bank: Optional[VariantBank] = state["kwargs"].get("variant_bank")
+    if variant_bank is not None:
+        variant_bank.start_sample(idx)
+
+    pills_per_type: Optional[List[int]] = None
+    if state["scheduler"] is not None:
+        pills_per_type = state["scheduler"].plan_sample(idx, rng)
+
+    stats: Dict[str, int] = {}
+    img_comp, mask_comp, labels_comp, _ = create_pill_comp(
+        bg_img,
+        pills_per_type=pills_per_type,
+        stats=stats,
+        timings=timings,
+        rng=rng,
+        **state["kwargs"],
+    )
+
+    with time_stage(timings, "annotate"):
+        anno_yolo = create_yolo_annotations(mask_comp, labels_comp)
 
-    img_comp, mask_comp, labels_comp, _ = create_pill_comp(bg_img, **kwargs)
-    img_comp = cv2.cvtColor(img_comp, cv2.COLOR_RGB2BGR)
+    return img_comp, anno_yolo, stats
 
-    # Save the image and annotations
-    anno_yolo = create_yolo_annotations(mask_comp, labels_comp)
+
+def generate_samples(
+    idx: int,
+    config: Dict[str, Any],
+    state: Dict[str, Any],
+    writer: AsyncWriter,
+    timings: Optional[Dict[str, float]] = None,
+) -> Dict[str, int]:
+    """Generate a single sample along with its annotation and queue it to be saved.
+    Return the placement counters of the composition."""
+    img_comp, anno_yolo, stats = compose_sample(idx, config, state, timings)
+
+    # Save the image and annotations, encoding the image in the background
     n_pills: int = len(anno_yolo)
-    with (output_folder / "labels" / f"{idx}_{n_pills}.txt").open("w") as f:
-        for j in range(len(anno_yolo)):
-            f.write(" ".join(str(el) for el in anno_yolo[j]) + "\n")
-    cv2.imwrite(str(output_folder / "images" / f"{idx}_{n_pills}.jpg"), img_comp)
+    writer.submit(f"{idx}_{n_pills}", img_comp, anno_yolo)
+
+    return stats
+
+
+def generate_chunk(
+    indices: Sequence[int], config: Dict[str, Any], shard_id: Optional[int] = None
+) -> Dict[str, Any]:
+    """Generate and save the samples of a range of indices in the current worker.
+
+    Args:
+        indices: The indices of the samples to generate.
+        config: The job configuration, as built by `main` from `make_job_config`.
+        shard_id: The number of the tar shard to write the samples to, if the output
+            format is `tar`.
+
+    Returns:
+        The id of the worker process, the first index and number of generated images,
+        the time spent generating them, the summed placement counters of the
+        compositions, and the time spent in each stage if the job is profiled.
+    """
+    start = time.perf_counter()
+    state = init_worker(config)
+    timings: Optional[Dict[str, float]] = {} if config["profile"] else None
+
+    output: Union[FileWriter, TarShardWriter]
+    if config["output_format"] == "tar":
+        output = TarShardWriter(config["output_folder"], shard_id or 0)
+    else:
+        output = FileWriter(config["output_folder"])
+    writer = AsyncWriter(
+        output,
+        config["image_format"],
+        config["quality"],
+        config["writer_threads"],
+        timings=timings,
+    )
+
+    stats: Dict[str, int] = {}
+    for idx in indices:
+        for key, value in generate_samples(idx, config, state, writer, timings).items():
+            stats[key] = stats.get(key, 0) + value
+    writer.close()
+    record_completed(config["output_folder"], indices)
+
+    return {
+        "pid": os.getpid(),
+        "first_index": indices[0] if len(indices) > 0 else None,
+        "n_images": len(indices),
+        "elapsed": time.perf_counter() - start,
+        "stats": stats,
+        "timings": timings or {},
+    }
 
 
 @click.command()
@@ -104,6 +575,24 @@ def generate_samples(
     show_default=True,
     help="Maximum number of pills per image",
 )
+@click.option(
+    "-ps",
+    "--min-pill-size",
+    default=PILL_LONGEST_MIN,
+    show_default=True,
+    help="Minimum length of the long side of the pills, in pixels",
+)
+@click.option(
+    "-PS",
+    "--max-pill-size",
+    default=PILL_LONGEST_MAX,
+    show_default=True,
+    help="""
+    Maximum length of the long side of the pills, in pixels. Small pills allow
+    high-density scenes: above 255 pills per image, the composition masks switch to
+    16-bit instance labels
+    """,
+)
 @click.option(
     "-mo",
     "--max-overlap",
@@ -118,6 +607,61 @@ def generate_samples(
     show_default=True,
     help="Maximum number of attempts to place a pill",
 )
+@click.option(
+    "-mc",
+    "--max-occupancy",
+    default=None,
+    type=float,
+    show_default=True,
+    help="""
+    Reject candidate pill positions whose surroundings are already covered by other
+    pills by more than this fraction, before transforming and composing the pill.
+    A lossy speed-up: it also rejects positions --max-overlap would accept, which
+    changes the images
+    """,
+)
+@click.option(
+    "-pl",
+    "--placement",
+    default="gaussian",
+    type=click.Choice(["gaussian", "free"]),
+    show_default=True,
+    help="""
+    Draw the candidate pill positions from a normal distribution centered on the
+    background, or from the space not yet covered by other pills
+    """,
+)
+@click.option(
+    "-tc/-no-tc",
+    "--target-count/--no-target-count",
+    default=False,
+    show_default=True,
+    help="""
+    Share a budget of `--max-attempts` attempts per requested pill between all the
+    pills of an image, instead of stopping a type of pill at its first pill which
+    could not be placed, so that the images get closer to the requested pill counts
+    """,
+)
+@click.option(
+    "-sd",
+    "--schedule",
+    default="random",
+    type=click.Choice(SCHEDULES),
+    show_default=True,
+    help="""
+    Draw the number of pills of each image uniformly and split it randomly between the
+    pill types, or plan the number of pills and of pill types of the images so that
+    every block of consecutive images covers every pill count bin and number of pill
+    types evenly
+    """,
+)
+@click.option(
+    "-nb",
+    "--n-count-bins",
+    default=10,
+    show_default=True,
+    help="Number of pill count bins covered by the stratified schedule",
+)
 @click.option(
     "-mb",
     "--min-bg-dim",
@@ -139,6 +683,123 @@ def generate_samples(
     show_default=True,
     help="Allow pills to be placed on the edge of the background image",
 )
+@click.option(
+    "-bm",
+    "--bg-cache-memory",
+    default=1024,
+    show_default=True,
+    help="""
+    Memory budget, in MB, of the caches of decoded and resized backgrounds kept by the
+    workers when a directory of backgrounds is used, split equally between the
+    workers. 0 disables the cache
+    """,
+)
+@click.option(
+    "--preload-bg/--no-preload-bg",
+    default=False,
+    show_default=True,
+    help="Load the whole background directory into each worker's cache upfront",
+)
+@click.option(
+    "-nv",
+    "--n-variants",
+    default=0,
+    show_default=True,
+    help="""
+    Number of pre-transformed variants kept per pill by each worker. The pills are
+    then drawn from these variants instead of being resized and augmented on every
+    placement attempt. 0 disables the variant bank
+    """,
+)
+@click.option(
+    "-vm",
+    "--variant-memory",
+    default=512,
+    show_default=True,
+    help="Memory budget of the variant bank of each worker, in MB",
+)
+@click.option(
+    "-la",
+    "--label-attribute",
+    default=None,
+    type=click.Choice(list(LABEL_ATTRIBUTES)),
+    help="""
+    Label the pills by pill type, shape or color, as given by the pill metadata, and
+    save the class names to `classes.txt`. All the pills are of class 0 if not provided
+    """,
+)
+@click.option(
+    "-md",
+    "--metadata-path",
+    default=Path(METADATA_FILE),
+    type=click.Path(path_type=Path),
+    show_default=True,
+    help="""
+    Path to the pill metadata CSV. It is compiled once into an index next to it, which
+    is rebuilt when the CSV changes
+    """,
+)
+@click.option(
+    "-sc",
+    "--sprite-cache",
+    default=None,
+    type=click.Path(),
+    show_default=True,
+    help="""
+    Path to a sprite cache directory. The pill images and masks are decoded once into
+    this memory-mapped cache, which all workers share. Built if missing or stale.
+    """,
+)
+@click.option(
+    "-of",
+    "--output-format",
+    default="files",
+    type=click.Choice(["files", "tar"]),
+    show_default=True,
+    help="""
+    Save each image and its labels as separate files in `images/` and `labels/`, or
+    stream them into WebDataset-style tar shards in `shards/`, each with a CSV index of
+    the offset and size of its files for random access
+    """,
+)
+@click.option(
+    "-ss",
+    "--shard-size",
+    default=1000,
+    show_default=True,
+    help="""
+    Number of images per tar shard. Shard k holds the images with indices from
+    k * shard-size to (k + 1) * shard-size - 1
+    """,
+)
+@click.option(
+    "-if",
+    "--image-format",
+    default="jpg",
+    type=click.Choice(["jpg", "png", "webp"]),
+    show_default=True,
+    help="Format of the generated images",
+)
+@click.option(
+    "-q",
+    "--quality",
+    default=None,
+    type=int,
+    help="""
+    Quality of the JPEG or WebP images, from 0 to 100, or compression level of the PNG
+    images, from 0 to 9. Defaults to the OpenCV default of the format
+    """,
+)
+@click.option(
+    "-wt",
+    "--writer-threads",
+    default=2,
+    show_default=True,
+    help="""
+    Number of threads per worker encoding the images in the background while the next
+    images are composed. 0 encodes and saves every image before composing the next one
+    """,
+)
 @click.option(
     "-c",
     "--num-cpu",
@@ -146,6 +807,59 @@ def generate_samples(
     show_default=True,
     help="The number of CPU cores to use",
 )
+@click.option(
+    "-cs",
+    "--chunk-size",
+    default=None,
+    type=int,
+    help="""
+    Number of consecutive images generated by a worker per task. Defaults to about four
+    tasks per worker, at most 256 images each
+    """,
+)
+@click.option(
+    "-s",
+    "--seed",
+    default=None,
+    type=int,
+    help="""
+    Seed of the dataset. Each image is drawn from its own random stream derived from the
+    seed and its index, so any image can be regenerated exactly, on any number of
+    workers. A random seed is drawn and printed if not provided
+    """,
+)
+@click.option(
+    "-i",
+    "--indices",
+    default=None,
+    type=str,
+    help="""
+    Only generate the images with these indices, e.g. `3,10-19`, instead of the first
+    `--n-images`. Used with the seed of an earlier run to regenerate some of its images.
+    Not available with the tar output format
+    """,
+)
+@click.option(
+    "-r",
+    "--resume/--no-resume",
+    default=False,
+    show_default=True,
+    help="""
+    Resume the job recorded in the manifest of the output folder, with the same
+    parameters and seed: the completed images are kept and only the missing ones are
+    generated. Images which an interrupted job was still writing are regenerated
+    """,
+)
+@click.option(
+    "--profile/--no-profile",
+    default=False,
+    show_default=True,
+    help="""
+    Time every stage of the generation, from loading the backgrounds to writing the
+    images, and save a JSON summary and a CSV with a row per chunk of images to
+    `telemetry.json` and `telemetry.csv` in the output folder
+    """,
+)
 def main(
     pill_mask_path: Path,
     bg_img_path: Optional[Path],
@@ -154,59 +868,153 @@ def main(
     n_pill_types: int,
     min_pills: int,
     max_pills: int,
+    min_pill_size: int,
+    max_pill_size: int,
     max_overlap: float,
     max_attempts: int,
+    max_occupancy: Optional[float],
+    placement: str,
+    target_count: bool,
+    schedule: str,
+    n_count_bins: int,
     min_bg_dim: int,
     max_bg_dim: int,
     allow_pills_outside: bool,
+    bg_cache_memory: int,
+    preload_bg: bool,
+    n_variants: int,
+    variant_memory: int,
+    label_attribute: Optional[str],
+    metadata_path: Path,
+    sprite_cache: Optional[Path],
+    output_format: str,
+    shard_size: int,
+    image_format: str,
+    quality: Optional[int],
+    writer_threads: int,
     num_cpu: int,
+    chunk_size: Optional[int],
+    seed: Optional[int],
+    indices: Optional[str],
+    resume: bool,
+    profile: bool,
 ):
+    # A tar shard is always rewritten as a whole, so writing a subset of its images
+    # would drop the images it already holds
+    if indices and output_format == "tar":
+        raise click.UsageError(
+            "--indices cannot be combined with --output-format tar, as tar shards are "
+            "rewritten as a whole. Regenerate whole shards with --resume instead."
+        )
+
     # Load pill mask paths
     pill_mask_paths = load_pill_mask_paths(pill_mask_path)
     print(f"Found {len(pill_mask_paths)} pill masks.")
 
-    # Create output folder
-    output_path = Path(output_folder)
-    output_path.mkdir(parents=True, exist_ok=True)
-    (output_path / "images").mkdir(parents=True, exist_ok=True)
-    (output_path / "labels").mkdir(parents=True, exist_ok=True)
-
-    # Load and resize background image if provided
-    bg_img: Optional[np.ndarray] = None
-    bg_img_paths: List[Path] = []
-    if bg_img_path is not None:
-        bg_img_path = Path(bg_img_path)
-        if bg_img_path.is_file():
-            bg_img = load_bg_image(bg_img_path, min_bg_dim, max_bg_dim)
-        else:
-            bg_img_paths = list(bg_img_path.glob("*.jpg"))
-
-    # Generate images and annotations and save them
-    kwargs: Dict[str, Any] = {
-        "pill_mask_paths": pill_mask_paths,
-        "n_pill_types": n_pill_types,
-        "min_pills": min_pills,
-        "max_pills": max_pills,
-        "max_overlap": max_overlap,
-        "max_attempts": max_attempts,
-        "allow_pill_on_border": allow_pills_outside,
-    }
-    Parallel(n_jobs=num_cpu)(
-        delayed(generate_samples)(
-            bg_img,
-            bg_img_path,
-            bg_img_paths,
-            output_path,
-            min_bg_dim,
-            max_bg_dim,
-            idx,
-            **kwargs,
+    # Decode the pills once into a shared memory-mapped cache if requested,
+    # otherwise read them from the pill atlas if one was built with `sprite_atlas`
+    cache: Optional[SpriteCache] = None
+    if sprite_cache is not None:
+        cache = load_sprite_cache(pill_mask_paths, Path(sprite_cache))
+    else:
+        cache = open_sprite_cache(Path(pill_mask_path) / ATLAS_DIR, pill_mask_paths)
+    if cache is not None:
+        print(f"Using sprite cache at {cache.cache_dir}.")
+
+    # Look up the class of every pill once in the compiled metadata index
+    sprite_labels: Optional[np.ndarray] = None
+    classes: List[str] = ["pill"]
+    if label_attribute is not None:
+        sprite_labels, classes = get_sprite_labels(
+            [img_path.name for img_path, _ in pill_mask_paths],
+            load_label_index(metadata_path),
+            label_attribute,
         )
-        for idx in trange(n_images, desc="Generating images")
+        print(f"Labeling the pills by {label_attribute}: {len(classes)} classes.")
+
+    # Seed the whole dataset, drawing a seed if none is given so that the run can
+    # still be reproduced. A resumed job keeps the seed of its manifest.
+    output_path = Path(output_folder)
+    manifest = load_manifest(output_path) if resume else None
+    if seed is None and manifest is not None:
+        seed = manifest["seed"]
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy) % 2**63
+    print(f"Using seed {seed}.")
+
+    # Generate images and annotations and save them. Each worker is handed whole
+    # chunks of indices and loads the background and pill assets only once.
+    config = make_job_config(
+        pill_mask_paths,
+        seed,
+        bg_img_path=bg_img_path,
+        min_bg_dim=min_bg_dim,
+        max_bg_dim=max_bg_dim,
+        bg_cache_memory=(
+            max(1, bg_cache_memory // effective_n_jobs(num_cpu))
+            if bg_cache_memory > 0
+            else 0
+        ),
+        preload_bg=preload_bg,
+        n_variants=n_variants,
+        variant_memory=variant_memory,
+        schedule=schedule,
+        n_count_bins=n_count_bins,
+        n_pill_types=n_pill_types,
+        min_pills=min_pills,
+        max_pills=max_pills,
+        longest_min=min_pill_size,
+        longest_max=max_pill_size,
+        max_overlap=max_overlap,
+        max_attempts=max_attempts,
+        allow_pill_on_border=allow_pills_outside,
+        max_occupancy=max_occupancy,
+        placement=placement,
+        target_count=target_count,
+        sprite_cache=cache,
+        sprite_labels=sprite_labels,
     )
+    config.update(
+        output_folder=output_path,
+        output_format=output_format,
+        image_format=image_format,
+        quality=quality,
+        writer_threads=writer_threads,
+        shard_size=shard_size,
+        profile=profile,
+        label_attribute=label_attribute,
+    )
+
+    # Create the output folder, or skip the images completed by the job to resume
+    completed = prepare_output(output_path, get_job_params(config), resume)
+    (output_path / CLASSES_FILE).write_text("\n".join(classes) + "\n")
+    sample_indices = get_missing_indices(
+        parse_indices(indices) if indices else list(range(n_images)),
+        completed,
+        shard_size if output_format == "tar" else None,
+    )
+    n_samples = len(sample_indices)
+    chunks = plan_chunks(sample_indices, output_format, shard_size, chunk_size, num_cpu)
 
-    print("Annotations are saved to the folder: ", output_path / "labels")
-    print("Images are saved to the folder: ", output_path / "images")
+    start_time = time.perf_counter()
+    with tqdm(total=len(chunks), desc="Generating images", unit="chunk") as pbar:
+        chunk_reports: List[Dict[str, Any]] = ProgressParallel(
+            pbar, n_samples, n_jobs=num_cpu
+        )(
+            delayed(generate_chunk)(chunk, config, shard_id)
+            for chunk, shard_id in chunks
+        )
+    elapsed = time.perf_counter() - start_time
+    report_job(chunk_reports, elapsed, output_path if profile else None)
+
+    if output_format == "tar":
+        print(
+            f"Images and annotations are saved to {len(chunks)} shards in the folder: ",
+            output_path / SHARDS_DIR,
+        )
+    else:
+        print("Annotations are saved to the folder: ", output_path / "labels")
+        print("Images are saved to the folder: ", output_path / "images")
 
 
 if __name__ == "__main__":
@@ -1,14 +1,70 @@
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import List, Set
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 import click
 import cv2
 import numpy as np
-from joblib import Parallel, delayed
 from tqdm import tqdm
 
-from countpillar.grabcut_utils import apply_grabcut, post_process_mask
-from countpillar.sam_utils import get_best_mask_per_images, predict_masks
+from countpillar.embedding_cache import EmbeddingCache
+from countpillar.grabcut_utils import (
+    apply_grabcut,
+    apply_roi_grabcut,
+    post_process_mask,
+)
+from countpillar.mask_manifest import MaskManifest
+from countpillar.sam_utils import (
+    DEFAULT_CHECKPOINT,
+    SAM_CHECKPOINTS,
+    configure_sam,
+    get_best_mask_per_images,
+    predict_masks,
+)
+
+
+def refine_and_save_mask(
+    image_path: Path,
+    image: np.ndarray,
+    sam_mask: np.ndarray,
+    output_masks_path: Path,
+    num_iterations: int = 10,
+    verbose: bool = False,
+    grabcut_mode: str = "full",
+    **roi_kwargs,
+) -> None:
+    """Refine the SAM mask of an image with GrabCut and save it.
+
+    Args:
+        image_path: The path to the image.
+        image: The BGR image.
+        sam_mask: The best mask predicted by SAM for the image.
+        output_masks_path: The folder to save the mask to, under the image file name.
+        num_iterations: The number of iterations of GrabCut.
+        verbose: Whether to print the path of the saved mask.
+        grabcut_mode: Run GrabCut on the whole image with `full`, or on the region
+            around the mask only with `roi`.
+        roi_kwargs: Keyword arguments for apply_roi_grabcut.
+    """
+    if grabcut_mode == "roi":
+        mask = apply_roi_grabcut(image, sam_mask, num_iterations, **roi_kwargs)
+    else:
+        mask = apply_grabcut(image, sam_mask, num_iterations)
+    final_mask = post_process_mask(mask)
+    if verbose:
+        print(
+            f"Saving mask for {image_path.name} to {output_masks_path / image_path.name}"
+        )
+
+    # Write the mask under a temporary name first and move it into place, so that a
+    # crash never leaves a partial mask behind, and the modification time of the
+    # mask folder tells a sprite atlas that a mask was regenerated
+    tmp_path = output_masks_path / f".{image_path.stem}.tmp{image_path.suffix}"
+    cv2.imwrite(str(tmp_path), final_mask)
+    os.replace(tmp_path, output_masks_path / image_path.name)
 
 
 def generate_final_mask(
@@ -16,22 +72,215 @@ def generate_final_mask(
     output_masks_path: Path,
     num_iterations: int = 10,
     verbose: bool = False,
+    checkpoint: str = DEFAULT_CHECKPOINT,
+    device: Optional[str] = None,
 ):
+    # Select the SAM model of this process, which is loaded once on first use
+    configure_sam(checkpoint, device)
+
     image: np.ndarray = cv2.imread(str(image_path))
     masks = predict_masks(image)
     mask_per_image = get_best_mask_per_images(masks)
 
-    mask = apply_grabcut(image, mask_per_image[0], num_iterations)
-    final_mask = post_process_mask(mask)
-    if verbose:
-        print(
-            f"Saving mask for {image_path.name} to {output_masks_path / image_path.name}"
+    refine_and_save_mask(
+        image_path, image, mask_per_image[0], output_masks_path, num_iterations, verbose
+    )
+
+
+def load_images(
+    image_paths: Iterable[Path],
+    n_threads: int = 2,
+    prefetch: int = 8,
+    on_skip: Optional[Callable[[Path], None]] = None,
+) -> Iterator[Tuple[Path, np.ndarray]]:
+    """Read images in background threads, ahead of their consumer.
+
+    Args:
+        image_paths: The paths to the images.
+        n_threads: The number of threads decoding the images.
+        prefetch: The maximum number of images read ahead.
+        on_skip: If provided, called with the path to every image which cannot be
+            read.
+
+    Yields:
+        The path to each image and the BGR image, in order. Images which cannot be
+        read are skipped.
+    """
+    paths = iter(image_paths)
+    with ThreadPoolExecutor(n_threads) as pool:
+        pending: Deque[Tuple[Path, Future]] = deque()
+        while True:
+            for image_path in islice(paths, prefetch - len(pending)):
+                pending.append((image_path, pool.submit(cv2.imread, str(image_path))))
+            if not pending:
+                return
+
+            image_path, image = pending.popleft()
+            if image.result() is None:
+                print(f"Skipping {image_path}, which cannot be read.")
+                if on_skip is not None:
+                    on_skip(image_path)
+                continue
+            yield image_path, image.result()
+
+
+def batch_by_shape(
+    images: Iterable[Tuple[Path, np.ndarray]], batch_size: int, max_pending: int = 0
+) -> Iterator[List[Tuple[Path, np.ndarray]]]:
+    """Group images into batches of images of the same size, as SAM requires.
+
+    Args:
+        images: The paths to the images and the images.
+        batch_size: The maximum number of images per batch.
+        max_pending: The maximum number of images waiting for a full batch. Once
+            exceeded, the largest incomplete batch is released. Defaults to four
+            batches.
+
+    Yields:
+        The batches of images.
+    """
+    max_pending = max_pending or 4 * batch_size
+    groups: Dict[Tuple[int, ...], List[Tuple[Path, np.ndarray]]] = {}
+    n_pending = 0
+    for image_path, image in images:
+        group = groups.setdefault(image.shape, [])
+        group.append((image_path, image))
+        n_pending += 1
+        if len(group) < batch_size and n_pending <= max_pending:
+            continue
+
+        # Release the full batch, or the largest one if too many images are waiting
+        shape = (
+            image.shape
+            if len(group) >= batch_size
+            else max(groups, key=lambda s: len(groups[s]))
         )
+        batch = groups.pop(shape)
+        n_pending -= len(batch)
+        yield batch
+
+    yield from groups.values()
+
+
+def generate_masks(
+    image_paths: List[Path],
+    output_masks_path: Path,
+    num_iterations: int = 10,
+    batch_size: int = 4,
+    num_workers: int = 6,
+    verbose: bool = False,
+    embedding_cache: Optional[EmbeddingCache] = None,
+    manifest: Optional[MaskManifest] = None,
+    **grabcut_kwargs,
+) -> None:
+    """Generate the masks of images in a pipeline of three stages: background threads
+    read the images, SAM predicts the masks of batches of same-size images, and a pool
+    of threads refines the masks with GrabCut and saves them.
+
+    The SAM model is loaded once, in the current process, and the GrabCut refinement of
+    the masks of a batch overlaps with the prediction of the next batches. OpenCV
+    releases the GIL while it runs GrabCut and reads and writes images, so the threads
+    of the pool run in parallel. At most two batches of masks per worker are waiting to
+    be refined, which bounds the memory held by pending images.
+
+    Args:
+        image_paths: The paths to the images to mask.
+        output_masks_path: The folder to save the masks to, under the image file names.
+        num_iterations: The number of iterations of GrabCut.
+        batch_size: The maximum number of images per SAM batch.
+        num_workers: The number of threads refining and saving the masks.
+        verbose: Whether to print the path of every saved mask.
+        embedding_cache: If provided, the cache SAM reads the image embeddings from,
+            and adds the embeddings it computes to.
+        manifest: If provided, every saved mask is recorded in this manifest.
+        grabcut_kwargs: Keyword arguments for refine_and_save_mask.
+    """
+    max_pending = 2 * batch_size * max(num_workers, 1)
+    pending: Deque[Tuple[Path, Future]] = deque()
+
+    def wait_oldest() -> None:
+        image_path, future = pending.popleft()
+        future.result()
+        if manifest is not None:
+            manifest.record(image_path)
+        pbar.update()
+
+    # Unreadable images are counted as done, so that the progress bar completes
+    n_skipped = 0
 
-    cv2.imwrite(str(output_masks_path / image_path.name), final_mask)
+    def skip(image_path: Path) -> None:
+        nonlocal n_skipped
+        n_skipped += 1
+        pbar.set_postfix(skipped=n_skipped, refresh=False)
+        pbar.update()
 
+    with tqdm(total=len(image_paths), desc="Generating masks") as pbar:
+        with ThreadPoolExecutor(max(num_workers, 1)) as pool:
+            loaded = load_images(image_paths, on_skip=skip)
+            for batch in batch_by_shape(loaded, batch_size):
+                images = [image for _, image in batch]
+                sam_masks = get_best_mask_per_images(
+                    predict_masks(images, embedding_cache)
+                )
+                for (image_path, image), sam_mask in zip(batch, sam_masks):
+                    pending.append(
+                        (
+                            image_path,
+                            pool.submit(
+                                refine_and_save_mask,
+                                image_path,
+                                image,
+                                sam_mask,
+                                output_masks_path,
+                                num_iterations,
+                                verbose,
+                                **grabcut_kwargs,
+                            ),
+                        )
+                    )
+
+                # Wait for the oldest masks once too many are waiting to be refined
+                while len(pending) > max_pending:
+                    wait_oldest()
+
+            while pending:
+                wait_oldest()
+
+
+def images_to_mask(
+    input_images_path: Path,
+    output_masks_path: Path,
+    manifest: Optional[MaskManifest] = None,
+    adopt: bool = False,
+) -> List[Path]:
+    """Get the images whose masks need to be generated.
+
+    Args:
+        input_images_path: The folder of the source images.
+        output_masks_path: The folder of the masks.
+        manifest: If provided, the masks which are missing or out of date according to
+            this manifest are generated. Otherwise, only the missing masks are.
+        adopt: Whether to record the existing masks missing from the manifest as up to
+            date if they are newer than their source image, instead of generating
+            them again.
+
+    Returns:
+        The paths to the images to mask.
+    """
+    if manifest is not None:
+        stale_paths, counts = manifest.get_stale(
+            sorted(Path(input_images_path).glob("*.jpg")), adopt
+        )
+        print(
+            f"Found {len(stale_paths)} images to mask: "
+            f"{counts.get('new', 0)} new, {counts.get('changed', 0)} changed, "
+            f"{counts.get('params', 0)} masked with other parameters and "
+            f"{counts.get('untracked', 0)} untracked. "
+            f"{counts.get('fresh', 0)} masks are up to date and "
+            f"{counts.get('adopted', 0)} existing masks were adopted."
+        )
+        return stale_paths
 
-def images_to_mask(input_images_path: Path, output_masks_path: Path) -> List[Path]:
     input_images: Set[str] = {
         img_path.name for img_path in input_images_path.glob("*.jpg")
     }
@@ -72,12 +321,96 @@ def images_to_mask(input_images_path: Path, output_masks_path: Path) -> List[Pat
     show_default=True,
     help="The number of iterations to run grabcut",
 )
+@click.option(
+    "-gm",
+    "--grabcut-mode",
+    default="full",
+    type=click.Choice(["full", "roi"]),
+    show_default=True,
+    help="""
+    Run GrabCut on the whole image, or only on the region around the SAM mask, stopping
+    once the mask stops changing
+    """,
+)
+@click.option(
+    "-gp",
+    "--grabcut-margin",
+    default=0.25,
+    show_default=True,
+    help="""
+    Padding of the region GrabCut runs on around the bounding box of the SAM mask, as a
+    fraction of its size, in the roi mode
+    """,
+)
+@click.option(
+    "-gs",
+    "--grabcut-scale",
+    default=1.0,
+    show_default=True,
+    help="Factor to downscale the region GrabCut runs on by, in the roi mode",
+)
 @click.option(
     "-c",
     "--num-cpu",
     default=6,
     show_default=True,
-    help="The number of CPU cores to use",
+    help="The number of threads refining the SAM masks with GrabCut and saving them",
+)
+@click.option(
+    "-b",
+    "--batch-size",
+    default=4,
+    show_default=True,
+    help="The maximum number of images of the same size SAM predicts the masks of at once",
+)
+@click.option(
+    "-m",
+    "--sam-checkpoint",
+    default=DEFAULT_CHECKPOINT,
+    type=click.Choice(list(SAM_CHECKPOINTS)),
+    show_default=True,
+    help="The size of the SAM model: ViT-B, ViT-L or ViT-H image encoder",
+)
+@click.option(
+    "-d",
+    "--device",
+    default=None,
+    type=str,
+    help="""
+    The device to run SAM on, e.g. `cpu`, `cuda` or `mps`. Defaults to the fastest
+    available device
+    """,
+)
+@click.option(
+    "-ec",
+    "--embedding-cache",
+    default=None,
+    type=click.Path(path_type=Path),
+    help="""
+    Path to a directory caching the SAM image embeddings, keyed by a hash of the image
+    and the SAM checkpoint, so that reruns over the same images only run the mask
+    decoder. Disabled if not provided
+    """,
+)
+@click.option(
+    "-em",
+    "--embedding-cache-memory",
+    default=4096,
+    show_default=True,
+    help="""
+    Disk budget of the embedding cache, in MB. The least recently used embeddings are
+    evicted beyond it
+    """,
+)
+@click.option(
+    "-ae",
+    "--adopt-existing",
+    is_flag=True,
+    help="""
+    Record the existing masks missing from the mask manifest, e.g. those generated
+    before it existed, as generated with the current parameters if they are newer than
+    their source image, instead of generating them again
+    """,
 )
 @click.option(
     "-v",
@@ -89,19 +422,56 @@ def main(
     input_images_path: Path,
     output_masks_path: Path,
     num_iterations: int,
+    grabcut_mode: str,
+    grabcut_margin: float,
+    grabcut_scale: float,
     num_cpu: int,
+    batch_size: int,
+    sam_checkpoint: str,
+    device: Optional[str],
+    embedding_cache: Optional[Path],
+    embedding_cache_memory: int,
+    adopt_existing: bool,
     verbose: bool,
 ) -> None:
-    # Get the images that need to be masked
-    images_path = images_to_mask(input_images_path, output_masks_path)
+    # Get the images whose masks are missing, or out of date as their source image or
+    # the parameters of the masks changed since they were generated
+    params = {
+        "sam_checkpoint": sam_checkpoint,
+        "num_iterations": num_iterations,
+        "grabcut_mode": grabcut_mode,
+    }
+    if grabcut_mode == "roi":
+        params.update(grabcut_margin=grabcut_margin, grabcut_scale=grabcut_scale)
+    manifest = MaskManifest(Path(output_masks_path), params)
+    images_path = images_to_mask(
+        Path(input_images_path), Path(output_masks_path), manifest, adopt_existing
+    )
+    manifest.compact()
 
-    # Generate the masks
-    Parallel(n_jobs=num_cpu)(
-        delayed(generate_final_mask)(
-            image_path, output_masks_path, num_iterations, verbose
-        )
-        for image_path in tqdm(images_path, desc="Generating masks")
+    # Generate the masks with a single SAM model, loaded in this process
+    configure_sam(sam_checkpoint, device)
+    cache: Optional[EmbeddingCache] = None
+    if embedding_cache is not None:
+        cache = EmbeddingCache(embedding_cache, embedding_cache_memory * 2**20)
+    generate_masks(
+        images_path,
+        Path(output_masks_path),
+        num_iterations,
+        batch_size,
+        num_cpu,
+        verbose,
+        cache,
+        manifest,
+        grabcut_mode=grabcut_mode,
+        margin=grabcut_margin,
+        scale=grabcut_scale,
     )
+    if cache is not None:
+        print(
+            f"Embedding cache: {cache.hits} hits, {cache.misses} misses, "
+            f"{cache.evictions} evictions, {cache.nbytes / 2**20:.0f} MB."
+        )
 
 
 if __name__ == "__main__":
@@ -3,6 +3,8 @@ from typing import Tuple
 import cv2
 import numpy as np
 
+from countpillar.io_utils import mask_bbox
+
 # the output mask has for possible output values, marking each pixel
 # in the mask as (1) definite background, (2) definite foreground,
 # (3) probable background, and (4) probable foreground
@@ -13,9 +15,13 @@ GRABCUT_TYPES: Tuple[Tuple[str, int], ...] = (
     ("Probable Foreground", cv2.GC_PR_FGD),
 )
 
+# Number of components of the color models of GrabCut, each of which needs at least
+# one pixel of the foreground and of the background
+GMM_COMPONENTS = 5
+
 
 def apply_grabcut(image: np.ndarray, mask: np.ndarray, n_iter: int = 10) -> np.ndarray:
-    """Apply GrabCut to the image."""
+    """Apply GrabCut to the whole image, for `n_iter` iterations."""
     # Set any value greater than zero to be foreground
     mask[mask > 0] = cv2.GC_PR_FGD
 
@@ -29,7 +35,13 @@ def apply_grabcut(image: np.ndarray, mask: np.ndarray, n_iter: int = 10) -> np.n
 
     # apply GrabCut using the the mask segmentation method
     (mask, bg_model, fg_model) = cv2.grabCut(
-        image, mask, None, bg_model, fg_model, iterCount=10, mode=cv2.GC_INIT_WITH_MASK
+        image,
+        mask,
+        None,
+        bg_model,
+        fg_model,
+        iterCount=n_iter,
+        mode=cv2.GC_INIT_WITH_MASK,
     )
 
     return mask
@@ -44,3 +56,121 @@ def post_process_mask(mask: np.ndarray) -> np.ndarray:
     outputMask = (outputMask * 255).astype("uint8")
 
     return outputMask
+
+
+def get_grabcut_roi(
+    mask: np.ndarray, margin: float = 0.25, min_margin: int = 16
+) -> Tuple[slice, slice]:
+    """Get the region of the image GrabCut needs to refine a mask: the bounding box of
+    the mask, padded on every side so that the background model has enough pixels.
+
+    Args:
+        mask: The mask to refine.
+        margin: The padding, as a fraction of the size of the bounding box.
+        min_margin: The minimum padding, in pixels.
+
+    Returns:
+        The rows and columns of the region, clipped to the image.
+    """
+    x_min, y_min, x_max, y_max = mask_bbox(mask)
+    pad_x = max(int(margin * (x_max - x_min + 1)), min_margin)
+    pad_y = max(int(margin * (y_max - y_min + 1)), min_margin)
+    height, width = mask.shape[:2]
+
+    return (
+        slice(max(y_min - pad_y, 0), min(y_max + pad_y + 1, height)),
+        slice(max(x_min - pad_x, 0), min(x_max + pad_x + 1, width)),
+    )
+
+
+def run_grabcut(
+    image: np.ndarray, labels: np.ndarray, n_iter: int = 10, tol: float = 0.001
+) -> np.ndarray:
+    """Run GrabCut one iteration at a time, stopping once the labels stop changing.
+
+    Args:
+        image: The BGR image.
+        labels: The initial GrabCut labels of the pixels, which are updated in place.
+        n_iter: The maximum number of iterations.
+        tol: The fraction of the pixels which must change of foreground or background
+            for GrabCut to go on with another iteration.
+
+    Returns:
+        The GrabCut labels of the pixels.
+    """
+    foreground = (labels == cv2.GC_FGD) | (labels == cv2.GC_PR_FGD)
+    n_foreground = np.count_nonzero(foreground)
+
+    # GrabCut cannot fit its color models without enough pixels of each kind
+    if min(n_foreground, labels.size - n_foreground) < GMM_COMPONENTS:
+        return labels
+
+    bg_model = np.zeros((1, 65), dtype="float")
+    fg_model = np.zeros((1, 65), dtype="float")
+    mode = cv2.GC_INIT_WITH_MASK
+    for _ in range(n_iter):
+        cv2.grabCut(image, labels, None, bg_model, fg_model, iterCount=1, mode=mode)
+        mode = cv2.GC_EVAL
+
+        new_foreground = (labels == cv2.GC_FGD) | (labels == cv2.GC_PR_FGD)
+        n_changed = np.count_nonzero(new_foreground != foreground)
+        foreground = new_foreground
+        if n_changed <= tol * labels.size:
+            break
+
+    return labels
+
+
+def apply_roi_grabcut(
+    image: np.ndarray,
+    mask: np.ndarray,
+    n_iter: int = 10,
+    margin: float = 0.25,
+    scale: float = 1.0,
+    tol: float = 0.001,
+) -> np.ndarray:
+    """Apply GrabCut to the region of the image around the mask only, optionally at a
+    reduced resolution, stopping once the labels stop changing.
+
+    As with `apply_grabcut`, the pixels outside of the mask are definite background,
+    so GrabCut can only remove pixels from the mask, and nothing outside of the region
+    changes. At a reduced resolution, the labels are upsampled back to the region and
+    the pixels outside of the mask are kept as background.
+
+    Args:
+        image: The BGR image.
+        mask: The mask to refine, non-zero on the foreground.
+        n_iter: The maximum number of iterations of GrabCut.
+        margin: The padding of the region around the bounding box of the mask, as a
+            fraction of the size of the bounding box.
+        scale: The factor to resize the region by before running GrabCut, at most 1.
+        tol: The fraction of the pixels of the region which must change for GrabCut
+            to go on with another iteration.
+
+    Returns:
+        The GrabCut labels of the pixels of the whole image.
+    """
+    labels = np.where(mask > 0, cv2.GC_PR_FGD, cv2.GC_BGD).astype(np.uint8)
+    roi = get_grabcut_roi(mask, margin)
+    roi_image, roi_labels = image[roi], labels[roi]
+
+    if scale < 1:
+        height, width = roi_labels.shape
+        size = (max(round(width * scale), 1), max(round(height * scale), 1))
+        small_labels = cv2.resize(roi_labels, size, interpolation=cv2.INTER_NEAREST)
+        small_labels = run_grabcut(
+            cv2.resize(roi_image, size, interpolation=cv2.INTER_AREA),
+            small_labels,
+            n_iter,
+            tol,
+        )
+        refined = cv2.resize(
+            small_labels, (width, height), interpolation=cv2.INTER_NEAREST
+        )
+        labels[roi] = np.where(roi_labels == cv2.GC_BGD, cv2.GC_BGD, refined)
+    else:
+        labels[roi] = run_grabcut(
+            np.ascontiguousarray(roi_image), roi_labels.copy(), n_iter, tol
+        )
+
+    return labels
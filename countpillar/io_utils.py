@@ -1,42 +1,123 @@
+import json
+import os
 from pathlib import Path
-from typing import List, Tuple
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Sequence, Tuple
 
 import cv2
 import numpy as np
 
+from countpillar.cache_utils import LRUCache
 from countpillar.transform import resize_bg
 
+if TYPE_CHECKING:
+    from countpillar.sprite_cache import SpriteCache
 
-def load_pill_mask_paths(pill_mask_dir: Path) -> List[Tuple[Path, Path]]:
-    """Load the pill image and the corresponding mask paths.
+# Location of the packed pill atlas inside a pill mask directory, see `sprite_atlas`
+ATLAS_DIR = "atlas"
+ATLAS_INDEX_FILE = "index.npy"
+ATLAS_META_FILE = "meta.json"
+
+
+def get_source_dir_stamps(pill_mask_paths: List[Tuple[Path, Path]]) -> Dict[str, int]:
+    """Get the modification time, in nanoseconds, of every folder holding pill images
+    or masks, or -1 for a missing folder. Adding, removing, renaming or atomically
+    replacing a pill file updates the modification time of its folder, so this tells
+    whether the pills changed with a `stat` per folder instead of per file.
+
+    Args:
+        pill_mask_paths: The paths to the pill images and masks.
+
+    Returns:
+        The modification time of each folder, by path.
+    """
+    dirs = sorted({str(path.parent) for paths in pill_mask_paths for path in paths})
+    stamps: Dict[str, int] = {}
+    for source_dir in dirs:
+        try:
+            stamps[source_dir] = os.stat(source_dir).st_mtime_ns
+        except OSError:
+            stamps[source_dir] = -1
+
+    return stamps
+
+
+def sources_match(
+    recorded_stamps: Dict[str, int], pill_mask_paths: List[Tuple[Path, Path]]
+) -> bool:
+    """Whether the pill folders are unchanged since their stamps were recorded with
+    `get_source_dir_stamps`. Missing folders are ignored, so that an atlas can be
+    shipped without the pill images it was built from."""
+    return all(
+        stamp in (-1, recorded_stamps.get(source_dir))
+        for source_dir, stamp in get_source_dir_stamps(pill_mask_paths).items()
+    )
+
+
+def load_pill_mask_paths(
+    pill_mask_dir: Path, use_atlas: bool = True
+) -> List[Tuple[Path, Path]]:
+    """Load the pill image and the corresponding mask paths. The paths are sorted by
+    file name so that their order, and with it the pills drawn for a given seed, does
+    not depend on the file system. If the directory holds a pill atlas, and the pill
+    folders did not change since it was built, the paths are read from the index of
+    the atlas instead of listing the pill folders.
 
     Args:
         pill_mask_dir: The directory containing the pill images and masks.
+        use_atlas: Whether to read the paths from the pill atlas.
 
     Returns:
         pill_mask_paths: The paths to the pill image and mask.
     """
-    pill_mask_paths: List[Tuple[Path, Path]] = [
-        (p, pill_mask_dir / "masks" / p.name)
-        for p in (pill_mask_dir / "images").glob("*.jpg")
+    pill_mask_dir = Path(pill_mask_dir)
+    atlas_dir = pill_mask_dir / ATLAS_DIR
+    if (
+        use_atlas
+        and (atlas_dir / ATLAS_INDEX_FILE).exists()
+        and (atlas_dir / ATLAS_META_FILE).exists()
+    ):
+        with (atlas_dir / ATLAS_META_FILE).open() as f:
+            source_dirs: Dict[str, int] = json.load(f).get("source_dirs", {})
+        names: List[str] = np.load(atlas_dir / ATLAS_INDEX_FILE)["name"].tolist()
+        pill_mask_paths = get_pill_mask_paths(pill_mask_dir, names)
+        if sources_match(source_dirs, pill_mask_paths):
+            return pill_mask_paths
+
+    names = sorted(p.name for p in (pill_mask_dir / "images").glob("*.jpg"))
+    return get_pill_mask_paths(pill_mask_dir, names)
+
+
+def get_pill_mask_paths(
+    pill_mask_dir: Path, names: List[str]
+) -> List[Tuple[Path, Path]]:
+    """Get the paths to the images and masks of the pills with the given file names."""
+    return [
+        (pill_mask_dir / "images" / name, pill_mask_dir / "masks" / name)
+        for name in names
     ]
-    return pill_mask_paths
 
 
 def get_img_and_mask(
-    pill_mask_paths: Tuple[Path, Path], thresh: int = 25
+    pill_mask_paths: Tuple[Path, Path],
+    thresh: int = 25,
+    sprite_cache: Optional["SpriteCache"] = None,
 ) -> Tuple[np.ndarray, np.ndarray]:
     """Get the image and mask from the pill mask paths.
 
     Args:
         pill_mask_paths: The paths to the pill image and mask.
         thresh: The threshold at which to binarize the mask.
+        sprite_cache: A sprite cache or pill atlas to read the pill from instead of
+            decoding the files. The pill is looked up by its image file name.
 
     Returns:
         img: The pill image.
         mask: The pill mask.
     """
     img_path, mask_path = pill_mask_paths
+    if sprite_cache is not None:
+        return sprite_cache[sprite_cache.index_of(img_path.name)]
+
     img = cv2.imread(str(img_path))
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
@@ -52,6 +133,24 @@ def get_img_and_mask(
     return img, mask
 
 
+def mask_bbox(mask: np.ndarray) -> Tuple[int, int, int, int]:
+    """Get the bounding box of the foreground of a mask.
+
+    Args:
+        mask: The mask.
+
+    Returns:
+        The (x_min, y_min, x_max, y_max) inclusive bounds of the non-zero pixels, or
+        (0, 0, -1, -1) if the mask is empty.
+    """
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(cols) == 0:
+        return 0, 0, -1, -1
+    rows = np.flatnonzero(mask.any(axis=1))
+
+    return int(cols[0]), int(rows[0]), int(cols[-1]), int(rows[-1])
+
+
 def load_bg_image(path: Path, min_dim: int, max_dim) -> np.ndarray:
     """Load and resize the background image.
 
@@ -70,6 +169,99 @@ def load_bg_image(path: Path, min_dim: int, max_dim) -> np.ndarray:
     return bg_img
 
 
+class BackgroundCache:
+    """Cache of decoded and resized background images, bounded by their total memory
+    size. The least recently used backgrounds are evicted first.
+
+    The cached backgrounds are shared between calls and are therefore read-only;
+    create_pill_comp composes the pills on a copy of the background.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self._cache = LRUCache(max_bytes)
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def load(self, path: Path, min_dim: int, max_dim: int) -> np.ndarray:
+        """Load and resize the background image, unless it is already cached.
+
+        Args:
+            path: The path to the background image.
+            min_dim: The minimum dimension of the background image.
+            max_dim: The maximum dimension of the background image.
+
+        Returns:
+            bg_img: The read-only background image as a numpy array.
+        """
+        key = (str(path), min_dim, max_dim)
+        bg_img: Optional[np.ndarray] = self._cache.get(key)
+        if bg_img is None:
+            bg_img = load_bg_image(path, min_dim, max_dim)
+            bg_img.flags.writeable = False
+            self._cache.put(key, bg_img)
+
+        return bg_img
+
+    def preload(self, paths: Sequence[Path], min_dim: int, max_dim: int) -> None:
+        """Load all the background images into the cache. Backgrounds which do not
+        fit in the memory budget are evicted again, least recently used first.
+
+        Args:
+            paths: The paths to the background images.
+            min_dim: The minimum dimension of the background images.
+            max_dim: The maximum dimension of the background images.
+        """
+        for path in paths:
+            self.load(path, min_dim, max_dim)
+
+
+class Instances(NamedTuple):
+    """Per-instance statistics of a composition mask, ordered by instance index."""
+
+    ids: np.ndarray  # (N,) indices of the instances present in the mask
+    bboxes: np.ndarray  # (N, 4) inclusive (x_min, y_min, x_max, y_max) bounds
+    areas: np.ndarray  # (N,) areas of the bounding boxes
+    visible: np.ndarray  # (N,) numbers of visible pixels
+
+
+def extract_instances(mask_comp: np.ndarray) -> Instances:
+    """Extract the bounding box, bounding box area and visible-pixel count of every
+    instance of a composition mask in a single pass over the mask.
+
+    Args:
+        mask_comp: The composition mask, 0 for the background and the instance index
+            elsewhere.
+
+    Returns:
+        The statistics of the instances present in the mask.
+    """
+    comp_h, comp_w = mask_comp.shape[:2]
+
+    # Scan the mask once for the foreground pixels and their instance indices
+    pos = np.flatnonzero(mask_comp)
+    labels = mask_comp.ravel()[pos].astype(np.intp)
+    ys, xs = np.divmod(pos, comp_w)
+
+    n_labels = int(labels.max()) + 1 if len(labels) > 0 else 1
+    visible = np.bincount(labels, minlength=n_labels)
+    ids = np.flatnonzero(visible[1:]) + 1
+
+    # Mark the rows and columns each instance appears in and take the first and last
+    rows = np.zeros((n_labels, comp_h), dtype=bool)
+    cols = np.zeros((n_labels, comp_w), dtype=bool)
+    rows[labels, ys] = True
+    cols[labels, xs] = True
+    rows, cols = rows[ids], cols[ids]
+
+    x_min, x_max = cols.argmax(axis=1), comp_w - 1 - cols[:, ::-1].argmax(axis=1)
+    y_min, y_max = rows.argmax(axis=1), comp_h - 1 - rows[:, ::-1].argmax(axis=1)
+    bboxes = np.stack([x_min, y_min, x_max, y_max], axis=1)
+    areas = (x_max - x_min + 1) * (y_max - y_min + 1)
+
+    return Instances(ids, bboxes, areas, visible[ids])
+
+
 def create_yolo_annotations(
     mask_comp: np.ndarray, labels_comp: List[int]
 ) -> List[List[float]]:
@@ -83,15 +275,11 @@ def create_yolo_annotations(
         annotations_yolo: The YOLO annotations.
     """
     comp_w, comp_h = mask_comp.shape[1], mask_comp.shape[0]
-
-    obj_ids = np.unique(mask_comp).astype(np.uint8)[1:]
-    masks = mask_comp == obj_ids[:, None, None]
+    bboxes = extract_instances(mask_comp).bboxes
 
     annotations_yolo: List[List[float]] = []
     for i in range(len(labels_comp)):
-        pos = np.where(masks[i])
-        xmin, xmax = np.min(pos[1]), np.max(pos[1])
-        ymin, ymax = np.min(pos[0]), np.max(pos[0])
+        xmin, ymin, xmax, ymax = bboxes[i]
 
         xc, yc = (xmin + xmax) / 2, (ymin + ymax) / 2
         w, h = xmax - xmin, ymax - ymin
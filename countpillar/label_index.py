@@ -0,0 +1,162 @@
+import csv
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+METADATA_FILE = "labels_metadata.csv"
+
+# Class attributes of the pills, and the metadata column each one is read from
+LABEL_ATTRIBUTES = {"pilltype": "pilltype_id", "shape": "Shape", "color": "Color"}
+
+# Class of the pills whose attribute is missing from the metadata
+UNKNOWN_CLASS = "unknown"
+
+
+class LabelIndex:
+    """Compiled index of the pill metadata, mapping each pill image file name to the
+    class id of its pill type, shape and color.
+
+    The index is a compact `.npz` file holding the sorted image file names, the class
+    id of every image for each attribute of `LABEL_ATTRIBUTES`, and the class names of
+    each attribute, in class id order. Loading it is much cheaper than parsing the
+    metadata CSV, and looking up the classes of a list of names is a vectorized binary
+    search.
+    """
+
+    def __init__(self, index_path: Path) -> None:
+        self.index_path = Path(index_path)
+        with np.load(self.index_path, allow_pickle=False) as index:
+            self.names: np.ndarray = index["names"]
+            self._class_ids: Dict[str, np.ndarray] = {
+                attribute: index[f"{attribute}_ids"] for attribute in LABEL_ATTRIBUTES
+            }
+            self._classes: Dict[str, List[str]] = {
+                attribute: index[f"{attribute}_classes"].tolist()
+                for attribute in LABEL_ATTRIBUTES
+            }
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def classes(self, attribute: str) -> List[str]:
+        """Get the class names of an attribute, in class id order."""
+        return self._classes[attribute]
+
+    def lookup(self, names: Sequence[str], attribute: str) -> np.ndarray:
+        """Get the class ids of the images with the given file names.
+
+        Args:
+            names: The image file names.
+            attribute: The class attribute, one of `LABEL_ATTRIBUTES`.
+
+        Returns:
+            The class id of each image, or -1 for the images missing from the index.
+        """
+        names_arr = np.asarray(names, dtype=self.names.dtype)
+        pos = np.searchsorted(self.names, names_arr)
+        pos = np.minimum(pos, max(len(self.names) - 1, 0))
+        found = (
+            self.names[pos] == names_arr
+            if len(self.names) > 0
+            else np.zeros(len(names_arr), dtype=bool)
+        )
+
+        return np.where(found, self._class_ids[attribute][pos], -1).astype(np.int32)
+
+
+def build_label_index(metadata_path: Path, index_path: Path) -> LabelIndex:
+    """Parse the pill metadata CSV once and compile it into a label index.
+
+    The class ids of each attribute are assigned in the sorted order of its values,
+    so they only depend on the metadata. Images listed more than once keep their first
+    row, and missing values are assigned the `unknown` class.
+
+    Args:
+        metadata_path: The path to the metadata CSV.
+        index_path: The path to write the `.npz` index to.
+
+    Returns:
+        The label index.
+    """
+    rows: Dict[str, Dict[str, str]] = {}
+    with Path(metadata_path).open(newline="") as f:
+        for row in csv.DictReader(f):
+            rows.setdefault(row["images"], row)
+
+    names = sorted(rows)
+    arrays: Dict[str, np.ndarray] = {
+        "names": np.array(names, dtype=f"U{max(map(len, names), default=1)}")
+    }
+    for attribute, column in LABEL_ATTRIBUTES.items():
+        values = [rows[name][column].strip() or UNKNOWN_CLASS for name in names]
+        classes, class_ids = np.unique(np.array(values, dtype=str), return_inverse=True)
+        arrays[f"{attribute}_ids"] = class_ids.astype(np.int32)
+        arrays[f"{attribute}_classes"] = classes
+
+    # Write the index under a temporary name first, so that workers never load a
+    # partially written index
+    index_path = Path(index_path)
+    fd, tmp_path = tempfile.mkstemp(dir=index_path.parent, suffix=".npz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, index_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return LabelIndex(index_path)
+
+
+def load_label_index(
+    metadata_path: Path, index_path: Optional[Path] = None
+) -> LabelIndex:
+    """Load the label index of the pill metadata, compiling it first if it is missing
+    or older than the metadata CSV.
+
+    Args:
+        metadata_path: The path to the metadata CSV.
+        index_path: The path to the `.npz` index. Defaults to the path of the CSV with
+            an `.npz` suffix.
+
+    Returns:
+        The label index.
+    """
+    metadata_path = Path(metadata_path)
+    index_path = Path(index_path or metadata_path.with_suffix(".npz"))
+    if (
+        index_path.is_file()
+        and index_path.stat().st_mtime >= metadata_path.stat().st_mtime
+    ):
+        return LabelIndex(index_path)
+
+    return build_label_index(metadata_path, index_path)
+
+
+def get_sprite_labels(
+    names: Sequence[str], label_index: LabelIndex, attribute: str
+) -> Tuple[np.ndarray, List[str]]:
+    """Get the class of every pill sprite, in sprite order, so that the label of a
+    placed pill is a single array lookup.
+
+    Args:
+        names: The image file names of the sprites.
+        label_index: The label index of the pill metadata.
+        attribute: The class attribute, one of `LABEL_ATTRIBUTES`.
+
+    Returns:
+        The class id of each sprite, and the class names in class id order. Sprites
+        missing from the metadata are assigned the `unknown` class, which is appended
+        to the classes if the metadata has no such class.
+    """
+    classes = list(label_index.classes(attribute))
+    sprite_labels = label_index.lookup(names, attribute)
+    if np.any(sprite_labels < 0):
+        if UNKNOWN_CLASS not in classes:
+            classes.append(UNKNOWN_CLASS)
+        sprite_labels[sprite_labels < 0] = classes.index(UNKNOWN_CLASS)
+
+    return sprite_labels, classes
@@ -0,0 +1,128 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+MANIFEST_FILE = "manifest.json"
+COMPLETED_FILE = "completed.txt"
+
+
+def parse_indices(indices: str) -> List[int]:
+    """Parse a comma-separated list of indices and inclusive ranges, e.g. `3,10-19`.
+
+    Args:
+        indices: The indices to parse.
+
+    Returns:
+        The sorted unique indices.
+    """
+    parsed: Set[int] = set()
+    for part in indices.split(","):
+        first, _, last = part.strip().partition("-")
+        parsed.update(range(int(first), int(last or first) + 1))
+
+    return sorted(parsed)
+
+
+def format_indices(indices: Sequence[int]) -> str:
+    """Format indices as a comma-separated list of inclusive ranges, the inverse of
+    `parse_indices`, e.g. `3,10-19`."""
+    parts: List[str] = []
+    sorted_indices = sorted(set(indices))
+    start = 0
+    for i in range(1, len(sorted_indices) + 1):
+        if i == len(sorted_indices) or sorted_indices[i] != sorted_indices[i - 1] + 1:
+            first, last = sorted_indices[start], sorted_indices[i - 1]
+            parts.append(str(first) if first == last else f"{first}-{last}")
+            start = i
+
+    return ",".join(parts)
+
+
+def write_manifest(output_folder: Path, params: Dict[str, Any]) -> None:
+    """Record the parameters of a generation job in its output folder, and start a new
+    log of completed indices.
+
+    Args:
+        output_folder: The output folder of the job.
+        params: The JSON-serializable parameters which determine the generated samples.
+    """
+    output_folder = Path(output_folder)
+    tmp_path = output_folder / f".{MANIFEST_FILE}.tmp"
+    with tmp_path.open("w") as f:
+        json.dump(params, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, output_folder / MANIFEST_FILE)
+    (output_folder / COMPLETED_FILE).write_text("")
+
+
+def load_manifest(output_folder: Path) -> Optional[Dict[str, Any]]:
+    """Load the parameters recorded by `write_manifest`, if there are any."""
+    manifest_path = Path(output_folder) / MANIFEST_FILE
+    if not manifest_path.is_file():
+        return None
+
+    with manifest_path.open() as f:
+        return json.load(f)
+
+
+def record_completed(output_folder: Path, indices: Sequence[int]) -> None:
+    """Append indices whose samples are fully saved to the log of completed indices.
+
+    Each call appends a single line with one write, so that workers can record their
+    chunks concurrently, and syncs it to disk, so that a recorded sample is never lost
+    in a crash.
+
+    Args:
+        output_folder: The output folder of the job.
+        indices: The indices of the saved samples.
+    """
+    if len(indices) == 0:
+        return
+
+    fd = os.open(
+        Path(output_folder) / COMPLETED_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT
+    )
+    try:
+        os.write(fd, f"{format_indices(indices)}\n".encode())
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def load_completed(output_folder: Path) -> Set[int]:
+    """Load the completed indices of a job. A line cut short by a crash is ignored,
+    as its chunk was not completed."""
+    completed_path = Path(output_folder) / COMPLETED_FILE
+    if not completed_path.is_file():
+        return set()
+
+    completed: Set[int] = set()
+    for line in completed_path.read_text().splitlines(keepends=True):
+        if not line.endswith("\n") or not line.strip():
+            continue
+        try:
+            completed.update(parse_indices(line))
+        except ValueError:
+            continue
+
+    return completed
+
+
+def compact_completed(output_folder: Path, completed: Set[int]) -> None:
+    """Rewrite the log of completed indices as a single line, dropping any line cut
+    short by a crash, before a resumed job appends to it."""
+    output_folder = Path(output_folder)
+    tmp_path = output_folder / f".{COMPLETED_FILE}.tmp"
+    tmp_path.write_text(f"{format_indices(sorted(completed))}\n" if completed else "")
+    os.replace(tmp_path, output_folder / COMPLETED_FILE)
+
+
+def diff_params(params: Dict[str, Any], recorded: Dict[str, Any]) -> List[str]:
+    """Get the names of the parameters which differ from the recorded ones."""
+    # Compare the parameters as they would be recorded, e.g. with tuples as lists
+    params = json.loads(json.dumps(params))
+    return sorted(
+        key
+        for key in set(params) | set(recorded)
+        if params.get(key) != recorded.get(key)
+    )
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+MASK_MANIFEST_FILE = "masks_manifest.jsonl"
+
+
+def hash_file(path: Path, chunk_size: int = 2**20) -> str:
+    """Get the SHA-1 hash of the content of a file."""
+    digest = hashlib.sha1()
+    with Path(path).open("rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def hash_params(params: Dict[str, Any]) -> str:
+    """Get the SHA-1 hash of JSON-serializable parameters, independent of key order."""
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+class MaskManifest:
+    """Record of the source image and the parameters every mask was generated from,
+    so that only the masks which are out of date are generated again.
+
+    The manifest is a JSON lines file in the mask folder, with one line per generated
+    mask holding the name of the image, the hash of its content, its size and
+    modification time, and the hash of the generation parameters. A line is appended,
+    and flushed, as soon as its mask is saved, so an interrupted run loses nothing; the
+    last line of an image wins, and a line cut short by a crash is ignored.
+
+    The content of a source image is only hashed again when its size or modification
+    time differs from the recorded ones, so checking a large library which did not
+    change only costs a `stat` per image.
+    """
+
+    def __init__(self, masks_path: Path, params: Dict[str, Any]) -> None:
+        self.masks_path = Path(masks_path)
+        self.manifest_path = self.masks_path / MASK_MANIFEST_FILE
+        self.params = params
+        self.params_hash = hash_params(params)
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if self.manifest_path.is_file():
+            for line in self.manifest_path.read_text().splitlines(keepends=True):
+                try:
+                    entry = json.loads(line) if line.endswith("\n") else None
+                except ValueError:
+                    entry = None
+                if isinstance(entry, dict) and "name" in entry:
+                    self.entries[entry["name"]] = entry
+
+        # Content hash, size and modification time of the scanned source images
+        self._sources: Dict[str, Tuple[str, int, int]] = {}
+
+    def source_hash(self, image_path: Path) -> str:
+        """Get the content hash of a source image, reusing the recorded one if the
+        image has the recorded size and modification time."""
+        stat = Path(image_path).stat()
+        entry = self.entries.get(image_path.name)
+        if (
+            entry is not None
+            and entry["size"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+        ):
+            source = (entry["hash"], stat.st_size, stat.st_mtime_ns)
+        else:
+            source = (hash_file(image_path), stat.st_size, stat.st_mtime_ns)
+        self._sources[image_path.name] = source
+
+        return source[0]
+
+    def get_status(self, image_path: Path) -> str:
+        """Get the status of the mask of a source image.
+
+        Returns:
+            `fresh` if the mask is up to date, `new` if it is missing, `untracked` if it
+            is not in the manifest, `params` if it was generated with other parameters,
+            or `changed` if its source image changed.
+        """
+        entry = self.entries.get(image_path.name)
+        if not (self.masks_path / image_path.name).is_file():
+            return "new"
+        if entry is None:
+            return "untracked"
+        if entry["params"] != self.params_hash:
+            return "params"
+        if self.source_hash(image_path) != entry["hash"]:
+            return "changed"
+
+        # Keep the size and modification time of an image which was touched but did
+        # not change, so that it is not hashed again
+        entry["size"], entry["mtime_ns"] = self._sources[image_path.name][1:]
+        return "fresh"
+
+    def record(self, image_path: Path) -> None:
+        """Record that the mask of a source image is saved with the current parameters."""
+        if image_path.name not in self._sources:
+            self.source_hash(image_path)
+        source_hash, size, mtime_ns = self._sources[image_path.name]
+
+        entry = {
+            "name": image_path.name,
+            "hash": source_hash,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "params": self.params_hash,
+        }
+        self.entries[image_path.name] = entry
+        with self.manifest_path.open("a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+
+    def adopt(self, image_path: Path) -> bool:
+        """Record an existing mask as generated from its source image with the current
+        parameters, if the mask is newer than the image.
+
+        Returns:
+            Whether the mask was adopted.
+        """
+        mask_path = self.masks_path / image_path.name
+        if mask_path.stat().st_mtime_ns < Path(image_path).stat().st_mtime_ns:
+            return False
+
+        self.record(image_path)
+        return True
+
+    def compact(self) -> None:
+        """Rewrite the manifest with a single line per image, dropping the lines of the
+        images whose latest line supersedes them and any line cut short by a crash.
+        Called before a new run appends to the manifest."""
+        tmp_path = self.masks_path / f".{MASK_MANIFEST_FILE}.tmp"
+        with tmp_path.open("w") as f:
+            for name in sorted(self.entries):
+                f.write(json.dumps(self.entries[name]) + "\n")
+        os.replace(tmp_path, self.manifest_path)
+
+    def get_stale(
+        self, image_paths: List[Path], adopt: bool = False
+    ) -> Tuple[List[Path], Dict[str, int]]:
+        """Get the source images whose masks are out of date.
+
+        Args:
+            image_paths: The paths to the source images.
+            adopt: Whether to adopt the `untracked` masks newer than their source
+                image, e.g. those of a library masked before the manifest existed,
+                instead of generating them again.
+
+        Returns:
+            The paths to the images whose masks are neither `fresh` nor `adopted`, and
+            the number of images of each status.
+        """
+        stale: List[Path] = []
+        counts: Dict[str, int] = {}
+        for image_path in image_paths:
+            status = self.get_status(image_path)
+            if status == "untracked" and adopt and self.adopt(image_path):
+                status = "adopted"
+            counts[status] = counts.get(status, 0) + 1
+            if status not in ("fresh", "adopted"):
+                stale.append(image_path)
+
+        return stale, counts
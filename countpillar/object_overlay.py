@@ -1,21 +1,27 @@
+import math
 from typing import List, Optional, Tuple
 
 import numpy as np
 
+from countpillar.random_utils import get_rng
 
-def generate_random_bg(height: int, width: int) -> np.ndarray:
+
+def generate_random_bg(
+    height: int, width: int, rng: Optional[np.random.Generator] = None
+) -> np.ndarray:
     """Generate a random background image.
 
     Args:
         height (int): height of the background image.
         width (int): width of the background image.
+        rng (np.random.Generator, optional): random generator to draw the color from.
 
     Returns:
         np.ndarray: random background image.
     """
 
     # Generate a random color for the background
-    background_color = np.random.randint(0, 256, size=(3,)).tolist()
+    background_color = get_rng(rng).integers(0, 256, size=(3,)).tolist()
 
     # Create a black background image
     background_image = np.zeros((height, width, 3), np.uint8)
@@ -26,6 +32,49 @@ def generate_random_bg(height: int, width: int) -> np.ndarray:
     return background_image
 
 
+def get_mask_dtype(max_pills: int) -> np.dtype:
+    """Get the smallest unsigned integer type of a composition mask which can hold the
+    indices of `max_pills` pills, e.g. uint8 up to 255 pills and uint16 up to 65535.
+
+    Args:
+        max_pills (int): maximum number of pills in the composition.
+
+    Returns:
+        np.dtype: data type of the composition mask.
+    """
+    return np.min_scalar_type(max(max_pills, 1))
+
+
+def get_pill_roi(
+    bg_shape: Tuple[int, ...], pill_shape: Tuple[int, ...], x: int, y: int
+) -> Optional[Tuple[Tuple[slice, slice], Tuple[slice, slice]]]:
+    """Get the region of the background covered by a pill placed at (x, y).
+
+    Args:
+        bg_shape (Tuple[int, ...]): shape of the background image.
+        pill_shape (Tuple[int, ...]): shape of the pill image.
+        x (int): x coordinate of the top left corner of the pill object.
+        y (int): y coordinate of the top left corner of the pill object.
+
+    Returns:
+        The (rows, cols) slices of the background image and the matching (rows, cols)
+        slices of the pill image, clipped to the frame of the background image, or
+        None if the pill lies entirely outside of the background image.
+    """
+    h_bg, w_bg = bg_shape[:2]
+    h_pill, w_pill = pill_shape[:2]
+
+    y0, y1 = max(y, 0), min(y + h_pill, h_bg)
+    x0, x1 = max(x, 0), min(x + w_pill, w_bg)
+    if y0 >= y1 or x0 >= x1:
+        return None
+
+    bg_roi = (slice(y0, y1), slice(x0, x1))
+    pill_roi = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+
+    return bg_roi, pill_roi
+
+
 def add_pill_on_bg(
     img_bg: np.ndarray,
     mask_comp: np.ndarray,
@@ -35,15 +84,16 @@ def add_pill_on_bg(
     y: int,
     idx: int,
 ) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray], bool]:
-    """Add the pill object to the background image.
+    """Add the pill object to the background image. The background image and its mask
+    are modified in place, and only within the region returned by `get_pill_roi`.
 
     Args:
         img_bg (np.ndarray): background image.
         mask_comp (np.ndarray): mask of the background image.
         img_pill (np.ndarray): pill image.
         mask_pill (np.ndarray): binary mask of the pill
-        x (int): x coordinate of the center of the pill object.
-        y (int): y coordinate of the center of the pill object.
+        x (int): x coordinate of the top left corner of the pill object.
+        y (int): y coordinate of the top left corner of the pill object.
         idx (int): index of the pill object.
 
     Returns:
@@ -52,89 +102,31 @@ def add_pill_on_bg(
         - the mask of the last pill image, and
         - whether the pill object was successfully added to the background image.
     """
-    h_bg, w_bg = img_bg.shape[:2]
-    h_pill, w_pill = img_pill.shape[:2]
     mask_added: Optional[np.ndarray] = None
     success: bool = False
 
-    # Convert to RGB mask
-    mask_b = mask_pill == 1
-    mask_rgb_b = np.stack([mask_b, mask_b, mask_b], axis=2)
-
-    if (x >= 0 and y >= 0) and (x < w_bg and y < h_bg):
-        # part of the image which gets into the frame of img_bg along y-axis
-        h_part = h_pill - max(0, y + h_pill - h_bg)
-        # part of the image which gets into the frame of img_bg along x-axis
-        w_part = w_pill - max(0, x + w_pill - w_bg)
-
-        # Add the pill object to the background image and compose the mask
-        img_bg[y : y + h_part, x : x + w_part, :] = (
-            img_bg[y : y + h_part, x : x + w_part, :]
-            * (~mask_rgb_b[:h_part, :w_part, :])
-            + (img_pill * mask_rgb_b)[:h_part, :w_part, :]
-        )
-        mask_comp[y : y + h_part, x : x + w_part] = (
-            mask_comp[y : y + h_part, x : x + w_part] * (~mask_b[:h_part, :w_part])
-            + (idx * mask_b)[:h_part, :w_part]
-        )
-        mask_added = mask_pill[:h_part, :w_part]
-        success = True
-
-    elif (x < 0 and y < 0) and (x + w_pill > 0 and y + h_pill > 0):
-        h_part = h_pill + y
-        w_part = w_pill + x
-
-        img_bg[:h_part, :w_part, :] = (
-            img_bg[:h_part, :w_part, :]
-            * (~mask_rgb_b[h_pill - h_part : h_pill, w_pill - w_part : w_pill, :])
-            + (img_pill * mask_rgb_b)[
-                h_pill - h_part : h_pill, w_pill - w_part : w_pill, :
-            ]
-        )
-        mask_comp[:h_part, :w_part] = (
-            mask_comp[:h_part, :w_part]
-            * (~mask_b[h_pill - h_part : h_pill, w_pill - w_part : w_pill])
-            + (idx * mask_b)[h_pill - h_part : h_pill, w_pill - w_part : w_pill]
-        )
-        mask_added = mask_pill[h_pill - h_part : h_pill, w_pill - w_part : w_pill]
-        success = True
-
-    elif (x < 0 and y >= 0) and (x + w_pill > 0 and y < h_bg):
-        h_part = h_pill - max(0, y + h_pill - h_bg)
-        w_part = w_pill + x
-
-        img_bg[y : y + h_part, :w_part, :] = (
-            img_bg[y : y + h_part, :w_part, :]
-            * (~mask_rgb_b[:h_part, w_pill - w_part : w_pill, :])
-            + (img_pill * mask_rgb_b)[:h_part, w_pill - w_part : w_pill, :]
-        )
-        mask_comp[y : y + h_part, :w_part] = (
-            mask_comp[y : y + h_part, :w_part]
-            * (~mask_b[:h_part, w_pill - w_part : w_pill])
-            + (idx * mask_b)[:h_part, w_pill - w_part : w_pill]
+    if idx > np.iinfo(mask_comp.dtype).max:
+        raise ValueError(
+            f"Pill index {idx} does not fit in a {mask_comp.dtype} composition mask."
+            " Use `get_mask_dtype` to allocate the mask."
         )
-        mask_added = mask_pill[:h_part, w_pill - w_part : w_pill]
-        success = True
 
-    elif (x >= 0 and y < 0) and (x < w_bg and y + h_pill > 0):
-        h_part = h_pill + y
-        w_part = w_pill - max(0, x + w_pill - w_bg)
+    roi = get_pill_roi(img_bg.shape, img_pill.shape, x, y)
+    if roi is not None:
+        bg_roi, pill_roi = roi
 
-        img_bg[:h_part, x : x + w_part, :] = (
-            img_bg[:h_part, x : x + w_part, :]
-            * (~mask_rgb_b[h_pill - h_part : h_pill, :w_part, :])
-            + (img_pill * mask_rgb_b)[h_pill - h_part : h_pill, :w_part, :]
-        )
-        mask_comp[:h_part, x : x + w_part] = (
-            mask_comp[:h_part, x : x + w_part]
-            * (~mask_b[h_pill - h_part : h_pill, :w_part])
-            + (idx * mask_b)[h_pill - h_part : h_pill, :w_part]
-        )
-        mask_added = mask_pill[h_pill - h_part : h_pill, :w_part]
+        # Add the part of the pill object which gets into the frame of img_bg to the
+        # background image and compose the mask
+        mask_b = mask_pill[pill_roi] == 1
+        img_bg[bg_roi][mask_b] = img_pill[pill_roi][mask_b]
+        mask_comp[bg_roi][mask_b] = idx
+        mask_added = mask_pill[pill_roi]
         success = True
 
-    # Check if the pill was added successfully within the frame of the background image
-    if success and (idx != np.unique(mask_comp).max()):
+    # Check if the pill was added successfully within the frame of the background
+    # image. Only the pill's region can hold the new index, as idx is expected to be
+    # greater than every index already in mask_comp.
+    if success and not np.any(mask_comp[bg_roi] == idx):
         success = False
 
     return img_bg, mask_comp, mask_added, success
@@ -158,7 +150,7 @@ def verify_overlap(
     if len(pill_areas) == 0:
         return True
 
-    pill_ids = np.unique(mask_comp).astype(np.uint8)[1:-1]
+    pill_ids = np.unique(mask_comp)[1:-1]
     masks = mask_comp == pill_ids[:, None, None]
 
     if len(np.unique(mask_comp)) != np.max(mask_comp) + 1:
@@ -171,3 +163,175 @@ def verify_overlap(
             break
 
     return overlap
+
+
+class OverlapTracker:
+    """Keep track of the visible area of every pill in a composition, so that the
+    overlap of a new pill can be verified from the pill's region alone.
+
+    This gives the same decision as `verify_overlap`, but without scanning the whole
+    composition mask: the labels a new pill covers are counted with a bincount over
+    its region and subtracted from the visible-pixel counters of the pills they belong
+    to. Only those pills can have become more occluded, so only they are checked.
+    """
+
+    def __init__(self, overlap_degree: float = 0.3) -> None:
+        self.overlap_degree = overlap_degree
+        self.pill_areas: List[int] = []
+
+        # Areas and visible-pixel counts indexed by pill index (0 is the background)
+        self._areas = np.zeros(16, dtype=np.int64)
+        self._visible = np.zeros(16, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.pill_areas)
+
+    def add(self, covered_labels: np.ndarray, mask_added: np.ndarray) -> bool:
+        """Try to add the next pill, whose index is ``len(self) + 1``.
+
+        Args:
+            covered_labels (np.ndarray): region of the composition mask covered by the
+                pill, as it was before the pill was added.
+            mask_added (np.ndarray): binary mask of the pill, clipped to that region.
+
+        Returns:
+            bool: True if none of the previous pills overlaps more than overlap_degree
+            with the new pill, in which case the pill is recorded, False otherwise.
+        """
+        mask_b = mask_added == 1
+        n_labels = len(self.pill_areas) + 1
+
+        # Count the visible pixels of each previous pill hidden by the new pill. A
+        # bincount also costs O(number of pills), so in high-density scenes with more
+        # pills than covered pixels the covered labels are sorted instead.
+        covered = covered_labels[mask_b]
+        covered = covered[covered > 0]
+        if n_labels <= len(covered):
+            counts = np.bincount(covered)
+            ids = np.flatnonzero(counts)
+            counts = counts[ids]
+        else:
+            ids, counts = np.unique(covered, return_counts=True)
+        visible = self._visible[ids] - counts
+
+        if np.any(visible == 0) or np.any(
+            visible / self._areas[ids] < 1 - self.overlap_degree
+        ):
+            return False
+
+        self._visible[ids] = visible
+        if n_labels == len(self._areas):
+            self._areas = np.resize(self._areas, 2 * n_labels)
+            self._visible = np.resize(self._visible, 2 * n_labels)
+        self._areas[n_labels] = np.count_nonzero(mask_added)
+        self._visible[n_labels] = np.count_nonzero(mask_b)
+        self.pill_areas.append(int(self._areas[n_labels]))
+
+        return True
+
+
+class OccupancyGrid:
+    """Coarse map of the pixels covered by pills in a composition, counted per cell.
+
+    It is used to cheaply estimate how much of a candidate pill's footprint is already
+    taken by other pills, so that hopeless candidates can be rejected before resizing,
+    augmenting and compositing the pill, and to draw candidate positions from the free
+    space of the composition.
+    """
+
+    def __init__(self, shape: Tuple[int, ...], cell_size: int = 32) -> None:
+        self.shape = shape[:2]
+        self.cell_size = cell_size
+
+        h, w = self.shape
+        n_rows, n_cols = math.ceil(h / cell_size), math.ceil(w / cell_size)
+        self.counts = np.zeros((n_rows, n_cols), dtype=np.int64)
+
+        # Number of pixels in each cell, smaller along the bottom and right edges
+        cell_h = np.minimum(cell_size, h - cell_size * np.arange(n_rows))
+        cell_w = np.minimum(cell_size, w - cell_size * np.arange(n_cols))
+        self.cell_areas = np.outer(cell_h, cell_w)
+
+    def _cells(
+        self, x0: int, y0: int, x1: int, y1: int
+    ) -> Optional[Tuple[slice, slice]]:
+        """Get the cells overlapping the pixels [y0, y1) x [x0, x1) of the frame."""
+        h, w = self.shape
+        x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)
+        if x0 >= x1 or y0 >= y1:
+            return None
+
+        c = self.cell_size
+        return slice(y0 // c, math.ceil(y1 / c)), slice(x0 // c, math.ceil(x1 / c))
+
+    def update(self, mask_comp: np.ndarray, bg_roi: Tuple[slice, slice]) -> None:
+        """Recount the covered pixels of the cells overlapping a region of the frame.
+
+        Args:
+            mask_comp (np.ndarray): mask of the background image composition.
+            bg_roi (Tuple[slice, slice]): the region of the frame which has changed.
+        """
+        cells = self._cells(
+            bg_roi[1].start, bg_roi[0].start, bg_roi[1].stop, bg_roi[0].stop
+        )
+        if cells is None:
+            return
+
+        c = self.cell_size
+        rows, cols = cells
+        block = (
+            mask_comp[rows.start * c : rows.stop * c, cols.start * c : cols.stop * c]
+            > 0
+        )
+        pad_h, pad_w = (-block.shape[0]) % c, (-block.shape[1]) % c
+        if pad_h or pad_w:
+            block = np.pad(block, ((0, pad_h), (0, pad_w)))
+
+        n_rows, n_cols = rows.stop - rows.start, cols.stop - cols.start
+        self.counts[cells] = block.reshape(n_rows, c, n_cols, c).sum(axis=(1, 3))
+
+    def occupancy(self, x: int, y: int, height: int, width: int) -> float:
+        """Estimate the fraction of a footprint which is already covered by pills.
+
+        Args:
+            x (int): x coordinate of the top left corner of the footprint.
+            y (int): y coordinate of the top left corner of the footprint.
+            height (int): height of the footprint.
+            width (int): width of the footprint.
+
+        Returns:
+            float: the covered fraction of the cells overlapping the footprint.
+        """
+        cells = self._cells(x, y, x + width, y + height)
+        if cells is None:
+            return 0.0
+
+        return float(self.counts[cells].sum() / self.cell_areas[cells].sum())
+
+    def sample_free(self, rng: Optional[np.random.Generator] = None) -> Tuple[int, int]:
+        """Draw a position from the free space of the frame: a cell is drawn with a
+        probability proportional to the square of its number of uncovered pixels, which
+        favors the empty regions over the gaps between pills, and the position is drawn
+        uniformly within the cell.
+
+        Args:
+            rng (np.random.Generator, optional): random generator to draw from.
+
+        Returns:
+            Tuple[int, int]: the (x, y) coordinates of the position.
+        """
+        rng = get_rng(rng)
+        free = np.cumsum((self.cell_areas - self.counts) ** 2)
+        if free[-1] <= 0:
+            h, w = self.shape
+            return int(rng.integers(w)), int(rng.integers(h))
+
+        cell = int(np.searchsorted(free, rng.random() * free[-1], side="right"))
+        row, col = divmod(cell, self.counts.shape[1])
+        y = row * self.cell_size + rng.integers(
+            min(self.cell_size, self.shape[0] - row * self.cell_size)
+        )
+        x = col * self.cell_size + rng.integers(
+            min(self.cell_size, self.shape[1] - col * self.cell_size)
+        )
+        return int(x), int(y)
@@ -0,0 +1,336 @@
+import csv
+import io
+import os
+import queue
+import tarfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Container, Dict, List, Optional, Sequence, Tuple, Union
+
+import cv2
+import numpy as np
+
+from countpillar.telemetry import time_stage
+
+SHARDS_DIR = "shards"
+
+# Encoder parameter set by the quality of each image format: the JPEG and WebP quality
+# from 0 to 100, and the PNG compression level from 0 to 9
+IMAGE_QUALITY_PARAMS = {
+    "jpg": cv2.IMWRITE_JPEG_QUALITY,
+    "png": cv2.IMWRITE_PNG_COMPRESSION,
+    "webp": cv2.IMWRITE_WEBP_QUALITY,
+}
+
+# Format of the class, x center, y center, width and height columns of YOLO labels
+YOLO_LABEL_FORMAT = ["%d", "%g", "%g", "%g", "%g"]
+
+# Columns of the index written next to every tar shard
+SHARD_INDEX_FIELDS = ["key", "member", "offset", "size"]
+
+
+def format_yolo_annotations(annotations: Sequence[Sequence[float]]) -> str:
+    """Format YOLO annotations as the text of a label file, one object per line.
+
+    Args:
+        annotations: The YOLO annotations, as returned by `create_yolo_annotations`.
+
+    Returns:
+        The text of the label file.
+    """
+    if len(annotations) == 0:
+        return ""
+
+    buffer = io.StringIO()
+    np.savetxt(buffer, np.asarray(annotations, dtype=float), fmt=YOLO_LABEL_FORMAT)
+    return buffer.getvalue()
+
+
+def encode_image(
+    img: np.ndarray, image_format: str = "jpg", quality: Optional[int] = None
+) -> bytes:
+    """Encode an RGB image.
+
+    Args:
+        img: The RGB image.
+        image_format: The image format, one of `IMAGE_QUALITY_PARAMS`.
+        quality: The JPEG or WebP quality, or the PNG compression level. The OpenCV
+            default of the format is used if None.
+
+    Returns:
+        The encoded image.
+    """
+    params = [] if quality is None else [IMAGE_QUALITY_PARAMS[image_format], quality]
+    success, encoded = cv2.imencode(
+        f".{image_format}", cv2.cvtColor(img, cv2.COLOR_RGB2BGR), params
+    )
+    if not success:
+        raise ValueError(f"Failed to encode the image as {image_format}.")
+
+    return encoded.tobytes()
+
+
+def get_shard_name(shard_id: int) -> str:
+    """Get the file name of the tar shard with the given number."""
+    return f"shard-{shard_id:06d}.tar"
+
+
+def write_file_atomic(path: Path, data: bytes) -> None:
+    """Write a file under a temporary name and then rename it, so that the file is
+    either complete or missing, even if the process is killed while writing it."""
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+class FileWriter:
+    """Write each sample as an image file in `images/` and a label file in `labels/`."""
+
+    def __init__(self, output_folder: Path) -> None:
+        self.output_folder = Path(output_folder)
+        (self.output_folder / "images").mkdir(parents=True, exist_ok=True)
+        (self.output_folder / "labels").mkdir(parents=True, exist_ok=True)
+
+    def write(
+        self, key: str, image: bytes, labels: str, image_ext: str = "jpg"
+    ) -> None:
+        """Write the encoded image and the label text of a sample.
+
+        Args:
+            key: The name of the sample, without extension.
+            image: The encoded image.
+            labels: The text of the label file.
+            image_ext: The extension of the image file.
+        """
+        write_file_atomic(self.output_folder / "labels" / f"{key}.txt", labels.encode())
+        write_file_atomic(self.output_folder / "images" / f"{key}.{image_ext}", image)
+
+    def close(self) -> None:
+        pass
+
+
+class TarShardWriter:
+    """Stream samples into a single WebDataset-style tar shard.
+
+    Each sample is stored as two consecutive members sharing the sample key, the
+    encoded image and its label file, so the shard can be read sequentially by
+    WebDataset. A CSV index with the offset and size of the data of every member is
+    written next to the shard, so any single file can also be read back with one seek.
+
+    The shard is written under a temporary name and only renamed once its index is
+    written on `close`, so an interrupted job never leaves a truncated shard behind.
+    """
+
+    def __init__(self, output_folder: Path, shard_id: int) -> None:
+        shards_dir = Path(output_folder) / SHARDS_DIR
+        shards_dir.mkdir(parents=True, exist_ok=True)
+        self.path = shards_dir / get_shard_name(shard_id)
+        self.index_path = self.path.with_suffix(".csv")
+
+        self._tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        self._tar: Optional[tarfile.TarFile] = tarfile.open(self._tmp_path, "w")
+        self._index: List[Tuple[str, str, int, int]] = []
+
+    def __len__(self) -> int:
+        return len(self._index) // 2
+
+    def _add(self, key: str, name: str, data: bytes) -> None:
+        assert self._tar is not None, "The shard is already closed."
+
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+
+        # The data of the member ends the archive so far, padded to whole blocks
+        n_blocks = -(-info.size // tarfile.BLOCKSIZE)
+        offset = self._tar.offset - n_blocks * tarfile.BLOCKSIZE
+        self._index.append((key, name, offset, info.size))
+
+    def write(
+        self, key: str, image: bytes, labels: str, image_ext: str = "jpg"
+    ) -> None:
+        """Append the encoded image and the label text of a sample to the shard.
+
+        Args:
+            key: The name of the sample, without extension.
+            image: The encoded image.
+            labels: The text of the label file.
+            image_ext: The extension of the image file.
+        """
+        self._add(key, f"{key}.{image_ext}", image)
+        self._add(key, f"{key}.txt", labels.encode())
+
+    def close(self) -> None:
+        """Finish the shard and write its index."""
+        if self._tar is None:
+            return
+
+        self._tar.close()
+        self._tar = None
+        with self.index_path.open("w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(SHARD_INDEX_FIELDS)
+            writer.writerows(self._index)
+        os.replace(self._tmp_path, self.path)
+
+
+def remove_partial_outputs(output_folder: Path, completed: Container[int]) -> int:
+    """Remove what an interrupted job left of the samples it did not complete: the
+    temporary files of unfinished writes and shards, and the image and label files of
+    samples whose indices are not in `completed`.
+
+    Args:
+        output_folder: The output folder of the job.
+        completed: The indices of the completed samples.
+
+    Returns:
+        The number of removed files.
+    """
+    n_removed = 0
+    for subdir in ("images", "labels", SHARDS_DIR):
+        folder = Path(output_folder) / subdir
+        if not folder.is_dir():
+            continue
+
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith(".") and name.endswith(".tmp"):
+                    partial = True
+                elif subdir == SHARDS_DIR:
+                    partial = False
+                else:
+                    idx = name.split("_", 1)[0]
+                    partial = not idx.isdigit() or int(idx) not in completed
+                if partial:
+                    os.remove(entry.path)
+                    n_removed += 1
+
+    return n_removed
+
+
+def read_shard_member(shard_path: Path, offset: int, size: int) -> bytes:
+    """Read a single file of a tar shard, at the offset and size given by its index.
+
+    Args:
+        shard_path: The path to the tar shard.
+        offset: The offset of the data of the file in the shard.
+        size: The size of the file.
+
+    Returns:
+        The content of the file.
+    """
+    with Path(shard_path).open("rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+class AsyncWriter:
+    """Encode and save samples in background threads, while the caller goes on
+    composing the next samples.
+
+    The images are encoded by a pool of threads, as OpenCV releases the GIL while
+    encoding, and a single writer thread saves the encoded samples in submission order,
+    so that tar shards are identical to those written synchronously. At most
+    `max_pending` samples are queued: `submit` blocks once the queue is full, which
+    bounds the memory held by pending images.
+
+    With `n_threads=0`, every sample is encoded and saved synchronously by `submit`.
+
+    If `timings` is provided, the time `submit` waits for room in the queue and the
+    time spent encoding and saving the samples are added to its `queue_wait`, `encode`
+    and `write` stages. The encoding time is summed over the threads.
+    """
+
+    def __init__(
+        self,
+        writer: Union[FileWriter, TarShardWriter],
+        image_format: str = "jpg",
+        quality: Optional[int] = None,
+        n_threads: int = 2,
+        max_pending: int = 16,
+        timings: Optional[Dict[str, float]] = None,
+    ) -> None:
+        self.writer = writer
+        self.image_format = image_format
+        self.quality = quality
+        self.timings = timings
+        self._timings_lock = threading.Lock()
+
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        self._queue: "queue.Queue[Optional[Tuple[str, Future, str]]]" = queue.Queue(
+            max(max_pending, 1)
+        )
+        if n_threads > 0:
+            self._pool = ThreadPoolExecutor(n_threads)
+            self._thread = threading.Thread(target=self._write_loop, daemon=True)
+            self._thread.start()
+
+    def _encode(self, img: np.ndarray) -> bytes:
+        if self.timings is None:
+            return encode_image(img, self.image_format, self.quality)
+
+        # The pool threads encode concurrently, so they add up their timings in turn
+        start = time.perf_counter()
+        image = encode_image(img, self.image_format, self.quality)
+        elapsed = time.perf_counter() - start
+        with self._timings_lock:
+            self.timings["encode"] = self.timings.get("encode", 0.0) + elapsed
+        return image
+
+    def _write(self, key: str, image: bytes, labels: str) -> None:
+        with time_stage(self.timings, "write"):
+            self.writer.write(key, image, labels, self.image_format)
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            key, image, labels = item
+
+            # Keep draining the queue after an error, so that `submit` never blocks
+            if self._error is None:
+                try:
+                    self._write(key, image.result(), labels)
+                except BaseException as e:
+                    self._error = e
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise RuntimeError("Failed to save a sample.") from self._error
+
+    def submit(
+        self, key: str, img: np.ndarray, annotations: Sequence[Sequence[float]]
+    ) -> None:
+        """Queue a sample to be encoded and saved, waiting for room in the queue.
+
+        Args:
+            key: The name of the sample, without extension.
+            img: The RGB image of the sample, which must not be modified afterwards.
+            annotations: The YOLO annotations of the sample.
+        """
+        labels = format_yolo_annotations(annotations)
+        if self._pool is None:
+            self._write(key, self._encode(img), labels)
+            return
+
+        self._raise_error()
+        future = self._pool.submit(self._encode, img)
+        with time_stage(self.timings, "queue_wait"):
+            self._queue.put((key, future, labels))
+
+    def close(self) -> None:
+        """Wait for all the queued samples to be saved and close the writer."""
+        if self._pool is not None and self._thread is not None:
+            with time_stage(self.timings, "queue_wait"):
+                self._queue.put(None)
+                self._thread.join()
+            self._pool.shutdown()
+            self._pool, self._thread = None, None
+        self._raise_error()
+        self.writer.close()
@@ -0,0 +1,106 @@
+import random
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+import numpy as np
+
+# Independent families of random streams derived from the seed of a dataset
+SAMPLE_STREAM: int = 0
+SPRITE_STREAM: int = 1
+SCHEDULE_STREAM: int = 2
+
+
+def get_rng(rng: Optional[np.random.Generator] = None) -> np.random.Generator:
+    """Get the random generator to draw from.
+
+    Args:
+        rng: The generator passed by the caller, if any.
+
+    Returns:
+        `rng` if provided, otherwise a new generator seeded from the global numpy random
+        state, so that `np.random.seed` keeps controlling calls made without one.
+    """
+    if rng is not None:
+        return rng
+
+    return np.random.default_rng(np.random.randint(0, 2**32, dtype=np.int64))
+
+
+def get_sample_rng(seed: int, idx: int) -> np.random.Generator:
+    """Get the random generator of a single sample of a dataset. The streams of the
+    samples of a seed are independent of each other, so that any sample can be
+    regenerated on its own, in any process and in any order.
+
+    Args:
+        seed: The seed of the dataset.
+        idx: The index of the sample.
+
+    Returns:
+        The random generator of the sample.
+    """
+    return np.random.default_rng(
+        np.random.SeedSequence(seed, spawn_key=(SAMPLE_STREAM, idx))
+    )
+
+
+def get_sprite_rng(seed: int, key: int, generation: int = 0) -> np.random.Generator:
+    """Get the random generator used to transform a pill sprite, independent of the
+    generators of the samples.
+
+    Args:
+        seed: The seed of the dataset.
+        key: The index of the sprite in the pill library.
+        generation: The generation of the variants of the sprite.
+
+    Returns:
+        The random generator of the sprite.
+    """
+    return np.random.default_rng(
+        np.random.SeedSequence(seed, spawn_key=(SPRITE_STREAM, key, generation))
+    )
+
+
+def get_schedule_rng(seed: int, block: int) -> np.random.Generator:
+    """Get the random generator used to plan a block of samples of a dataset,
+    independent of the generators of the samples.
+
+    Args:
+        seed: The seed of the dataset.
+        block: The index of the block of samples.
+
+    Returns:
+        The random generator of the block.
+    """
+    return np.random.default_rng(
+        np.random.SeedSequence(seed, spawn_key=(SCHEDULE_STREAM, block))
+    )
+
+
+@contextmanager
+def seed_augmentations(augmentations: Any, rng: np.random.Generator) -> Iterator[None]:
+    """Seed an albumentations pipeline from a random generator, for the calls made
+    within the context.
+
+    Recent albumentations versions keep their own random state, which is seeded with
+    `set_random_seed`. Older ones draw from the global `random` and numpy random states,
+    which are then seeded within the context only, and restored on exit so that the
+    random state of the caller is left untouched.
+
+    Args:
+        augmentations: The augmentation pipeline.
+        rng: The random generator to draw the seed from.
+    """
+    seed = int(rng.integers(0, 2**32))
+    if hasattr(augmentations, "set_random_seed"):
+        augmentations.set_random_seed(seed)
+        yield
+        return
+
+    random_state, np_random_state = random.getstate(), np.random.get_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(random_state)
+        np.random.set_state(np_random_state)
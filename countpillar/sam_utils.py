@@ -1,18 +1,120 @@
-from typing import List, Tuple, Union
+import threading
+from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
 from PIL import Image
 from transformers import SamModel, SamProcessor
 
-HUB_MODEL_ID = "facebook/sam-vit-huge"
+from countpillar.embedding_cache import EmbeddingCache, get_embedding_key
 
-device = (
-    torch.device("mps") if torch.backends.mps.is_available() else torch.device("cpu")
-)
-MODEL_MPS = SamModel.from_pretrained(HUB_MODEL_ID).to(device)
-MODEL_CPU = SamModel.from_pretrained(HUB_MODEL_ID).to("cpu")
-PROCESSOR = SamProcessor.from_pretrained(HUB_MODEL_ID)
+# Hugging Face Hub checkpoints of the SAM model, by size of the image encoder
+SAM_CHECKPOINTS: Dict[str, str] = {
+    "base": "facebook/sam-vit-base",
+    "large": "facebook/sam-vit-large",
+    "huge": "facebook/sam-vit-huge",
+}
+DEFAULT_CHECKPOINT = "huge"
+
+
+def get_default_device() -> torch.device:
+    """Get the fastest available device: a CUDA GPU, Apple silicon, or the CPU."""
+    if torch.cuda.is_available():
+        return torch.device("cuda")
+    if torch.backends.mps.is_available():
+        return torch.device("mps")
+
+    return torch.device("cpu")
+
+
+class SamHolder:
+    """Holder of a single SAM model and its processor, which are only downloaded and
+    loaded the first time they are used, so that importing this module, or starting a
+    worker process which never runs SAM, costs nothing.
+
+    The model is the `checkpoint` size of `SAM_CHECKPOINTS`, and runs on `device`, the
+    fastest available device by default. Both the image encoder and the mask decoder
+    run on this single copy of the model.
+    """
+
+    def __init__(
+        self,
+        checkpoint: str = DEFAULT_CHECKPOINT,
+        device: Optional[Union[str, torch.device]] = None,
+    ) -> None:
+        if checkpoint not in SAM_CHECKPOINTS:
+            raise ValueError(
+                f"Unknown SAM checkpoint {checkpoint}, expected one of "
+                + ", ".join(SAM_CHECKPOINTS)
+            )
+        self.checkpoint = checkpoint
+        self.device = torch.device(device) if device else get_default_device()
+        self._model: Optional[SamModel] = None
+        self._processor: Optional[SamProcessor] = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self) -> SamModel:
+        """The SAM model, loaded on the device on first use."""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    model = SamModel.from_pretrained(SAM_CHECKPOINTS[self.checkpoint])
+                    self._model = model.to(self.device).eval()
+
+        return self._model
+
+    @property
+    def processor(self) -> SamProcessor:
+        """The SAM processor, loaded on first use."""
+        if self._processor is None:
+            with self._lock:
+                if self._processor is None:
+                    self._processor = SamProcessor.from_pretrained(
+                        SAM_CHECKPOINTS[self.checkpoint]
+                    )
+
+        return self._processor
+
+    @property
+    def is_loaded(self) -> bool:
+        """Whether the model is loaded."""
+        return self._model is not None
+
+
+# SAM model of the current process, created on first use
+_SAM: Optional[SamHolder] = None
+
+
+def configure_sam(
+    checkpoint: str = DEFAULT_CHECKPOINT,
+    device: Optional[Union[str, torch.device]] = None,
+) -> SamHolder:
+    """Select the SAM model used by this module in the current process. The model
+    which was loaded before, if any, is released unless it is the same one.
+
+    Args:
+        checkpoint: The size of the model, one of `SAM_CHECKPOINTS`.
+        device: The device to run the model on. Defaults to the fastest available one.
+
+    Returns:
+        The holder of the selected model, which is loaded on first use.
+    """
+    global _SAM
+    sam = SamHolder(checkpoint, device)
+    if _SAM is None or (_SAM.checkpoint, _SAM.device) != (sam.checkpoint, sam.device):
+        _SAM = sam
+
+    return _SAM
+
+
+def get_sam() -> SamHolder:
+    """Get the SAM model of the current process, the default one if none was selected
+    with `configure_sam`."""
+    if _SAM is None:
+        return configure_sam()
+
+    return _SAM
 
 
 def get_image_embeddings(images: List[Image.Image]) -> torch.Tensor:
@@ -24,17 +126,53 @@ def get_image_embeddings(images: List[Image.Image]) -> torch.Tensor:
     Returns:
         A tensor of shape (num_images, 256, 64, 64)
     """
-    inputs = PROCESSOR(images, return_tensors="pt")
-    image_embeddings = MODEL_MPS.get_image_embeddings(inputs["pixel_values"].to(device))
+    sam = get_sam()
+    inputs = sam.processor(images, return_tensors="pt")
+    with torch.inference_mode():
+        image_embeddings = sam.model.get_image_embeddings(
+            inputs["pixel_values"].to(sam.device)
+        )
+
+    return image_embeddings.cpu()
+
+
+def get_cached_image_embeddings(
+    images: List[np.ndarray], embedding_cache: EmbeddingCache
+) -> torch.Tensor:
+    """Get image embeddings for multiple images, only running the image encoder on the
+    images whose embeddings are not in the cache, and caching their embeddings.
+
+    Args:
+        images: A list of images. All the images must be of the same size.
+        embedding_cache: The cache of embeddings.
+
+    Returns:
+        A tensor of shape (num_images, 256, 64, 64)
+    """
+    checkpoint = get_sam().checkpoint
+    keys = [get_embedding_key(np.asarray(image), checkpoint) for image in images]
+    embeddings: List[Optional[np.ndarray]] = [embedding_cache.get(k) for k in keys]
+
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        computed = get_image_embeddings([images[i] for i in missing]).numpy()
+        for i, embedding in zip(missing, computed):
+            embedding_cache.put(keys[i], embedding)
+            embeddings[i] = embedding
 
-    return image_embeddings.cpu().detach()
+    return torch.from_numpy(np.stack(embeddings))
 
 
-def predict_masks(images: Union[np.ndarray, List[np.ndarray]]) -> List[torch.Tensor]:
+def predict_masks(
+    images: Union[np.ndarray, List[np.ndarray]],
+    embedding_cache: Optional[EmbeddingCache] = None,
+) -> List[torch.Tensor]:
     """Predict segmentation masks for each image. Return a list of masks.
 
     Args:
         images: A list of PIL images. All the images must be of the same size.
+        embedding_cache: If provided, the image embeddings are read from this cache
+            when they are in it, and are added to it otherwise.
 
     Returns:
         A list of masks. Each mask is a tensor of shape (num_masks, height, width).
@@ -52,19 +190,28 @@ def predict_masks(images: Union[np.ndarray, List[np.ndarray]]) -> List[torch.Ten
     input_points: List[List[List[int]]] = [[list(center)]] * num_images
 
     # Pre-process the images and the input points
-    inputs = PROCESSOR(images, input_points=input_points, return_tensors="pt")
-    image_embeddings = get_image_embeddings(images)
+    sam = get_sam()
+    inputs = sam.processor(images, input_points=input_points, return_tensors="pt")
+    image_embeddings = (
+        get_image_embeddings(images)
+        if embedding_cache is None
+        else get_cached_image_embeddings(images, embedding_cache)
+    )
 
     # pop the pixel_values as they are not neded
     inputs.pop("pixel_values", None)
-    inputs.update({"image_embeddings": image_embeddings})
 
-    # run the model in inference mode
+    # run the prompt encoder and mask decoder on the device of the image encoder,
+    # in single precision as some devices, e.g. MPS, do not support float64
+    prompt_inputs = {
+        "input_points": inputs["input_points"].to(sam.device, torch.float32),
+        "image_embeddings": image_embeddings.to(sam.device),
+    }
     with torch.inference_mode():
-        outputs = MODEL_CPU(**inputs)
+        outputs = sam.model(**prompt_inputs)
 
     # post-process the masks to get the predicted masks
-    masks: List[torch.Tensor] = PROCESSOR.image_processor.post_process_masks(
+    masks: List[torch.Tensor] = sam.processor.image_processor.post_process_masks(
         outputs.pred_masks.cpu(),
         inputs["original_sizes"].cpu(),
         inputs["reshaped_input_sizes"].cpu(),
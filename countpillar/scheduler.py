@@ -0,0 +1,142 @@
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from countpillar.random_utils import get_schedule_rng
+
+# How the number of pills and the pill types of the samples are chosen
+SCHEDULES = ("random", "stratified")
+
+
+def get_count_bins(
+    min_pills: int, max_pills: int, n_bins: int
+) -> List[Tuple[int, int]]:
+    """Split the range of pill counts into bins of nearly equal widths.
+
+    Args:
+        min_pills: The minimum number of pills per image.
+        max_pills: The maximum number of pills per image.
+        n_bins: The number of bins, at most the number of pill counts.
+
+    Returns:
+        The inclusive lower and upper pill count of each bin.
+    """
+    n_bins = max(1, min(n_bins, max_pills - min_pills + 1))
+    edges = np.linspace(min_pills, max_pills + 1, n_bins + 1).round().astype(int)
+    return [(int(lo), int(hi) - 1) for lo, hi in zip(edges[:-1], edges[1:])]
+
+
+def get_block_quotas(weights: np.ndarray, block_size: int) -> np.ndarray:
+    """Get the number of samples of each cell in a block of samples, proportionally to
+    the target weights of the cells, rounding with the largest remainder method.
+
+    Args:
+        weights: The target weights of the cells.
+        block_size: The number of samples per block.
+
+    Returns:
+        The number of samples of each cell, which add up to `block_size`.
+    """
+    shares = block_size * weights / weights.sum()
+    quotas = np.floor(shares).astype(int)
+    remainders = np.argsort(quotas - shares, kind="stable")
+    quotas[remainders[: block_size - quotas.sum()]] += 1
+
+    return quotas
+
+
+class CoverageScheduler:
+    """Plan the number of pills and the mix of pill types of every sample, so that a
+    dataset covers every cell of pill count bins x number of pill types evenly.
+
+    Drawing the pill count uniformly and splitting it between the types with
+    `random_partition` covers the cells very unevenly: the first type tends to take
+    most of the pills, so the images with several types in similar numbers are rare.
+    Instead, the samples are split into consecutive blocks of `block_size` indices,
+    and each block holds every cell in proportion to its target weight, in an order
+    shuffled per block. The pill count of a sample is then drawn uniformly within its
+    bin, and split into the number of types of its cell, each with at least one pill,
+    uniformly over all the possible splits.
+
+    The cells are the `n_count_bins` bins of nearly equal widths between `min_pills`
+    and `max_pills`, times the number of pill types, from 1 to `n_pill_types`. They
+    are targeted equally unless `weights` gives the weight of each cell, in the order
+    of `cells`. The blocks hold as many samples as there are cells by default, so that
+    every cell is covered exactly once per block.
+
+    The cell of a sample only depends on the seed and its index, so that any sample
+    can still be generated on its own, in any process and in any order.
+    """
+
+    def __init__(
+        self,
+        seed: int,
+        min_pills: int,
+        max_pills: int,
+        n_pill_types: int,
+        n_count_bins: int = 10,
+        weights: Optional[Sequence[float]] = None,
+        block_size: Optional[int] = None,
+    ) -> None:
+        self.seed = seed
+        self.cells: List[Tuple[int, int, int]] = [
+            (lo, hi, n_types)
+            for lo, hi in get_count_bins(min_pills, max_pills, n_count_bins)
+            for n_types in range(1, n_pill_types + 1)
+            if n_types <= hi
+        ]
+        if not self.cells:
+            raise ValueError("The pill counts do not allow any pill in the images.")
+
+        target = np.ones(len(self.cells)) if weights is None else np.asarray(weights)
+        if (
+            target.shape != (len(self.cells),)
+            or np.any(target < 0)
+            or target.sum() <= 0
+        ):
+            raise ValueError(
+                f"Expected {len(self.cells)} non-negative cell weights, got {weights}."
+            )
+        self.block_size = block_size or len(self.cells)
+        self._block_cells = np.repeat(
+            np.arange(len(self.cells)), get_block_quotas(target, self.block_size)
+        )
+
+        # The cells of the last block, as the samples are mostly planned in order
+        self._block = -1
+        self._block_order = self._block_cells
+
+    def get_cell(self, idx: int) -> int:
+        """Get the cell of a sample, as an index into `cells`."""
+        block, offset = divmod(idx, self.block_size)
+        if self._block != block:
+            rng = get_schedule_rng(self.seed, block)
+            self._block, self._block_order = block, rng.permutation(self._block_cells)
+
+        return int(self._block_order[offset])
+
+    def plan_sample(self, idx: int, rng: np.random.Generator) -> List[int]:
+        """Plan the pills of a sample.
+
+        Args:
+            idx: The index of the sample.
+            rng: The random generator of the sample.
+
+        Returns:
+            The number of pills of each pill type of the sample, all positive.
+        """
+        lo, hi, n_types = self.cells[self.get_cell(idx)]
+        num_pills = int(rng.integers(max(lo, n_types), hi + 1))
+
+        # Split the pills at n_types - 1 distinct cuts between them
+        cuts = np.sort(rng.choice(num_pills - 1, n_types - 1, replace=False)) + 1
+        return np.diff(np.concatenate(([0], cuts, [num_pills]))).tolist()
+
+    def find_cell(self, num_pills: int, n_types: int) -> Optional[int]:
+        """Get the cell of a composition with `num_pills` pills of `n_types` types, as
+        an index into `cells`, or None if it is outside of every cell."""
+        for cell, (lo, hi, cell_types) in enumerate(self.cells):
+            if lo <= num_pills <= hi and cell_types == n_types:
+                return cell
+
+        return None
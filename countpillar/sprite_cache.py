@@ -0,0 +1,363 @@
+import json
+import math
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import click
+import numpy as np
+from tqdm import tqdm
+
+from countpillar.io_utils import (
+    ATLAS_DIR,
+    ATLAS_INDEX_FILE,
+    ATLAS_META_FILE,
+    get_img_and_mask,
+    get_source_dir_stamps,
+    load_pill_mask_paths,
+    mask_bbox,
+    sources_match,
+)
+
+PIXELS_FILE = "pixels.bin"
+INDEX_FILE = ATLAS_INDEX_FILE
+META_FILE = ATLAS_META_FILE
+
+
+class SpriteCache(Sequence[Tuple[np.ndarray, np.ndarray]]):
+    """Read-only store of decoded and binarized pill sprites.
+
+    All sprites live in a single flat ``uint8`` buffer that is memory-mapped on open,
+    so every process attaching to the same cache directory shares the decoded pixels
+    through the OS page cache instead of re-reading and re-decoding the JPEGs. Each
+    sprite is stored as its RGB image followed by its binary mask; the index records
+    the offset and shape of every sprite along with its precomputed mask area, mask
+    bounding box, aspect ratio and mean color. The metadata of the cache records the
+    modification time of the folders of its source files, so that a cache whose
+    sources changed can be told apart without a `stat` per file. The cache the
+    `sprite_atlas` command writes is referred to as the pill atlas.
+
+    Pickling a cache only transfers the cache directory, so it is cheap to pass to
+    joblib workers, which re-attach to the memory-mapped buffer on unpickling.
+    """
+
+    def __init__(self, cache_dir: Path) -> None:
+        self.cache_dir = Path(cache_dir)
+        self._index: np.ndarray = np.load(self.cache_dir / INDEX_FILE)
+        self._pixels: np.ndarray = (
+            np.memmap(self.cache_dir / PIXELS_FILE, dtype=np.uint8, mode="r")
+            if len(self._index) > 0
+            else np.zeros(0, dtype=np.uint8)
+        )
+        with (self.cache_dir / META_FILE).open() as f:
+            self.meta: Dict[str, Any] = json.load(f)
+        self._name_to_idx: Optional[Dict[str, int]] = None
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __getitem__(self, idx: int) -> Tuple[np.ndarray, np.ndarray]:  # type: ignore[override]
+        """Get the image and mask of a sprite as read-only views into the cache."""
+        offset, height, width = (
+            int(v) for v in self._index[idx][["offset", "height", "width"]]
+        )
+        n_img = height * width * 3
+        img = self._pixels[offset : offset + n_img].reshape(height, width, 3)
+        mask = self._pixels[offset + n_img : offset + n_img + height * width].reshape(
+            height, width
+        )
+        return img, mask
+
+    def index_of(self, name: str) -> int:
+        """Get the position of the sprite with the given image file name."""
+        if self._name_to_idx is None:
+            self._name_to_idx = {n: i for i, n in enumerate(self.names)}
+        return self._name_to_idx[name]
+
+    @property
+    def cropped(self) -> bool:
+        """Whether the sprites are cropped to the bounding box of their masks."""
+        return bool(self.meta["cropped"])
+
+    @property
+    def names(self) -> List[str]:
+        """File names of the cached pill images, in cache order."""
+        return self._index["name"].tolist()
+
+    @property
+    def areas(self) -> np.ndarray:
+        """Number of foreground pixels in each sprite mask."""
+        return self._index["area"]
+
+    @property
+    def bboxes(self) -> np.ndarray:
+        """Mask bounding boxes (x_min, y_min, x_max, y_max) in the stored sprites."""
+        return self._index["bbox"]
+
+    @property
+    def aspect_ratios(self) -> np.ndarray:
+        """Width over height of each sprite mask bounding box."""
+        return self._index["aspect_ratio"]
+
+    @property
+    def mean_colors(self) -> np.ndarray:
+        """Mean RGB color of the foreground pixels of each sprite."""
+        return self._index["mean_color"]
+
+    def matches(self, pill_mask_paths: List[Tuple[Path, Path]]) -> bool:
+        """Whether the cache holds exactly the sprites in `pill_mask_paths`, in the
+        same order, and their folders did not change since the cache was built."""
+        if "source_dirs" not in self.meta:
+            return False
+
+        return self.names == [
+            img_path.name for img_path, _ in pill_mask_paths
+        ] and sources_match(self.meta["source_dirs"], pill_mask_paths)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"cache_dir": self.cache_dir}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["cache_dir"])  # type: ignore[misc]
+
+
+def get_crop_window(bbox: Tuple[int, int, int, int]) -> Tuple[int, int, int, int]:
+    """Get the window to crop a sprite to: the bounding box of its mask padded by half
+    its diagonal on every side, so that no rotation of the pill about the center of
+    the window cuts it.
+
+    Args:
+        bbox: The (x_min, y_min, x_max, y_max) bounds of the mask.
+
+    Returns:
+        The (x_start, y_start, x_end, y_end) bounds of the window, end excluded, which
+        may extend past the image.
+    """
+    x_min, y_min, x_max, y_max = bbox
+    pad = math.ceil(math.hypot(x_max - x_min + 1, y_max - y_min + 1) / 2)
+    return x_min - pad, y_min - pad, x_max + 1 + pad, y_max + 1 + pad
+
+
+def crop_sprite(
+    img: np.ndarray, mask: np.ndarray, window: Tuple[int, int, int, int]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Crop an image and its mask to a window, padding them with zeros where the
+    window extends past the image."""
+    x_start, y_start, x_end, y_end = window
+    height, width = mask.shape[:2]
+    pad = (
+        (max(-y_start, 0), max(y_end - height, 0)),
+        (max(-x_start, 0), max(x_end - width, 0)),
+    )
+    rows = slice(max(y_start, 0), min(y_end, height))
+    cols = slice(max(x_start, 0), min(x_end, width))
+
+    return np.pad(img[rows, cols], pad + ((0, 0),)), np.pad(mask[rows, cols], pad)
+
+
+def build_sprite_cache(
+    pill_mask_paths: List[Tuple[Path, Path]],
+    cache_dir: Path,
+    thresh: int = 25,
+    crop: bool = False,
+    verbose: bool = False,
+) -> SpriteCache:
+    """Decode every pill image and mask once and pack them into a sprite cache.
+
+    The cache is written to a temporary directory first and then moved into place, so
+    a crashed build never leaves a half-written cache behind.
+
+    Args:
+        pill_mask_paths: The paths to the pill images and masks.
+        cache_dir: The directory to write the cache to.
+        thresh: The threshold at which to binarize the masks.
+        crop: Whether to crop each sprite around its mask, keeping a margin of half
+            the diagonal of the bounding box of the mask on every side so that rotated
+            pills are never cut.
+        verbose: Whether to show a progress bar.
+
+    Returns:
+        The sprite cache attached to the newly written directory.
+    """
+    cache_dir = Path(cache_dir)
+    names = [img_path.name for img_path, _ in pill_mask_paths]
+    index = np.zeros(
+        len(pill_mask_paths),
+        dtype=[
+            ("name", f"U{max((len(n) for n in names), default=1)}"),
+            ("offset", np.int64),
+            ("height", np.int32),
+            ("width", np.int32),
+            ("area", np.int64),
+            ("bbox", np.int32, (4,)),
+            ("aspect_ratio", np.float32),
+            ("mean_color", np.float32, (3,)),
+        ],
+    )
+
+    # Stamp the source folders before reading them, so that a pill changed during
+    # the build makes the cache stale rather than silently outdated
+    source_dirs = get_source_dir_stamps(pill_mask_paths)
+
+    cache_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=cache_dir.parent, prefix=".sprite_cache_"))
+    try:
+        # Stream the decoded sprites to disk one at a time, so that building the
+        # cache never holds more than a single sprite in memory.
+        offset: int = 0
+        with (tmp_dir / PIXELS_FILE).open("wb") as f:
+            for i, paths in enumerate(
+                tqdm(pill_mask_paths, desc="Packing sprites", disable=not verbose)
+            ):
+                img, mask = get_img_and_mask(paths, thresh)
+                x_min, y_min, x_max, y_max = mask_bbox(mask)
+                fg = mask > 0
+                area = int(np.count_nonzero(fg))
+                mean_color = img[fg].mean(axis=0) if area > 0 else np.zeros(3)
+                aspect_ratio = (x_max - x_min + 1) / max(y_max - y_min + 1, 1)
+                if crop and area > 0:
+                    window = get_crop_window((x_min, y_min, x_max, y_max))
+                    img, mask = crop_sprite(img, mask, window)
+                    x_min, x_max = x_min - window[0], x_max - window[0]
+                    y_min, y_max = y_min - window[1], y_max - window[1]
+
+                height, width = img.shape[:2]
+                index[i] = (
+                    names[i],
+                    offset,
+                    height,
+                    width,
+                    area,
+                    (x_min, y_min, x_max, y_max),
+                    aspect_ratio,
+                    mean_color,
+                )
+                f.write(np.ascontiguousarray(img).tobytes())
+                f.write(np.ascontiguousarray(mask).tobytes())
+                offset += img.size + mask.size
+        np.save(tmp_dir / INDEX_FILE, index)
+        with (tmp_dir / META_FILE).open("w") as f:
+            json.dump(
+                {"cropped": crop, "thresh": thresh, "source_dirs": source_dirs}, f
+            )
+
+        if cache_dir.exists():
+            shutil.rmtree(cache_dir)
+        os.replace(tmp_dir, cache_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return SpriteCache(cache_dir)
+
+
+def load_sprite_cache(
+    pill_mask_paths: List[Tuple[Path, Path]],
+    cache_dir: Path,
+    thresh: int = 25,
+    crop: bool = False,
+) -> SpriteCache:
+    """Attach to the sprite cache in `cache_dir`, building it first if it is missing,
+    was built with other settings or does not hold exactly the sprites in
+    `pill_mask_paths`, in the same order, decoded from their current source files.
+
+    Args:
+        pill_mask_paths: The paths to the pill images and masks.
+        cache_dir: The directory of the cache.
+        thresh: The threshold at which to binarize the masks.
+        crop: Whether to crop each sprite to the bounding box of its mask.
+
+    Returns:
+        The sprite cache.
+    """
+    cache_dir = Path(cache_dir)
+    cache = open_sprite_cache(cache_dir)
+    if (
+        cache is not None
+        and cache.meta.get("cropped") == crop
+        and cache.meta.get("thresh") == thresh
+        and cache.matches(pill_mask_paths)
+    ):
+        return cache
+
+    return build_sprite_cache(pill_mask_paths, cache_dir, thresh, crop)
+
+
+def open_sprite_cache(
+    cache_dir: Path, pill_mask_paths: Optional[List[Tuple[Path, Path]]] = None
+) -> Optional[SpriteCache]:
+    """Attach to the sprite cache in `cache_dir` if there is a complete one.
+
+    Args:
+        cache_dir: The directory of the cache.
+        pill_mask_paths: If provided, the cache is only attached to if it holds exactly
+            these sprites, decoded from their current source files. A warning is
+            printed otherwise.
+
+    Returns:
+        The sprite cache, or None.
+    """
+    cache_dir = Path(cache_dir)
+    if not all((cache_dir / f).exists() for f in (PIXELS_FILE, INDEX_FILE, META_FILE)):
+        return None
+
+    cache = SpriteCache(cache_dir)
+    if pill_mask_paths is not None and not cache.matches(pill_mask_paths):
+        print(
+            f"Ignoring the sprite cache at {cache_dir}, as the pills changed since it "
+            "was built. Rerun `sprite_atlas` to update it."
+        )
+        return None
+
+    return cache
+
+
+@click.command()
+@click.option(
+    "-p",
+    "--pill-mask-path",
+    default=Path("./data/pills/"),
+    type=click.Path(exists=True, path_type=Path),
+    show_default=True,
+    help="Path to the folder with pill images and masks",
+)
+@click.option(
+    "-o",
+    "--atlas-path",
+    default=None,
+    type=click.Path(path_type=Path),
+    help=f"Path to the output atlas folder  [default: <pill-mask-path>/{ATLAS_DIR}]",
+)
+@click.option(
+    "-t",
+    "--thresh",
+    default=25,
+    show_default=True,
+    help="The threshold at which to binarize the masks",
+)
+@click.option(
+    "--crop/--no-crop",
+    default=False,
+    show_default=True,
+    help="""
+    Crop each sprite around its mask, with a margin of half the diagonal of the mask
+    bounding box on every side so that rotated pills are never cut. The pill size
+    options of `dataset_generator` then refer to this crop instead of the full photo,
+    which changes the scale of the pills
+    """,
+)
+def main(
+    pill_mask_path: Path, atlas_path: Optional[Path], thresh: int, crop: bool
+) -> None:
+    # Glob the pill images directly, an existing atlas may be stale
+    pill_mask_paths = load_pill_mask_paths(pill_mask_path, use_atlas=False)
+    print(f"Found {len(pill_mask_paths)} pill masks.")
+
+    atlas_path = atlas_path or pill_mask_path / ATLAS_DIR
+    atlas = build_sprite_cache(pill_mask_paths, atlas_path, thresh, crop, True)
+    print(f"Packed {len(atlas)} sprites into the atlas: ", atlas.cache_dir)
+
+
+if __name__ == "__main__":
+    main()
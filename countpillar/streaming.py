@@ -0,0 +1,134 @@
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from countpillar.generate_dataset import compose_sample, init_worker, make_job_config
+from countpillar.io_utils import ATLAS_DIR, load_pill_mask_paths
+from countpillar.sprite_cache import open_sprite_cache
+
+# Number of sample indices set apart for every epoch of an endless stream
+ENDLESS_EPOCH_STRIDE = 2**40
+
+
+def iter_samples(
+    config: Dict[str, Any], indices: Iterable[int]
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Compose the samples with the given indices one at a time, without saving them.
+
+    Each sample is drawn from its own random stream derived from the seed of the job
+    and its index, exactly as with `dataset_generator`, so a streamed sample is
+    identical to the image saved under the same index with the same seed.
+
+    The generator holds its own worker state, so that several streams can be
+    iterated in turn in the same process.
+
+    Args:
+        config: The job configuration, as built by `make_job_config`.
+        indices: The indices of the samples to compose.
+
+    Yields:
+        The RGB image of each sample and its YOLO annotations, as an (N, 5) array of
+        class, x center, y center, width and height.
+    """
+    state = init_worker(config)
+    for idx in indices:
+        img_comp, anno_yolo, _ = compose_sample(idx, config, state)
+        yield img_comp, np.asarray(anno_yolo, dtype=np.float32).reshape(-1, 5)
+
+
+def to_tensors(
+    img: np.ndarray, targets: np.ndarray
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Convert an RGB image to a (3, H, W) uint8 tensor and its targets to a tensor."""
+    img_t = torch.from_numpy(img).permute(2, 0, 1).contiguous()
+    return img_t, torch.from_numpy(targets)
+
+
+class SyntheticPillDataset(IterableDataset):
+    """Stream freshly composed pill images and their YOLO annotations.
+
+    The pills are read from `pill_mask_path`, or from its atlas if one was built with
+    `sprite_atlas`, and every other keyword argument is passed to `make_job_config`,
+    including those of `create_pill_comp`. Each sample is passed through `transform`,
+    which converts it to tensors by default. The stream is endless if `length` is None.
+
+    The samples are split between the `DataLoader` workers, and between the processes
+    of a distributed job, by interleaving their indices, so every sample of an epoch
+    is composed exactly once. As every sample only depends on the seed and its index,
+    the stream is the same for any number of workers; pass the same seed to every
+    process of a distributed job. Call `set_epoch` before each epoch to draw new
+    images: with a finite `length`, epoch e holds the samples e * length to
+    (e + 1) * length - 1, and an endless stream starts epoch e at sample
+    e * `ENDLESS_EPOCH_STRIDE`.
+
+    The images vary in size, so batch them with a `collate_fn` which keeps the images
+    and targets as lists, or resize them in `transform`.
+    """
+
+    def __init__(
+        self,
+        pill_mask_path: Path = Path("./data/pills/"),
+        length: Optional[int] = None,
+        seed: Optional[int] = None,
+        transform: Optional[Callable[[np.ndarray, np.ndarray], Any]] = to_tensors,
+        **kwargs,
+    ) -> None:
+        super().__init__()
+        if seed is None:
+            seed = int(np.random.SeedSequence().entropy) % 2**63
+        self.length = length
+        self.seed = seed
+        self.transform = transform
+        self.epoch = 0
+
+        pill_mask_paths = load_pill_mask_paths(pill_mask_path)
+        kwargs.setdefault("n_pill_types", 1)
+        if "sprite_cache" not in kwargs:
+            kwargs["sprite_cache"] = open_sprite_cache(
+                Path(pill_mask_path) / ATLAS_DIR, pill_mask_paths
+            )
+        self.config = make_job_config(pill_mask_paths, self.seed, **kwargs)
+
+    def __len__(self) -> int:
+        if self.length is None:
+            raise TypeError("An endless SyntheticPillDataset has no length.")
+
+        return self.length
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch, which selects the samples of the next iteration."""
+        self.epoch = epoch
+
+    def _shard(self) -> Tuple[int, int]:
+        """Get the shard of the current worker and the number of shards."""
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+
+        worker_info = get_worker_info()
+        worker_id, n_workers = (
+            (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        )
+
+        return rank * n_workers + worker_id, world_size * n_workers
+
+    def __iter__(self) -> Iterator[Any]:
+        shard, n_shards = self._shard()
+        if self.length is None:
+            start = self.epoch * ENDLESS_EPOCH_STRIDE
+            indices: Iterable[int] = range(
+                start + shard, start + ENDLESS_EPOCH_STRIDE, n_shards
+            )
+        else:
+            start = self.epoch * self.length
+            indices = range(start + shard, start + self.length, n_shards)
+
+        for img, targets in iter_samples(self.config, indices):
+            if self.transform is not None:
+                yield self.transform(img, targets)
+            else:
+                yield img, targets
@@ -0,0 +1,139 @@
+import csv
+import json
+import time
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Any, ContextManager, Dict, Iterable, List, Mapping, Optional, Union
+
+# Stages of the generation of a sample, in pipeline order
+STAGES = (
+    "bg_load",
+    "sprite_load",
+    "transform",
+    "composite",
+    "overlap_check",
+    "annotate",
+    "queue_wait",
+    "encode",
+    "write",
+)
+
+TELEMETRY_JSON = "telemetry.json"
+TELEMETRY_CSV = "telemetry.csv"
+
+
+class StageTimer:
+    """Context manager adding the wall time of its block to a stage of `timings`."""
+
+    __slots__ = ("timings", "stage", "start")
+
+    def __init__(self, timings: Dict[str, float], stage: str) -> None:
+        self.timings = timings
+        self.stage = stage
+        self.start = 0.0
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        elapsed = time.perf_counter() - self.start
+        self.timings[self.stage] = self.timings.get(self.stage, 0.0) + elapsed
+
+
+_NULL_TIMER = nullcontext()
+
+
+def time_stage(timings: Optional[Dict[str, float]], stage: str) -> ContextManager[None]:
+    """Time a block as a stage of `timings`, or do nothing if `timings` is None, so
+    that the instrumentation costs nothing unless it is enabled.
+
+    Args:
+        timings: The wall time spent in each stage so far, in seconds.
+        stage: The stage of the block, one of `STAGES`.
+
+    Returns:
+        The context manager timing the block.
+    """
+    if timings is None:
+        return _NULL_TIMER
+
+    return StageTimer(timings, stage)
+
+
+def sum_counts(
+    counts: Iterable[Dict[str, Union[int, float]]]
+) -> Dict[str, Union[int, float]]:
+    """Sum dictionaries of counters or timings key by key."""
+    total: Dict[str, Union[int, float]] = {}
+    for count in counts:
+        for key, value in count.items():
+            total[key] = total.get(key, 0) + value
+
+    return total
+
+
+def add_counts(
+    total: Optional[Dict[str, Any]], counts: Mapping[str, Union[int, float]]
+) -> None:
+    """Add counters or timings to `total` key by key, in place, unless it is None."""
+    if total is None:
+        return
+
+    for key, value in counts.items():
+        total[key] = total.get(key, 0) + value
+
+
+def write_telemetry(
+    output_folder: Path, chunk_reports: List[Dict[str, Any]], elapsed: float
+) -> Dict[str, Any]:
+    """Write the telemetry of a generation job: a JSON summary of the whole job and a
+    CSV with one row per chunk.
+
+    Args:
+        output_folder: The folder to write `telemetry.json` and `telemetry.csv` to.
+        chunk_reports: The reports of the chunks, as returned by `generate_chunk`.
+        elapsed: The wall time of the whole job, in seconds.
+
+    Returns:
+        The JSON summary.
+    """
+    n_images = sum(report["n_images"] for report in chunk_reports)
+    timings = sum_counts(report["timings"] for report in chunk_reports)
+    worker_time = sum(report["elapsed"] for report in chunk_reports)
+    summary = {
+        "n_images": n_images,
+        "n_chunks": len(chunk_reports),
+        "n_workers": len({report["pid"] for report in chunk_reports}),
+        "elapsed": elapsed,
+        "images_per_second": n_images / max(elapsed, 1e-9),
+        "worker_time": worker_time,
+        "counters": sum_counts(report["stats"] for report in chunk_reports),
+        "timings": {stage: timings.get(stage, 0.0) for stage in STAGES},
+        "ms_per_image": {
+            stage: 1e3 * timings.get(stage, 0.0) / max(n_images, 1) for stage in STAGES
+        },
+    }
+    with (Path(output_folder) / TELEMETRY_JSON).open("w") as f:
+        json.dump(summary, f, indent=2)
+
+    counter_keys = sorted({key for r in chunk_reports for key in r["stats"]})
+    with (Path(output_folder) / TELEMETRY_CSV).open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ["pid", "first_index", "n_images", "elapsed"]
+            + counter_keys
+            + [f"{s}_time" for s in STAGES]
+        )
+        for report in chunk_reports:
+            writer.writerow(
+                [
+                    report["pid"],
+                    report["first_index"],
+                    report["n_images"],
+                    report["elapsed"],
+                ]
+                + [report["stats"].get(key, 0) for key in counter_keys]
+                + [report["timings"].get(stage, 0.0) for stage in STAGES]
+            )
+
+    return summary
@@ -1,8 +1,15 @@
+from functools import lru_cache
 from typing import Optional, Tuple
 
 import albumentations as A
 import numpy as np
 
+from countpillar.random_utils import get_rng, seed_augmentations
+
+# Default range of the long side of the pills placed on a background, in pixels
+PILL_LONGEST_MIN: int = 224
+PILL_LONGEST_MAX: int = 224
+
 
 def resize_bg(
     img: np.ndarray, desired_max: int = 1920, desired_min: Optional[int] = None
@@ -42,15 +49,33 @@ def resize_bg(
     return img
 
 
+@lru_cache(maxsize=None)
+def get_default_augmentations() -> A.BasicTransform:
+    """Get the default augmentations applied to the pills. The pipeline is built once
+    per process and reused across calls."""
+    return A.Compose(
+        [
+            A.Rotate(limit=90, border_mode=0, mask_value=0, p=1.0),
+            A.RandomBrightnessContrast(
+                brightness_limit=0.02,
+                contrast_limit=0.02,
+                brightness_by_max=True,
+            ),
+        ]
+    )
+
+
 def resize_and_transform_pill(
     img: np.ndarray,
     mask: np.ndarray,
-    longest_max: int = 224,
-    longest_min: int = 224,
+    longest_max: int = PILL_LONGEST_MAX,
+    longest_min: int = PILL_LONGEST_MIN,
     augmentations: Optional[A.BasicTransform] = None,
+    rng: Optional[np.random.Generator] = None,
 ) -> Tuple[np.ndarray, np.ndarray]:
     """Resize the pill image and the corresponding mask to the given height and width.
-    Also, apply some random augmentations to the pill image.
+    Also, apply some random augmentations to the pill image. If a random generator is
+    provided, the size and the augmentations are drawn from it.
     """
     height, width = img.shape[:2]
 
@@ -59,7 +84,7 @@ def resize_and_transform_pill(
 
     # Randomly select the long side of the new image. The short side will be resized to
     # keep the aspect ratio of the original image.
-    long_new = np.random.randint(longest_min, longest_max + 1)
+    long_new = int(get_rng(rng).integers(longest_min, longest_max + 1))
     short_new = int(short_side * long_new / long_side)
     h_new, w_new = (long_new, short_new) if height > width else (short_new, long_new)
 
@@ -69,18 +94,12 @@ def resize_and_transform_pill(
     img_t, mask_t = transform_resized["image"], transform_resized["mask"]
 
     # Apply some random augmentations to the pill image.
-    augmentations = augmentations or A.Compose(
-        [
-            A.Rotate(limit=90, border_mode=0, mask_value=0, p=1.0),
-            A.RandomBrightnessContrast(
-                brightness_limit=0.02,
-                contrast_limit=0.02,
-                brightness_by_max=True,
-            ),
-        ]
-    )
-
-    transforms_aug = augmentations(image=img_t, mask=mask_t)
+    augmentations = augmentations or get_default_augmentations()
+    if rng is not None:
+        with seed_augmentations(augmentations, rng):
+            transforms_aug = augmentations(image=img_t, mask=mask_t)
+    else:
+        transforms_aug = augmentations(image=img_t, mask=mask_t)
     img_t, mask_t = transforms_aug["image"], transforms_aug["mask"]
 
     return img_t, mask_t
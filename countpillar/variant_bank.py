@@ -0,0 +1,90 @@
+from typing import Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from countpillar.cache_utils import LRUCache
+from countpillar.random_utils import get_rng, get_sprite_rng
+from countpillar.transform import resize_and_transform_pill
+
+
+class VariantBank:
+    """Bank of pre-transformed variants of the pill sprites.
+
+    The first time a sprite is requested, `n_variants` resized and augmented variants
+    of it are generated with resize_and_transform_pill and kept in memory; subsequent
+    requests pick one of them at random instead of transforming the sprite again. The
+    variants of the least recently used sprites are evicted once the bank exceeds its
+    memory budget, and are generated afresh the next time they are needed.
+
+    The variants are refreshed every `refresh_every` samples: `start_sample` moves the
+    bank to the generation of the block of samples being composed, and each generation
+    has its own variants, so that a large dataset does not reuse the same few variants
+    of a pill throughout.
+
+    If a seed is provided, the variants of a sprite with an integer key are generated
+    from that seed, the key and the generation alone. They are then the same in every
+    process and after every eviction, which keeps seeded datasets reproducible.
+    """
+
+    def __init__(
+        self,
+        n_variants: int = 8,
+        max_bytes: int = 512 * 2**20,
+        seed: Optional[int] = None,
+        refresh_every: int = 256,
+    ) -> None:
+        self.n_variants = n_variants
+        self.seed = seed
+        self.refresh_every = refresh_every
+        self.generation: int = 0
+        self._cache = LRUCache(max_bytes)
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def start_sample(self, idx: int) -> None:
+        """Use the variants of the generation of a sample for the next requests.
+
+        Args:
+            idx: The index of the sample about to be composed.
+        """
+        self.generation = idx // self.refresh_every
+
+    def get(
+        self,
+        key: Hashable,
+        pill_img: np.ndarray,
+        mask: np.ndarray,
+        rng: Optional[np.random.Generator] = None,
+        **kwargs,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Get a random transformed variant of a sprite.
+
+        Args:
+            key: The key identifying the sprite, e.g. its index in the pill library.
+            pill_img: The pill image.
+            mask: The pill mask.
+            rng: The random generator to pick the variant with.
+            **kwargs: Keyword arguments for resize_and_transform_pill. They must not
+                change between calls, as the variants are only generated once.
+
+        Returns:
+            The transformed pill image and mask. They are shared with later calls and
+            must not be modified in place.
+        """
+        rng = get_rng(rng)
+        cache_key = (key, self.generation)
+        variants: List[Tuple[np.ndarray, np.ndarray]] = self._cache.get(cache_key)
+        if variants is None:
+            variants_rng = (
+                get_sprite_rng(self.seed, key, self.generation)
+                if self.seed is not None and isinstance(key, int)
+                else rng
+            )
+            variants = [
+                resize_and_transform_pill(pill_img, mask, rng=variants_rng, **kwargs)
+                for _ in range(self.n_variants)
+            ]
+            self._cache.put(cache_key, variants)
+
+        return variants[rng.integers(len(variants))]
@@ -0,0 +1,34 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="session")
+def pill_mask_path(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """Draw a small library of elliptical pills, with their images and masks."""
+    pill_dir = tmp_path_factory.mktemp("pills")
+    (pill_dir / "images").mkdir()
+    (pill_dir / "masks").mkdir()
+
+    rng = np.random.default_rng(0)
+    for i in range(6):
+        h, w = rng.integers(120, 200, size=2)
+        mask = np.zeros((h, w), dtype=np.uint8)
+        cv2.ellipse(
+            mask,
+            (int(w) // 2, int(h) // 2),
+            (int(w) // 3, int(h) // 4),
+            float(rng.uniform(0, 180)),
+            0,
+            360,
+            255,
+            -1,
+        )
+        img = np.full((h, w, 3), 200, dtype=np.uint8)
+        img[mask > 0] = rng.integers(0, 256, size=3)
+        cv2.imwrite(str(pill_dir / "images" / f"{i}.jpg"), img)
+        cv2.imwrite(str(pill_dir / "masks" / f"{i}.jpg"), mask)
+
+    return pill_dir
@@ -0,0 +1,57 @@
+from typing import Dict, Tuple
+
+import numpy as np
+import pytest
+
+from countpillar.composition import (
+    create_pill_comp,
+    get_centered_position,
+    is_object_mask_within_image,
+)
+
+
+def make_sprite() -> Tuple[np.ndarray, np.ndarray]:
+    """Make a rectangular pill sprite."""
+    pill_img = np.full((30, 40, 3), 200, dtype=np.uint8)
+    mask = np.zeros((30, 40), dtype=np.uint8)
+    mask[5:25, 5:35] = 1
+    return pill_img, mask
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_centered_position_off_border_passes_border_check(seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    bg_img = np.zeros((120, 160, 3), dtype=np.uint8)
+    for _ in range(50):
+        h, w = rng.integers(5, 60, size=2)
+        mask = np.ones((h, w), dtype=np.uint8)
+        center = (int(rng.integers(-20, 180)), int(rng.integers(-20, 140)))
+
+        position = get_centered_position(center, mask.shape, bg_img.shape, False)
+
+        assert is_object_mask_within_image(bg_img, mask, position)
+
+
+@pytest.mark.parametrize("target_count", [False, True])
+@pytest.mark.parametrize("max_attempts, expected", [(0, 1), (50, 0)])
+def test_early_termination_is_counted_in_both_modes(
+    target_count: bool, max_attempts: int, expected: int
+) -> None:
+    stats: Dict[str, int] = {}
+    _, _, labels, _ = create_pill_comp(
+        np.zeros((320, 320, 3), dtype=np.uint8),
+        [],
+        n_pill_types=2,
+        min_pills=4,
+        max_pills=4,
+        max_attempts=max_attempts,
+        sprite_cache=[make_sprite()],
+        target_count=target_count,
+        stats=stats,
+        rng=np.random.default_rng(0),
+        longest_min=20,
+        longest_max=20,
+    )
+
+    assert stats["early_terminated"] == expected
+    assert len(labels) == stats["accepted"] == 4 * (1 - expected)
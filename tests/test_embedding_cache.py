@@ -0,0 +1,75 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+from countpillar.embedding_cache import EmbeddingCache, get_embedding_key
+
+
+def make_embedding(value: float) -> np.ndarray:
+    """Make a small embedding, saved as a file of 384 bytes."""
+    return np.full(64, value, dtype=np.float32)
+
+
+def test_get_misses_then_hits(tmp_path: Path) -> None:
+    cache = EmbeddingCache(tmp_path)
+    key = get_embedding_key(np.zeros((8, 8, 3), dtype=np.uint8), "vit_b")
+
+    assert cache.get(key) is None
+    cache.put(key, make_embedding(1.0))
+    embedding = cache.get(key)
+
+    assert embedding is not None
+    np.testing.assert_array_equal(embedding, make_embedding(1.0))
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 0)
+    assert key not in EmbeddingCache(tmp_path / "other")
+
+
+def test_key_depends_on_image_and_checkpoint() -> None:
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    other = image.copy()
+    other[0, 0, 0] = 1
+
+    assert get_embedding_key(image, "vit_b") == get_embedding_key(image.copy(), "vit_b")
+    assert get_embedding_key(image, "vit_b") != get_embedding_key(other, "vit_b")
+    assert get_embedding_key(image, "vit_b") != get_embedding_key(image, "vit_h")
+
+
+def test_least_recently_used_embeddings_are_evicted(tmp_path: Path) -> None:
+    cache = EmbeddingCache(tmp_path, max_bytes=1000)
+    cache.put("a", make_embedding(1.0))
+    cache.put("b", make_embedding(2.0))
+    assert cache.get("a") is not None
+
+    cache.put("c", make_embedding(3.0))
+
+    assert "b" not in cache and "a" in cache and "c" in cache
+    assert not (tmp_path / "b.npy").exists()
+    assert cache.evictions == 1
+    assert cache.nbytes == sum(p.stat().st_size for p in tmp_path.glob("*.npy"))
+    assert cache.nbytes <= cache.max_bytes
+
+
+def test_embedding_larger_than_budget_is_not_cached(tmp_path: Path) -> None:
+    cache = EmbeddingCache(tmp_path, max_bytes=1000)
+    cache.put("big", np.zeros(1000, dtype=np.float32))
+
+    assert "big" not in cache
+    assert cache.get("big") is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_reload_keeps_usage_order_and_budget(tmp_path: Path) -> None:
+    cache = EmbeddingCache(tmp_path)
+    for i, key in enumerate("abc"):
+        cache.put(key, make_embedding(float(i)))
+        os.utime(tmp_path / f"{key}.npy", ns=(i * 10**9, i * 10**9))
+
+    reloaded = EmbeddingCache(tmp_path, max_bytes=1000)
+
+    assert len(reloaded) == 2
+    assert "a" not in reloaded
+    assert reloaded.evictions == 1
+    embedding = reloaded.get("c")
+    assert embedding is not None
+    np.testing.assert_array_equal(embedding, make_embedding(2.0))
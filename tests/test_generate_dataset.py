@@ -0,0 +1,105 @@
+from pathlib import Path
+from typing import Dict, List
+
+from click.testing import CliRunner
+
+from countpillar.generate_dataset import main
+from countpillar.manifest import COMPLETED_FILE
+
+
+def generate(pill_mask_path: Path, output_folder: Path, *args: str) -> None:
+    """Generate a small seeded dataset of random color backgrounds."""
+    result = CliRunner().invoke(
+        main,
+        [
+            "--pill-mask-path",
+            str(pill_mask_path),
+            "--output-folder",
+            str(output_folder),
+            "--n-images",
+            "8",
+            "--n-pill-types",
+            "2",
+            "--min-pills",
+            "3",
+            "--max-pills",
+            "12",
+            "--min-pill-size",
+            "40",
+            "--max-pill-size",
+            "80",
+            "--min-bg-dim",
+            "256",
+            "--max-bg-dim",
+            "320",
+            "--chunk-size",
+            "2",
+            "--seed",
+            "7",
+            *args,
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+
+def read_outputs(output_folder: Path) -> Dict[str, bytes]:
+    """Read the images and annotations of a dataset, by relative path."""
+    return {
+        str(path.relative_to(output_folder)): path.read_bytes()
+        for folder in ("images", "labels")
+        for path in sorted((output_folder / folder).iterdir())
+    }
+
+
+def test_seeded_runs_match_across_worker_counts(
+    pill_mask_path: Path, tmp_path: Path
+) -> None:
+    outputs: List[Dict[str, bytes]] = []
+    for num_cpu in ("1", "3"):
+        generate(pill_mask_path, tmp_path / num_cpu, "--num-cpu", num_cpu)
+        outputs.append(read_outputs(tmp_path / num_cpu))
+
+    assert len(outputs[0]) == 16
+    assert outputs[0] == outputs[1]
+
+
+def test_resumed_run_matches_fresh_run(pill_mask_path: Path, tmp_path: Path) -> None:
+    generate(pill_mask_path, tmp_path / "fresh", "--num-cpu", "1")
+
+    # Interrupt a run after its first chunks: the later images are missing, or were
+    # cut short while being written
+    resumed = tmp_path / "resumed"
+    generate(pill_mask_path, resumed, "--num-cpu", "1")
+    (resumed / COMPLETED_FILE).write_text("0-3\n")
+    for path in sorted((resumed / "images").iterdir()):
+        idx = int(path.stem.split("_")[0])
+        if idx == 4:
+            path.write_bytes(path.read_bytes()[:100])
+        elif idx > 4:
+            path.unlink()
+            (resumed / "labels" / f"{path.stem}.txt").unlink()
+
+    generate(pill_mask_path, resumed, "--num-cpu", "1", "--resume")
+
+    assert read_outputs(resumed) == read_outputs(tmp_path / "fresh")
+
+
+def test_indices_are_rejected_with_tar_output(
+    pill_mask_path: Path, tmp_path: Path
+) -> None:
+    result = CliRunner().invoke(
+        main,
+        [
+            "--pill-mask-path",
+            str(pill_mask_path),
+            "--output-folder",
+            str(tmp_path),
+            "--output-format",
+            "tar",
+            "--indices",
+            "3",
+        ],
+    )
+
+    assert result.exit_code != 0
+    assert "--indices cannot be combined" in result.output
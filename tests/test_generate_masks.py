@@ -0,0 +1,49 @@
+from pathlib import Path
+from typing import List
+
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from countpillar import generate_masks as gm  # noqa: E402
+
+
+def test_unreadable_images_advance_the_progress_bar(
+    pill_mask_path: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    image_paths = sorted((pill_mask_path / "images").glob("*.jpg"))
+    broken_path = tmp_path / "broken.jpg"
+    broken_path.write_bytes(b"not an image")
+    image_paths.insert(2, broken_path)
+
+    # Predict the center of the image as the pill, instead of running SAM
+    def center_masks(images: List[np.ndarray]) -> List[np.ndarray]:
+        masks = [np.zeros(image.shape[:2], dtype=np.uint8) for image in images]
+        for mask in masks:
+            h, w = mask.shape
+            mask[h // 4 : 3 * h // 4, w // 4 : 3 * w // 4] = 1
+        return masks
+
+    monkeypatch.setattr(gm, "predict_masks", lambda images, cache: images)
+    monkeypatch.setattr(gm, "get_best_mask_per_images", center_masks)
+    bars: List[gm.tqdm] = []
+
+    class RecordingBar(gm.tqdm):
+        def __init__(self, *args, **kwargs) -> None:
+            super().__init__(*args, **kwargs)
+            bars.append(self)
+
+    monkeypatch.setattr(gm, "tqdm", RecordingBar)
+
+    output_masks_path = tmp_path / "masks"
+    output_masks_path.mkdir()
+    gm.generate_masks(image_paths, output_masks_path, num_iterations=1, num_workers=2)
+
+    assert bars[0].n == bars[0].total == len(image_paths)
+    assert bars[0].postfix == "skipped=1"
+    saved = sorted(p.name for p in output_masks_path.iterdir())
+    assert saved == sorted(p.name for p in image_paths if p != broken_path)
+    assert cv2.imread(str(output_masks_path / saved[0])) is not None
@@ -0,0 +1,81 @@
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+import pytest
+
+from countpillar.grabcut_utils import (
+    apply_grabcut,
+    apply_roi_grabcut,
+    post_process_mask,
+    run_grabcut,
+)
+
+
+def make_pill_image() -> Tuple[np.ndarray, np.ndarray]:
+    """Draw a colored elliptical pill on a noisy background, with a rough mask."""
+    rng = np.random.default_rng(0)
+    image = rng.integers(90, 130, size=(240, 320, 3), dtype=np.uint8)
+    pill = np.zeros((240, 320), dtype=np.uint8)
+    cv2.ellipse(pill, (150, 130), (60, 35), 20, 0, 360, 255, -1)
+    image[pill > 0] = (40, 60, 220)
+
+    # The rough mask spills over the background around the pill, as SAM masks do
+    rough_mask = cv2.dilate(pill, np.ones((15, 15), dtype=np.uint8))
+
+    return image, rough_mask
+
+
+def iou(mask: np.ndarray, other: np.ndarray) -> float:
+    return np.count_nonzero((mask > 0) & (other > 0)) / np.count_nonzero(
+        (mask > 0) | (other > 0)
+    )
+
+
+@pytest.fixture
+def grabcut_calls(monkeypatch: pytest.MonkeyPatch) -> List[int]:
+    """Record the number of iterations of every call to cv2.grabCut."""
+    calls: List[int] = []
+    grab_cut = cv2.grabCut
+
+    def counting_grab_cut(*args, iterCount, **kwargs):
+        calls.append(iterCount)
+        return grab_cut(*args, iterCount=iterCount, **kwargs)
+
+    monkeypatch.setattr(cv2, "grabCut", counting_grab_cut)
+    return calls
+
+
+def test_run_grabcut_stops_once_labels_stop_changing(grabcut_calls: List[int]) -> None:
+    image, rough_mask = make_pill_image()
+    labels = np.where(rough_mask > 0, cv2.GC_PR_FGD, cv2.GC_BGD).astype(np.uint8)
+
+    run_grabcut(image, labels, n_iter=20, tol=0.001)
+
+    assert 1 <= len(grabcut_calls) < 20
+
+
+def test_requested_iterations_are_honored(grabcut_calls: List[int]) -> None:
+    image, rough_mask = make_pill_image()
+    labels = np.where(rough_mask > 0, cv2.GC_PR_FGD, cv2.GC_BGD).astype(np.uint8)
+
+    # Without early stopping, run_grabcut runs exactly the requested iterations
+    run_grabcut(image, labels, n_iter=3, tol=-1)
+    assert grabcut_calls == [1, 1, 1]
+
+    grabcut_calls.clear()
+    apply_grabcut(image, rough_mask.copy(), n_iter=4)
+    assert grabcut_calls == [4]
+
+
+# At half resolution, the edge of the pill is only refined to within a pixel
+@pytest.mark.parametrize("scale, min_iou", [(1.0, 0.99), (0.5, 0.9)])
+def test_roi_grabcut_matches_full_image_grabcut(scale: float, min_iou: float) -> None:
+    image, rough_mask = make_pill_image()
+    full_mask = post_process_mask(apply_grabcut(image, rough_mask.copy()))
+
+    roi_mask = post_process_mask(apply_roi_grabcut(image, rough_mask, scale=scale))
+
+    assert iou(roi_mask, full_mask) >= min_iou
+    # GrabCut only removes pixels from the rough mask
+    assert not np.any((roi_mask > 0) & (rough_mask == 0))
@@ -0,0 +1,81 @@
+from typing import List
+
+import numpy as np
+import pytest
+
+from countpillar.io_utils import create_yolo_annotations, extract_instances
+
+
+def make_comp_mask(seed: int, n_pills: int) -> np.ndarray:
+    """Draw overlapping rectangular pills, some of them fully hidden."""
+    rng = np.random.default_rng(seed)
+    comp_mask = np.zeros((120, 160), dtype=np.uint8)
+    for idx in range(1, n_pills + 1):
+        y, x = rng.integers(0, 110), rng.integers(0, 150)
+        h, w = rng.integers(1, 40, size=2)
+        comp_mask[y : y + h, x : x + w] = idx
+
+    return comp_mask
+
+
+def create_yolo_annotations_per_mask(
+    mask_comp: np.ndarray, labels_comp: List[int]
+) -> List[List[float]]:
+    """The former annotation extraction, with a binary mask per pill."""
+    comp_w, comp_h = mask_comp.shape[1], mask_comp.shape[0]
+
+    obj_ids = np.unique(mask_comp).astype(np.uint8)[1:]
+    masks = mask_comp == obj_ids[:, None, None]
+
+    annotations_yolo: List[List[float]] = []
+    for i in range(len(labels_comp)):
+        pos = np.where(masks[i])
+        xmin, xmax = np.min(pos[1]), np.max(pos[1])
+        ymin, ymax = np.min(pos[0]), np.max(pos[0])
+
+        xc, yc = (xmin + xmax) / 2, (ymin + ymax) / 2
+        w, h = xmax - xmin, ymax - ymin
+
+        annotations_yolo.append(
+            [
+                labels_comp[i] - 1,
+                round(xc / comp_w, 5),
+                round(yc / comp_h, 5),
+                round(w / comp_w, 5),
+                round(h / comp_h, 5),
+            ]
+        )
+
+    return annotations_yolo
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_extract_instances_matches_per_mask_boxes(seed: int) -> None:
+    comp_mask = make_comp_mask(seed, 30)
+    instances = extract_instances(comp_mask)
+
+    expected_ids = np.unique(comp_mask)[1:]
+    np.testing.assert_array_equal(instances.ids, expected_ids)
+    for idx, bbox, area, visible in zip(*instances):
+        ys, xs = np.where(comp_mask == idx)
+        x_min, x_max, y_min, y_max = xs.min(), xs.max(), ys.min(), ys.max()
+        assert bbox.tolist() == [x_min, y_min, x_max, y_max]
+        assert area == (x_max - x_min + 1) * (y_max - y_min + 1)
+        assert visible == len(xs)
+
+
+def test_extract_instances_of_empty_mask() -> None:
+    instances = extract_instances(np.zeros((10, 10), dtype=np.uint8))
+
+    assert len(instances.ids) == 0
+    assert instances.bboxes.shape == (0, 4)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_create_yolo_annotations_matches_per_mask_annotations(seed: int) -> None:
+    comp_mask = make_comp_mask(seed, 20)
+    labels = [1 + idx % 3 for idx in range(len(np.unique(comp_mask)) - 1)]
+
+    assert create_yolo_annotations(comp_mask, labels) == (
+        create_yolo_annotations_per_mask(comp_mask, labels)
+    )
@@ -0,0 +1,85 @@
+import csv
+import os
+from pathlib import Path
+
+import numpy as np
+
+from countpillar.label_index import (
+    UNKNOWN_CLASS,
+    LabelIndex,
+    build_label_index,
+    get_sprite_labels,
+    load_label_index,
+)
+
+
+def write_metadata(metadata_path: Path) -> None:
+    """Write a small pill metadata CSV, with a duplicate row and a missing color."""
+    rows = [
+        ("c.jpg", "12", "ROUND", "WHITE"),
+        ("a.jpg", "7", "OVAL", "YELLOW"),
+        ("b.jpg", "12", "ROUND", ""),
+        ("a.jpg", "99", "CAPSULE", "BLUE"),
+    ]
+    with metadata_path.open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["images", "pilltype_id", "Shape", "Color"])
+        writer.writerows(rows)
+
+
+def test_label_index_round_trips_through_npz(tmp_path: Path) -> None:
+    write_metadata(tmp_path / "labels_metadata.csv")
+    built = build_label_index(
+        tmp_path / "labels_metadata.csv", tmp_path / "labels_metadata.npz"
+    )
+    loaded = LabelIndex(tmp_path / "labels_metadata.npz")
+
+    assert len(loaded) == 3
+    assert loaded.names.tolist() == ["a.jpg", "b.jpg", "c.jpg"]
+    for attribute in ("pilltype", "shape", "color"):
+        assert loaded.classes(attribute) == built.classes(attribute)
+        np.testing.assert_array_equal(
+            loaded.lookup(["a.jpg", "b.jpg", "c.jpg"], attribute),
+            built.lookup(["a.jpg", "b.jpg", "c.jpg"], attribute),
+        )
+
+
+def test_lookup_reads_the_first_row_of_every_image(tmp_path: Path) -> None:
+    write_metadata(tmp_path / "labels_metadata.csv")
+    index = load_label_index(tmp_path / "labels_metadata.csv")
+
+    shapes = index.classes("shape")
+    assert shapes == ["OVAL", "ROUND"]
+    assert [shapes[i] for i in index.lookup(["c.jpg", "a.jpg"], "shape")] == [
+        "ROUND",
+        "OVAL",
+    ]
+    colors = index.classes("color")
+    assert colors[index.lookup(["b.jpg"], "color")[0]] == UNKNOWN_CLASS
+
+
+def test_unknown_images_get_the_unknown_class(tmp_path: Path) -> None:
+    write_metadata(tmp_path / "labels_metadata.csv")
+    index = load_label_index(tmp_path / "labels_metadata.csv")
+
+    lookup = index.lookup(["zzz.jpg", "0.jpg", "a.jpg"], "pilltype")
+    assert lookup[:2].tolist() == [-1, -1]
+    assert index.classes("pilltype")[lookup[2]] == "7"
+    sprite_labels, classes = get_sprite_labels(["a.jpg", "zzz.jpg"], index, "pilltype")
+    assert classes == ["12", "7", UNKNOWN_CLASS]
+    assert [classes[i] for i in sprite_labels] == ["7", UNKNOWN_CLASS]
+
+
+def test_index_is_rebuilt_when_the_metadata_changes(tmp_path: Path) -> None:
+    metadata_path = tmp_path / "labels_metadata.csv"
+    write_metadata(metadata_path)
+    load_label_index(metadata_path)
+
+    with metadata_path.open("a", newline="") as f:
+        csv.writer(f).writerow(["d.jpg", "3", "ROUND", "RED"])
+    stat = (tmp_path / "labels_metadata.npz").stat()
+    os.utime(metadata_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    index = load_label_index(metadata_path)
+    assert len(index) == 4
+    assert index.classes("color")[index.lookup(["d.jpg"], "color")[0]] == "RED"
@@ -0,0 +1,110 @@
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from countpillar.mask_manifest import MASK_MANIFEST_FILE, MaskManifest
+
+PARAMS: Dict[str, Any] = {"model": "vit_b", "grabcut": True}
+
+
+def make_library(tmp_path: Path, n_images: int = 3) -> Tuple[Path, List[Path]]:
+    """Write source images and an empty mask folder."""
+    (tmp_path / "images").mkdir()
+    (tmp_path / "masks").mkdir()
+    image_paths = []
+    for i in range(n_images):
+        image_path = tmp_path / "images" / f"{i}.jpg"
+        image_path.write_bytes(bytes([i]) * 100)
+        image_paths.append(image_path)
+
+    return tmp_path / "masks", image_paths
+
+
+def save_masks(
+    masks_path: Path, image_paths: List[Path], params: Dict[str, Any] = PARAMS
+) -> None:
+    """Save a mask for every image and record it in the manifest."""
+    manifest = MaskManifest(masks_path, params)
+    for image_path in image_paths:
+        (masks_path / image_path.name).write_bytes(b"mask")
+        manifest.record(image_path)
+
+
+def test_recorded_masks_are_fresh(tmp_path: Path) -> None:
+    masks_path, image_paths = make_library(tmp_path)
+    stale, counts = MaskManifest(masks_path, PARAMS).get_stale(image_paths)
+    assert stale == image_paths
+    assert counts == {"new": 3}
+
+    save_masks(masks_path, image_paths)
+    stale, counts = MaskManifest(masks_path, PARAMS).get_stale(image_paths)
+
+    assert stale == []
+    assert counts == {"fresh": 3}
+
+
+def test_changed_source_image_is_stale(tmp_path: Path) -> None:
+    masks_path, image_paths = make_library(tmp_path)
+    save_masks(masks_path, image_paths)
+    image_paths[0].write_bytes(b"other content")
+
+    # Touching an image without changing its content keeps its mask fresh
+    stat = image_paths[1].stat()
+    os.utime(image_paths[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    stale, counts = MaskManifest(masks_path, PARAMS).get_stale(image_paths)
+
+    assert stale == [image_paths[0]]
+    assert counts == {"changed": 1, "fresh": 2}
+
+
+def test_other_params_make_every_mask_stale(tmp_path: Path) -> None:
+    masks_path, image_paths = make_library(tmp_path)
+    save_masks(masks_path, image_paths)
+
+    # The order of the parameters does not matter
+    reordered = {"grabcut": True, "model": "vit_b"}
+    assert MaskManifest(masks_path, reordered).get_stale(image_paths)[0] == []
+
+    stale, counts = MaskManifest(masks_path, {**PARAMS, "grabcut": False}).get_stale(
+        image_paths
+    )
+    assert stale == image_paths
+    assert counts == {"params": 3}
+
+
+def test_untracked_masks_are_adopted_if_newer(tmp_path: Path) -> None:
+    masks_path, image_paths = make_library(tmp_path)
+    for image_path in image_paths:
+        (masks_path / image_path.name).write_bytes(b"mask")
+    # The last mask is older than its image, so it may be out of date
+    stat = image_paths[2].stat()
+    os.utime(masks_path / "2.jpg", ns=(stat.st_atime_ns, stat.st_mtime_ns - 10**9))
+
+    stale, counts = MaskManifest(masks_path, PARAMS).get_stale(image_paths)
+    assert stale == image_paths
+    assert counts == {"untracked": 3}
+
+    stale, counts = MaskManifest(masks_path, PARAMS).get_stale(image_paths, adopt=True)
+    assert stale == [image_paths[2]]
+    assert counts == {"adopted": 2, "untracked": 1}
+
+    stale, counts = MaskManifest(masks_path, PARAMS).get_stale(image_paths)
+    assert stale == [image_paths[2]]
+    assert counts == {"fresh": 2, "untracked": 1}
+
+
+def test_compact_keeps_the_last_line_of_every_image(tmp_path: Path) -> None:
+    masks_path, image_paths = make_library(tmp_path)
+    save_masks(masks_path, image_paths)
+    save_masks(masks_path, image_paths[:1], {**PARAMS, "grabcut": False})
+    with (masks_path / MASK_MANIFEST_FILE).open("a") as f:
+        f.write('{"name": "1.jpg", "ha')
+
+    manifest = MaskManifest(masks_path, PARAMS)
+    manifest.compact()
+
+    assert len((masks_path / MASK_MANIFEST_FILE).read_text().splitlines()) == 3
+    stale, counts = MaskManifest(masks_path, PARAMS).get_stale(image_paths)
+    assert stale == [image_paths[0]]
+    assert counts == {"params": 1, "fresh": 2}
@@ -0,0 +1,51 @@
+from typing import List
+
+import numpy as np
+import pytest
+
+from countpillar.object_overlay import (
+    OverlapTracker,
+    add_pill_on_bg,
+    get_pill_roi,
+    verify_overlap,
+)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_overlap_tracker_matches_verify_overlap(seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    max_overlap = float(rng.uniform(0.05, 0.9))
+    bg_img = np.zeros((200, 300, 3), dtype=np.uint8)
+    comp_mask = np.zeros((200, 300), dtype=np.uint8)
+    tracker = OverlapTracker(max_overlap)
+    pill_areas: List[int] = []
+
+    n_decisions = 0
+    for _ in range(150):
+        h, w = rng.integers(10, 60, size=2)
+        mask = (rng.random((h, w)) < 0.8).astype(np.uint8)
+        pill_img = np.full((h, w, 3), 9, dtype=np.uint8)
+        x, y = int(rng.integers(-20, 300)), int(rng.integers(-20, 200))
+        roi = get_pill_roi(bg_img.shape, mask.shape, x, y)
+        if roi is None:
+            continue
+
+        bg_roi = roi[0]
+        bg_img_prev, comp_mask_prev = bg_img[bg_roi].copy(), comp_mask[bg_roi].copy()
+        bg_img, comp_mask, added_mask, pill_added = add_pill_on_bg(
+            bg_img, comp_mask, pill_img, mask, x, y, len(pill_areas) + 1
+        )
+        if not pill_added:
+            bg_img[bg_roi], comp_mask[bg_roi] = bg_img_prev, comp_mask_prev
+            continue
+
+        expected = verify_overlap(comp_mask, pill_areas, max_overlap)
+        assert tracker.add(comp_mask_prev, added_mask) == expected
+        n_decisions += 1
+        if expected:
+            pill_areas.append(int(np.count_nonzero(added_mask)))
+            assert tracker.pill_areas == pill_areas
+        else:
+            bg_img[bg_roi], comp_mask[bg_roi] = bg_img_prev, comp_mask_prev
+
+    assert n_decisions > 0
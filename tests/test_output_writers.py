@@ -0,0 +1,33 @@
+import csv
+import tarfile
+from pathlib import Path
+from typing import Dict
+
+from countpillar.output_writers import TarShardWriter, read_shard_member
+
+
+def test_tar_shard_index_locates_every_member(tmp_path: Path) -> None:
+    members: Dict[str, bytes] = {}
+    writer = TarShardWriter(tmp_path, 3)
+    for idx, size in enumerate([0, 1, 511, 512, 513, 5000]):
+        image = bytes(range(256)) * (size // 256) + bytes(size % 256)
+        labels = f"0 0.5 0.5 0.{idx} 0.1\n" * idx
+        writer.write(f"{idx}_{idx}", image, labels)
+        members[f"{idx}_{idx}.jpg"] = image
+        members[f"{idx}_{idx}.txt"] = labels.encode()
+    assert len(writer) == 6
+    writer.close()
+
+    with writer.index_path.open(newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["member"] for row in rows] == list(members)
+    for row in rows:
+        data = read_shard_member(writer.path, int(row["offset"]), int(row["size"]))
+        assert data == members[row["member"]]
+
+    # The shard is still a valid tar archive holding the same members
+    with tarfile.open(writer.path) as tar:
+        for info in tar.getmembers():
+            extracted = tar.extractfile(info)
+            assert extracted is not None
+            assert extracted.read() == members[info.name]
@@ -0,0 +1,73 @@
+from collections import Counter
+from typing import List
+
+import numpy as np
+import pytest
+
+from countpillar.random_utils import get_sample_rng
+from countpillar.scheduler import CoverageScheduler, get_block_quotas
+
+
+def plan(scheduler: CoverageScheduler, indices: List[int]) -> List[List[int]]:
+    """Plan the samples of some indices, with the random streams of the samples."""
+    return [
+        scheduler.plan_sample(idx, get_sample_rng(scheduler.seed, idx))
+        for idx in indices
+    ]
+
+
+def test_blocks_hold_every_cell_by_quota() -> None:
+    n_cells = 3 * 2
+    weights = np.arange(1, n_cells + 1, dtype=float)
+    scheduler = CoverageScheduler(0, 1, 30, 2, 3, weights=weights, block_size=40)
+    quotas = get_block_quotas(weights, 40)
+    assert quotas.sum() == 40
+
+    for block in range(5):
+        cells = Counter(
+            scheduler.get_cell(idx) for idx in range(40 * block, 40 * (block + 1))
+        )
+        assert [cells[cell] for cell in range(n_cells)] == quotas.tolist()
+
+
+def test_plans_fall_in_their_cells() -> None:
+    scheduler = CoverageScheduler(1, 5, 50, 4, 10)
+    for idx, pills_per_type in enumerate(plan(scheduler, list(range(400)))):
+        lo, hi, n_types = scheduler.cells[scheduler.get_cell(idx)]
+        assert len(pills_per_type) == n_types
+        assert all(n > 0 for n in pills_per_type)
+        assert lo <= sum(pills_per_type) <= hi
+        assert scheduler.find_cell(sum(pills_per_type), n_types) == scheduler.get_cell(
+            idx
+        )
+
+
+def test_plans_are_deterministic_per_seed() -> None:
+    indices = list(range(200))
+    plans = plan(CoverageScheduler(7, 5, 50, 3, 10), indices)
+
+    # A fresh scheduler gives the same plans, in any order
+    shuffled = list(np.random.default_rng(0).permutation(indices))
+    replanned = dict(zip(shuffled, plan(CoverageScheduler(7, 5, 50, 3, 10), shuffled)))
+    assert [replanned[idx] for idx in indices] == plans
+
+    assert plan(CoverageScheduler(8, 5, 50, 3, 10), indices) != plans
+
+
+@pytest.mark.parametrize("split", [(0, 90), (90, 150)])
+def test_index_splits_cover_every_cell_evenly(split: List[int]) -> None:
+    # A train and a validation split made of whole blocks of indices both cover
+    # every cell equally, and the validation split does not depend on the training
+    # one being planned first
+    scheduler = CoverageScheduler(3, 5, 50, 3, 10)
+    assert scheduler.block_size == 30
+    first, last = split
+    cells = Counter(scheduler.get_cell(idx) for idx in range(first, last))
+    n_blocks = (last - first) // scheduler.block_size
+    assert set(cells.values()) == {n_blocks}
+    assert len(cells) == len(scheduler.cells)
+
+    warm = CoverageScheduler(3, 5, 50, 3, 10)
+    plan(warm, list(range(first)))
+    indices = list(range(first, last))
+    assert plan(warm, indices) == plan(CoverageScheduler(3, 5, 50, 3, 10), indices)
@@ -0,0 +1,38 @@
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from countpillar.streaming import SyntheticPillDataset  # noqa: E402
+
+
+def take_images(dataset: SyntheticPillDataset, n_images: int) -> List[np.ndarray]:
+    """Take the first images of an iteration over a dataset."""
+    images = iter(dataset)
+    return [next(images)[0] for _ in range(n_images)]
+
+
+def test_endless_epochs_draw_new_samples(pill_mask_path: Path) -> None:
+    dataset = SyntheticPillDataset(
+        pill_mask_path,
+        seed=3,
+        transform=None,
+        min_bg_dim=128,
+        max_bg_dim=160,
+        longest_min=30,
+        longest_max=50,
+        min_pills=2,
+        max_pills=4,
+    )
+    first_epoch = take_images(dataset, 2)
+    dataset.set_epoch(1)
+    second_epoch = take_images(dataset, 2)
+    dataset.set_epoch(0)
+
+    for first, second in zip(first_epoch, second_epoch):
+        assert not np.array_equal(first, second)
+    for first, replayed in zip(first_epoch, take_images(dataset, 2)):
+        np.testing.assert_array_equal(first, replayed)
@@ -0,0 +1,104 @@
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import pytest
+
+from countpillar.random_utils import get_sample_rng
+from countpillar.transform import get_default_augmentations
+from countpillar.variant_bank import VariantBank
+
+SEED = 3
+
+
+def make_sprites(n_sprites: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Make sprites of random colors, each with a rectangular mask."""
+    rng = np.random.default_rng(0)
+    sprites = []
+    for _ in range(n_sprites):
+        img = rng.integers(0, 256, size=(40, 60, 3), dtype=np.uint8)
+        mask = np.zeros((40, 60), dtype=np.uint8)
+        mask[5:35, 10:50] = 255
+        sprites.append((img, mask))
+
+    return sprites
+
+
+def draw_samples(
+    bank: VariantBank,
+    sprites: Sequence[Tuple[np.ndarray, np.ndarray]],
+    indices: Sequence[int],
+) -> Dict[int, List[Tuple[np.ndarray, np.ndarray]]]:
+    """Draw the pills of a few samples from a bank, as a worker composing them."""
+    pills: Dict[int, List[Tuple[np.ndarray, np.ndarray]]] = {}
+    for idx in indices:
+        bank.start_sample(idx)
+        rng = get_sample_rng(SEED, idx)
+        pills[idx] = []
+        for key in rng.integers(len(sprites), size=4).tolist():
+            img, mask = sprites[key]
+            pills[idx].append(
+                bank.get(
+                    key,
+                    img,
+                    mask,
+                    rng=rng,
+                    longest_min=20,
+                    longest_max=40,
+                    augmentations=get_default_augmentations(),
+                )
+            )
+
+    return pills
+
+
+def test_variants_do_not_depend_on_worker_chunking() -> None:
+    sprites = make_sprites(5)
+    single_worker = draw_samples(
+        VariantBank(4, seed=SEED, refresh_every=4), sprites, range(12)
+    )
+
+    # Several workers, each composing its chunks of samples in any order, and a
+    # worker whose bank is too small to keep the variants of every sprite
+    chunked: Dict[int, List[Tuple[np.ndarray, np.ndarray]]] = {}
+    for chunk in ([8, 9, 10, 11], [4, 5, 6, 7], [0, 1, 2, 3]):
+        bank = VariantBank(4, seed=SEED, refresh_every=4)
+        chunked.update(draw_samples(bank, sprites, chunk))
+    small_bank = VariantBank(4, max_bytes=40_000, seed=SEED, refresh_every=4)
+    evicting = draw_samples(small_bank, sprites, [11, 3, 7, 0, 10, 5])
+    assert small_bank._cache.evictions > 0
+
+    for pills in (chunked, evicting):
+        for idx, sample_pills in pills.items():
+            for (img, mask), (img_ref, mask_ref) in zip(
+                sample_pills, single_worker[idx]
+            ):
+                np.testing.assert_array_equal(img, img_ref)
+                np.testing.assert_array_equal(mask, mask_ref)
+
+
+def test_variants_are_refreshed_every_generation() -> None:
+    img, mask = make_sprites(1)[0]
+    bank = VariantBank(1, seed=SEED, refresh_every=4)
+    kwargs = dict(longest_min=20, longest_max=200)
+
+    first = bank.get(0, img, mask, **kwargs)
+    bank.start_sample(3)
+    assert bank.get(0, img, mask, **kwargs) is first
+    bank.start_sample(4)
+    assert bank.get(0, img, mask, **kwargs) is not first
+    assert len(bank) == 2
+
+
+@pytest.mark.parametrize("n_sprites", [1, 6])
+def test_bank_fits_in_its_memory_budget(n_sprites: int) -> None:
+    sprites = make_sprites(n_sprites)
+    max_bytes = 30_000
+    bank = VariantBank(4, max_bytes=max_bytes, seed=SEED)
+
+    for key, (img, mask) in enumerate(sprites):
+        bank.get(key, img, mask, longest_min=40, longest_max=40)
+        assert bank._cache.nbytes <= max_bytes
+
+    # Four variants of a 40 x 26 sprite take 16640 bytes: a single sprite fits
+    assert len(bank) == 1
+    assert bank._cache.evictions == n_sprites - 1